@@ -21,8 +21,14 @@ from camera_calibration.utils.ARHelper import ARHelper
 from camera_calibration.utils.MeanHelper import MeanHelper
 from camera_calibration.utils.DaVinci import DaVinci
 from camera_calibration.utils.EyeHandSolver import EyeHandSolver
+from camera_calibration.utils.CalibrationUncertainty import CalibrationUncertainty
+from camera_calibration.utils.HandEyeBatchSolver import HandEyeBatchSolver
+from camera_calibration.utils.HandEyeRefiner import HandEyeRefiner
+from camera_calibration.utils.PoseDiversityScorer import PoseDiversityScorer
 from camera_calibration.params.aruco_dicts import ARUCO_DICT
 from camera_calibration.utils.JSONHelper import JSONHelper
+from camera_calibration.utils.Profiler import Profiler
+from camera_calibration.params.calibration import config_path
 
 import cv2
 
@@ -30,7 +36,7 @@ import cv2
 class ExtrinsicEstimator(object):
 
     def __init__(self, board_name, camera_name, camera_topic, eye_in_hand, memory_size, load_data_directory,
-                 save_data_directory):
+                 save_data_directory, uncertainty_parameters=None, refinement_parameters=None, pose_selection_size=15):
 
         camera_intrinsics = JSONHelper.get_camera_intrinsics(camera_name)
         board_data = JSONHelper.get_board_parameters(board_name)
@@ -72,6 +78,21 @@ class ExtrinsicEstimator(object):
         self.camera_estimates = []
         self.pose_estimations_all_algorithms = None
 
+        # "uncertainty": {"mode": "bootstrap" or "jackknife", "resamples": 2000, "seed": 0}
+        self.uncertainty_parameters = uncertainty_parameters
+        self.calibration_covariances = None
+
+        # "refinement": {"loss": "huber", "f_scale": 1.0}, charuco corners of every captured view
+        self.refinement_parameters = refinement_parameters
+        self.hand_eye_refiner = HandEyeRefiner(camera_matrix=self.camera_matrix, dist_coefficients=self.distortion,
+                                               board_corners=self.arHelper.get_board_corners())
+        self.charuco_observations = []
+        self.refinement_result = None
+
+        # Conditioning of the captured gripper rotations, updated per collected pose
+        self.pose_diversity_scorer = PoseDiversityScorer()
+        self.pose_selection_size = pose_selection_size
+
         self.memory_size = memory_size
         self.current_image = None
         self.Frame = Enum('Frame', 'camera charuco world panda_hand')
@@ -91,6 +112,7 @@ class ExtrinsicEstimator(object):
         self.live_camera_estimate_name = 'live_camera_estimate'
         self.live_estimate_result = None
 
+    @Profiler.profile('camera_callback')
     def camera_callback(self, input_image):
         try:
             self.current_image = self.cv_bridge.imgmsg_to_cv2(input_image, desired_encoding="bgr8")
@@ -116,6 +138,7 @@ class ExtrinsicEstimator(object):
                "[r]un_solver " \
                "[e]xtensive_run " \
                "[c]ollect " \
+               "[o]ptimal_subset " \
                "[t]oggle_mode"
         display_image = DaVinci.pad_image_cv(self.current_image)
         DaVinci.draw_text_box_in_corner(
@@ -135,6 +158,16 @@ class ExtrinsicEstimator(object):
             font_scale=0.8,
         )
 
+        if not self.toggle_marker_calibration:
+            DaVinci.draw_text_box_in_corner(
+                image=display_image,
+                text=self.pose_diversity_text(),
+                position='top_right',
+                background=(0, 0, 0),
+                thickness=1,
+                font_scale=0.8,
+            )
+
         cv2.imshow('External calibration display', display_image)
 
         # ---------------------- Input
@@ -152,10 +185,15 @@ class ExtrinsicEstimator(object):
 
             else:
                 self.save_camera_target_transform()
+                self.charuco_observations.append(self.arHelper.charuco_observation)
                 self.collect_robot_transforms()
                 if len(self.transforms_camera2charuco) > len(self.transforms_hand2world):
                     self.transforms_camera2charuco = self.transforms_camera2charuco[:-1]
+                    self.charuco_observations = self.charuco_observations[:-1]
                     self.solve_all_methods()
+                else:
+                    score = self.pose_diversity_scorer.add(self.to_rotation(self.transforms_hand2world[-1]))
+                    print(f'Pose {score["poses"]}: {self.format_score(score)}')
 
         elif key == ord('u') and len(self.transforms_camera2charuco) > 0:  # Undo
             if self.toggle_marker_calibration:
@@ -163,11 +201,11 @@ class ExtrinsicEstimator(object):
             else:
                 self.transforms_camera2charuco = self.transforms_camera2charuco[:-1]
                 self.transforms_hand2world = self.transforms_hand2world[:-1]
+                self.charuco_observations = self.charuco_observations[:-1]
+                self.pose_diversity_scorer.remove_last()
 
         elif key == ord('e') and len(self.transforms_camera2charuco) >= 3:  # Run
-            self.eye_hand_solver = EyeHandSolver(transforms_hand2world=self.transforms_hand2world,
-                                                 transforms_camera2charuco=self.transforms_camera2charuco,
-                                                 number_of_transforms=len(self.transforms_camera2charuco))
+            self.eye_hand_solver = self.create_eye_hand_solver()
             self.run_solvers()
 
         elif key == ord('r') and (len(self.transforms_camera2charuco) >= 3 or len(self.marker_mode_memory) > 0):  # Plot
@@ -206,17 +244,32 @@ class ExtrinsicEstimator(object):
                 JSONHelper.save_extrinsic_data(eye_in_hand=self.eye_in_hand,
                                                camera2target=self.transforms_camera2charuco,
                                                hand2world=self.transforms_hand2world, estimates=self.camera_estimates,
-                                               directory_name=self.save_directory)
+                                               directory_name=self.save_directory,
+                                               covariances=self.calibration_covariances,
+                                               charuco_observations=self.charuco_observations,
+                                               refinement=self.refinement_result)
+
+        elif key == ord('o') and len(self.transforms_hand2world) >= 3:  # Best conditioned subset
+            self.select_pose_subset()
 
         elif key == ord('t'):
             self.toggle_marker_calibration = not self.toggle_marker_calibration
         elif key == ord('p'):
             print(self.get_transform_between(self.Frame.world.name, self.live_camera_estimate_name))
 
+    def create_eye_hand_solver(self):
+        # The previous solver's process pool is shut down, the new one starts its own on first use
+        if self.eye_hand_solver is not None:
+            self.eye_hand_solver.close()
+
+        uncertainty_parameters = self.uncertainty_parameters if self.uncertainty_parameters is not None else dict()
+        return EyeHandSolver(transforms_hand2world=self.transforms_hand2world,
+                             transforms_camera2charuco=self.transforms_camera2charuco,
+                             number_of_transforms=len(self.transforms_camera2charuco),
+                             processes=uncertainty_parameters.get('processes'))
+
     def solve_all_methods(self):
-        self.eye_hand_solver = EyeHandSolver(transforms_hand2world=self.transforms_hand2world,
-                                             transforms_camera2charuco=self.transforms_camera2charuco,
-                                             number_of_transforms=len(self.transforms_camera2charuco))
+        self.eye_hand_solver = self.create_eye_hand_solver()
         if len(self.transforms_camera2charuco) >= 3:
             self.pose_estimations_all_algorithms = self.eye_hand_solver.solve_all_algorithms()
 
@@ -253,19 +306,58 @@ class ExtrinsicEstimator(object):
 
         self.transforms_camera2charuco.append(average_stamped_transform)
 
-    def collect_robot_transforms(self):
-
+    def get_robot_frames(self):
         if self.eye_in_hand:
-            origin = self.Frame.world.name
-            child = self.Frame.panda_hand.name
-        else:
-            origin = self.Frame.panda_hand.name
-            child = self.Frame.world.name
+            return self.Frame.world.name, self.Frame.panda_hand.name
+        return self.Frame.panda_hand.name, self.Frame.world.name
+
+    def collect_robot_transforms(self):
+        origin, child = self.get_robot_frames()
 
         hand2world = self.get_transform_between(origin=origin, to=child)
         if hand2world is not None:
             self.transforms_hand2world.append(hand2world)
 
+    @staticmethod
+    def to_rotation(transform):
+        rotations, _ = TypeConverter.transform_to_matrices([transform])
+        return rotations[0]
+
+    def pose_diversity_text(self):
+        # Conditioning so far and what collecting at the current robot pose would give
+        score = self.pose_diversity_scorer.score()
+        text = f"Diversity: spread {score['rotation_spread']:.2f}, worst axis {score['worst_axis_degrees']:.1f} deg"
+
+        origin, child = self.get_robot_frames()
+        if not self.tfBuffer.can_transform(origin, child, rospy.Time()):
+            return text
+        candidate = self.pose_diversity_scorer.evaluate(
+            self.to_rotation(self.tfBuffer.lookup_transform(origin, child, rospy.Time())))
+        return (f"{text} | here: worst axis {candidate['worst_axis_degrees']:.1f} deg, "
+                f"gain {candidate['log_det'] - score['log_det']:+.2f}")
+
+    @staticmethod
+    def format_score(score):
+        return (f"spread {score['rotation_spread']:.2f}, worst axis {score['worst_axis_degrees']:.1f} deg, "
+                f"translation {score['translation_conditioning']:.3f}, log det {score['log_det']:.2f}")
+
+    def select_pose_subset(self):
+        # Keep only the best conditioned pose_selection_size poses (capture order kept), the
+        # next run, save or refinement uses the subset
+        rotations = [self.to_rotation(transform) for transform in self.transforms_hand2world]
+        selected = sorted(PoseDiversityScorer.select(rotations, self.pose_selection_size))
+        if len(selected) == len(rotations):
+            print(f'All {len(rotations)} poses are kept, pose_selection_size is {self.pose_selection_size}')
+            return
+
+        print(f'All {len(rotations)} poses: {self.format_score(self.pose_diversity_scorer.score())}')
+        self.transforms_hand2world = [self.transforms_hand2world[index] for index in selected]
+        self.transforms_camera2charuco = [self.transforms_camera2charuco[index] for index in selected]
+        if len(self.charuco_observations) == len(rotations):
+            self.charuco_observations = [self.charuco_observations[index] for index in selected]
+        score = self.pose_diversity_scorer.reset([rotations[index] for index in selected])
+        print(f'Kept poses {selected}: {self.format_score(score)}')
+
     def get_transform_between(self, origin, to):
         try:
             transform = self.tfBuffer.lookup_transform(origin, to, rospy.Time())
@@ -282,6 +374,9 @@ class ExtrinsicEstimator(object):
             self.transforms_camera2charuco, self.transforms_hand2world = JSONHelper.load_extrinsic_data(
                 load_data_directory,
                 self.eye_in_hand)
+            charuco_observations = JSONHelper.load_charuco_observations(load_data_directory, self.eye_in_hand)
+            self.charuco_observations = charuco_observations if charuco_observations is not None else []
+            self.pose_diversity_scorer.reset([self.to_rotation(transform) for transform in self.transforms_hand2world])
 
     def publish_camera_estimates(self):
         rotation, translation = self.pose_estimations_all_algorithms[0][0]
@@ -315,6 +410,8 @@ class ExtrinsicEstimator(object):
 
         self.camera_estimates = TypeConverter.estimates_to_transforms(pose_estimations_methods, self.parent_frame_name)
         self.calculate_mean_estimate()
+        self.calculate_covariances(pose_estimations_methods)
+        self.refine_estimate(pose_estimations_methods)
         for method in self.methods:
             rotation, translation = pose_estimations_methods[method][0]
             rotation = TypeConverter.matrix_to_quaternion_vector(rotation)
@@ -374,6 +471,56 @@ class ExtrinsicEstimator(object):
         #
         # HarryPlotter.stacked_histogram(frame_variance)
 
+    def calculate_covariances(self, pose_estimations_methods):
+        if self.uncertainty_parameters is None:
+            return
+
+        calibration_uncertainty = CalibrationUncertainty(
+            eye_hand_solver=self.eye_hand_solver,
+            mode=self.uncertainty_parameters.get('mode', 'bootstrap'),
+            resamples=self.uncertainty_parameters.get('resamples', 2000),
+            seed=self.uncertainty_parameters.get('seed')
+        )
+        self.calibration_covariances = calibration_uncertainty.estimate_all(pose_estimations_methods)
+
+    def refine_estimate(self, pose_estimations_methods):
+        # Best closed form estimate refined on the charuco corners of every view
+        if self.refinement_parameters is None:
+            return
+        if len(self.charuco_observations) != len(self.transforms_camera2charuco):
+            print('No charuco corners for the captured views, skipping refinement')
+            return
+
+        rot_hand2world, tran_hand2world, rot_camera2charuco, tran_camera2charuco = self.eye_hand_solver.pose_arrays
+        self.refinement_result = self.hand_eye_refiner.refine(
+            hand2world=HandEyeBatchSolver.to_homogeneous(rot_hand2world, tran_hand2world),
+            camera2charuco=HandEyeBatchSolver.to_homogeneous(rot_camera2charuco, tran_camera2charuco),
+            observations=self.charuco_observations,
+            candidates={CalibrationUncertainty.METHOD_NAMES[method]: estimates[0]
+                        for method, estimates in pose_estimations_methods.items()},
+            loss=self.refinement_parameters.get('loss', 'huber'),
+            f_scale=self.refinement_parameters.get('f_scale', 1.)
+        )
+        if self.refinement_result is None:
+            print('No charuco corners or no solved closed form estimate, skipping refinement')
+            return
+
+        result = self.refinement_result
+        print(f"Refined {result['initial_method']} on {result['corners']} corners in {result['views']} views: "
+              f"rms {result['initial_rms']:.3f} -> {result['rms']:.3f} px, "
+              f"std {np.round(result['translation_std'], 5)} m {np.round(result['rotation_std_degrees'], 4)} deg")
+
+        rotation = TypeConverter.matrix_to_quaternion_vector(result['rotation'])
+        translation = result['translation']
+        self.camera_estimates.append(TypeConverter.vectors_to_stamped_transform(translation=translation,
+                                                                                rotation=rotation,
+                                                                                parent_frame=self.parent_frame_name,
+                                                                                child_frame='camera_estimate_REFINED'))
+        TFPublish.publish_static_transform(publisher=tf2_ros.StaticTransformBroadcaster(),
+                                           parent_name=self.parent_frame_name,
+                                           child_name='camera_estimate_REFINED',
+                                           rotation=rotation, translation=translation)
+
     def calculate_mean_estimate(self):
         mean_translation, mean_rotation = MeanHelper.riemannian_mean(self.camera_estimates)
         # print(mean_translation, mean_rotation)
@@ -390,6 +537,8 @@ if __name__ == '__main__':
     board_name, camera_name, mode, camera_topic, memory_size, load_data_directory, save_data_directory = JSONHelper.get_extrinsic_calibration_parameters(
         config_file)
     rospy.init_node('hand_eye_node')
+    parameters = JSONHelper.read_json(f'{config_path}{config_file}')
+    Profiler.setup(parameters.get('profiling'), node_name='hand_eye_node')
     if mode == 'eye_in_hand':
         eye_in_hand = True
     else:
@@ -399,10 +548,15 @@ if __name__ == '__main__':
                                              eye_in_hand=eye_in_hand,
                                              camera_topic=camera_topic,
                                              memory_size=memory_size, load_data_directory=load_data_directory,
-                                             save_data_directory=save_data_directory)
+                                             save_data_directory=save_data_directory,
+                                             uncertainty_parameters=parameters.get('uncertainty'),
+                                             refinement_parameters=parameters.get('refinement'),
+                                             pose_selection_size=parameters.get('pose_selection_size', 15))
 
     try:
         rospy.spin()
     except KeyboardInterrupt:
         print('Shutting down.')
+    if extrinsic_estimator.eye_hand_solver is not None:
+        extrinsic_estimator.eye_hand_solver.close()
     cv2.destroyAllWindows()
@@ -2,6 +2,7 @@
 import cv2
 import numpy as np
 from camera_calibration.utils.DaVinci import DaVinci
+from camera_calibration.utils.Profiler import Profiler
 
 
 class ARHelper:
@@ -26,6 +27,9 @@ class ARHelper:
             charuco_board_shape[1], charuco_board_shape[0], charuco_square_size,
             charuco_marker_size, self.aruco_dict)
 
+        # (charuco ids, corners) of the last image the board pose was estimated from
+        self.charuco_observation = None
+
     def find_markers(self, img, debug=False):
 
         gray_image = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -133,6 +137,7 @@ class ARHelper:
                 image = DaVinci.draw_charuco_corner(image, corner)
         return True, image
 
+    @Profiler.profile('estimate_charuco_pose')
     def estimate_charuco_pose(self, image, camera_matrix, dist_coefficients):
 
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -140,6 +145,7 @@ class ARHelper:
         parameters = cv2.aruco.DetectorParameters_create()
 
         corners, ids, rejected_img_points = cv2.aruco.detectMarkers(gray, self.aruco_dict, parameters=parameters)
+        self.charuco_observation = None
         if ids is None:
             return image, self.reverse_rvec(self.rvec_un_reversed), self.tvec
         cv2.aruco.drawDetectedMarkers(image, corners)
@@ -170,6 +176,8 @@ class ARHelper:
                                                                 useExtrinsicGuess=False)
         self.rvec_un_reversed = rvec
         self.tvec = tvec
+        if retval:
+            self.charuco_observation = (charuco_ids.ravel().copy(), charuco_corners.reshape(-1, 2).copy())
         rvec = self.reverse_rvec(rvec)
         if rvec is not None and tvec is not None:
             cv2.drawFrameAxes(image=image, cameraMatrix=camera_matrix, distCoeffs=dist_coefficients, rvec=rvec,
@@ -178,6 +186,10 @@ class ARHelper:
 
         return image, rvec, tvec
 
+    def get_board_corners(self):
+        # (K,3) chessboard corners in the board frame, row k is charuco id k
+        return np.array(self.charuco_board.chessboardCorners).reshape(-1, 3)
+
     def reverse_rvec(self, rvec):
         # REMOVE ME PLEASE!
         # rotation_matrix, _ = cv2.Rodrigues(rvec)
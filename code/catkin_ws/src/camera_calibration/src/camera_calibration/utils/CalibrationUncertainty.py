@@ -0,0 +1,96 @@
+import cv2
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from camera_calibration.utils.HandEyeBatchSolver import HandEyeBatchSolver
+
+
+# Bootstrap / jackknife spread of the hand-eye estimates. Pose pairs are resampled, every
+# resample is solved again (batched NumPy solvers for Tsai/Park/Andreff, the solver's
+# OpenCV process pool for the others) and the translation (m) and rotation (rad, rotation
+# vector of estimate^T * resample, i.e. in the camera frame) deviations from the
+# estimate give a 3x3 covariance each.
+class CalibrationUncertainty(object):
+    METHOD_NAMES = {
+        cv2.CALIB_HAND_EYE_TSAI: 'TSAI',
+        cv2.CALIB_HAND_EYE_PARK: 'PARK',
+        cv2.CALIB_HAND_EYE_HORAUD: 'HORAUD',
+        cv2.CALIB_HAND_EYE_ANDREFF: 'ANDREFF',
+        cv2.CALIB_HAND_EYE_DANIILIDIS: 'DANIILIDIS'
+    }
+
+    def __init__(self, eye_hand_solver, mode='bootstrap', resamples=2000, seed=None):
+        if mode not in ('bootstrap', 'jackknife'):
+            raise ValueError(f'Unknown uncertainty mode {mode}')
+
+        self.eye_hand_solver = eye_hand_solver
+        self.mode = mode
+        self.resamples = resamples
+        self.rng = np.random.default_rng(seed)
+        self.number_of_poses = len(eye_hand_solver.transforms_camera2charuco)
+
+    def create_subsets(self):
+        if self.mode == 'jackknife':
+            # Leave one pose out
+            indices = np.arange(self.number_of_poses)
+            return np.array([np.delete(indices, left_out) for left_out in indices])
+
+        # Poses drawn with replacement
+        return self.rng.integers(0, self.number_of_poses, size=(self.resamples, self.number_of_poses))
+
+    def solve_subsets(self, method, subsets):
+        if method in self.eye_hand_solver.get_batch_solver().solvers:
+            return self.eye_hand_solver.get_batch_solver().solve(method, subsets)
+
+        return self.eye_hand_solver.get_sweep().solve_subsets(method, subsets)
+
+    def covariance(self, method, rotation, translation, subsets):
+        rotations, translations = self.solve_subsets(method, subsets)
+        solved = np.isfinite(rotations).all(axis=(1, 2)) & np.isfinite(translations).all(axis=1)
+        rotations, translations = rotations[solved], translations[solved]
+        if len(rotations) < 2:
+            return None
+
+        translation_deviations = translations - np.asarray(translation).ravel()
+        rotation_deviations = Rotation.from_matrix(
+            np.asarray(rotation).T @ HandEyeBatchSolver.closest_rotations(rotations)).as_rotvec()
+
+        if self.mode == 'jackknife':
+            # Spread of leave one out estimates around their mean, scaled by (n - 1)
+            count = len(rotations)
+            translation_covariance = (count - 1) * np.cov(translation_deviations, rowvar=False, bias=True)
+            rotation_covariance = (count - 1) * np.cov(rotation_deviations, rowvar=False, bias=True)
+        else:
+            translation_covariance = np.cov(translation_deviations, rowvar=False)
+            rotation_covariance = np.cov(rotation_deviations, rowvar=False)
+
+        return {
+            'mode': self.mode,
+            'samples': int(len(rotations)),
+            'failed': int(np.count_nonzero(~solved)),
+            'translation_covariance': translation_covariance.tolist(),
+            'rotation_covariance': rotation_covariance.tolist(),
+            'translation_std': np.sqrt(np.diag(translation_covariance)).tolist(),
+            'rotation_std_degrees': np.degrees(np.sqrt(np.diag(rotation_covariance))).tolist()
+        }
+
+    def estimate_all(self, pose_estimations_methods):
+        # {'TSAI': {...}, ...} for every method estimate of EyeHandSolver.solve_all_algorithms,
+        # every method is solved on the same resamples
+        subsets = self.create_subsets()
+        covariances = dict()
+        for method, estimates in pose_estimations_methods.items():
+            rotation, translation = estimates[0]
+            if rotation is None or translation is None:
+                continue
+
+            covariance = self.covariance(method, rotation, translation, subsets)
+            if covariance is None:
+                print(f'Not enough solvable resamples for {self.METHOD_NAMES[method]}')
+                continue
+            covariances[self.METHOD_NAMES[method]] = covariance
+            print(f"{self.METHOD_NAMES[method]} {self.mode} std: "
+                  f"translation {np.round(covariance['translation_std'], 5)} m, "
+                  f"rotation {np.round(covariance['rotation_std_degrees'], 4)} deg")
+
+        return covariances
@@ -4,10 +4,12 @@ import random
 import cv2
 
 from camera_calibration.utils.TypeConverter import TypeConverter
+from camera_calibration.utils.HandEyeSweep import HandEyeSweep
+from camera_calibration.utils.HandEyeBatchSolver import HandEyeBatchSolver
 
 
 class EyeHandSolver(object):
-    def __init__(self, transforms_hand2world, transforms_camera2charuco, number_of_transforms):
+    def __init__(self, transforms_hand2world, transforms_camera2charuco, number_of_transforms, processes=None):
         self.methods = [
             cv2.CALIB_HAND_EYE_TSAI,
             cv2.CALIB_HAND_EYE_PARK,
@@ -18,6 +20,28 @@ class EyeHandSolver(object):
         self.num_images_to_capture = number_of_transforms
         self.transforms_hand2world = transforms_hand2world
         self.transforms_camera2charuco = transforms_camera2charuco
+        self.pose_arrays = self.to_pose_arrays(transforms_hand2world, transforms_camera2charuco)
+        self.batch_solver = None
+        self.close()
+        self.processes = processes
+        self.sweep = None
+
+    @staticmethod
+    def to_pose_arrays(transforms_hand2world, transforms_camera2charuco):
+        # Converted once, every subset is an index into these
+        rot_hand2world, tran_hand2world = TypeConverter.transform_to_matrices(transforms_hand2world)
+        rot_camera2charuco, tran_camera2charuco = TypeConverter.transform_to_matrices(transforms_camera2charuco)
+        return rot_hand2world, tran_hand2world, rot_camera2charuco, tran_camera2charuco
+
+    def default_sample_sizes(self, start_sample_size, end_sample_size, step_size):
+        if end_sample_size is None:
+            end_sample_size = self.num_images_to_capture + 1
+        if start_sample_size is None:
+            half_size = int(self.num_images_to_capture / 2)
+            start_sample_size = half_size if half_size >= 3 else 3
+        # Never more than the captured poses
+        end_sample_size = min(end_sample_size, len(self.transforms_camera2charuco) + 1)
+        return list(range(start_sample_size, end_sample_size, step_size))
 
     @staticmethod
     def solve(fixed2attached, hand2base, solve_method, attached2hand_guess=None):
@@ -69,46 +93,40 @@ class EyeHandSolver(object):
             solve_method=None,
             start_sample_size=None,
             end_sample_size=None,
-            step_size=1):
+            step_size=1,
+            max_subsets=300,
+            seed=None):
 
-        if end_sample_size is None:
-            end_sample_size = self.num_images_to_capture + 1
+        # {sample_size: [(rot, tran), ...]}, up to max_subsets random subsets per size
         if solve_method is None:
             solve_method = self.methods[0]
-        if start_sample_size is None:
-            half_size = int(self.num_images_to_capture / 2)
-            start_sample_size = half_size if half_size >= 3 else 3
 
-        poses = dict()
-        list_size = len(self.transforms_camera2charuco)
-        max_iterations = 0
-        # For every sample size
-        for sample_size in range(start_sample_size, end_sample_size, step_size):
-            print(sample_size)
-            poses[sample_size] = list()
-
-            # For every index combination
-            for sample_indices in combinations(range(list_size), sample_size):
-                # Take out subset of indices
-                camera2aruco_subset = [self.transforms_camera2charuco[index] for index in sample_indices]
-                hand2base_subset = [self.transforms_hand2world[index] for index in sample_indices]
+        poses = self.sweep_sample_combos(
+            methods=[solve_method],
+            start_sample_size=start_sample_size,
+            end_sample_size=end_sample_size,
+            step_size=step_size,
+            max_subsets=max_subsets,
+            seed=seed
+        )
+        return poses[solve_method]
+
+    def sweep_sample_combos(
+            self,
+            methods=None,
+            start_sample_size=None,
+            end_sample_size=None,
+            step_size=1,
+            max_subsets=300,
+            seed=None):
 
-                # Do and save estimation
-                rot, tran = self.solve(
-                    fixed2attached=camera2aruco_subset,
-                    hand2base=hand2base_subset,
-                    solve_method=solve_method
-                )
-                if rot is not None and tran is not None:
-                    poses[sample_size].append(
-                        (rot, tran)
-                    )
-                max_iterations += 1
-                if max_iterations >= 300:
-                    break
-            max_iterations = 0
+        # {method: {sample_size: [(rot, tran), ...]}}, the same subsets for every method
+        if methods is None:
+            methods = self.methods
+        sample_sizes = self.default_sample_sizes(start_sample_size, end_sample_size, step_size)
 
-        return poses
+        return self.get_sweep().collect(methods=methods, sample_sizes=sample_sizes, max_subsets=max_subsets,
+                                        seed=seed)
 
     def solve_all_method_samples(
             self,
@@ -164,6 +182,36 @@ class EyeHandSolver(object):
 
         return poses
 
+    def get_batch_solver(self):
+        # Built on first use, the pair terms cost O(N^2) once
+        if self.batch_solver is None:
+            rot_hand2world, tran_hand2world, rot_camera2charuco, tran_camera2charuco = self.pose_arrays
+            self.batch_solver = HandEyeBatchSolver(
+                hand2world=HandEyeBatchSolver.to_homogeneous(rot_hand2world, tran_hand2world),
+                camera2charuco=HandEyeBatchSolver.to_homogeneous(rot_camera2charuco, tran_camera2charuco)
+            )
+        return self.batch_solver
+
+    def get_sweep(self):
+        # Built on first use, its process pool serves every sweep of these poses
+        if self.sweep is None:
+            self.sweep = HandEyeSweep(*self.pose_arrays, processes=self.processes)
+        return self.sweep
+
+    def close(self):
+        if self.sweep is not None:
+            self.sweep.close()
+            self.sweep = None
+
+    def solve_subsets_batched(self, solve_method, subsets):
+        # [(rot, tran), ...] per subset (rows of pose indices) with the NumPy
+        # Tsai/Park/Andreff solvers, thousands of subsets per call
+        rotations, translations = self.get_batch_solver().solve(solve_method, subsets)
+        return [(rotation, translation.reshape(3, 1)) for rotation, translation in zip(rotations, translations)]
+
     def update_transforms(self, transforms_hand2world, transforms_camera2charuco):
         self.transforms_hand2world = transforms_hand2world
         self.transforms_camera2charuco = transforms_camera2charuco
+        self.pose_arrays = self.to_pose_arrays(transforms_hand2world, transforms_camera2charuco)
+        self.batch_solver = None
+        self.close()
@@ -0,0 +1,181 @@
+import cv2
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+
+# Tsai, Park and Andreff hand-eye solutions for many pose subsets at once, same
+# convention as cv2.calibrateHandEye: hand2world (N,4,4) are gripper -> base,
+# camera2charuco (N,4,4) target -> camera, the result camera -> gripper, and every pose
+# pair (i < j) of a subset is one motion.
+# Every least squares term is a sum over pose pairs, so the per pair terms are computed
+# once for the whole dataset and a subset's normal equations are one row of
+# pair_weights @ terms. Subsets may repeat poses (bootstrap resamples).
+class HandEyeBatchSolver(object):
+
+    def __init__(self, hand2world, camera2charuco):
+        hand2world = np.asarray(hand2world, dtype=np.float64)
+        camera2charuco = np.asarray(camera2charuco, dtype=np.float64)
+        self.number_of_poses = len(hand2world)
+
+        # All pose pairs of the dataset, motion A (gripper) and B (camera) with AX = XB
+        first, second = np.triu_indices(self.number_of_poses, k=1)
+        self.pair_index = np.full((self.number_of_poses, self.number_of_poses), -1)
+        self.pair_index[first, second] = np.arange(len(first))
+        self.number_of_pairs = len(first)
+
+        motion_a = HandEyeBatchSolver.invert(hand2world[second]) @ hand2world[first]
+        motion_b = camera2charuco[second] @ HandEyeBatchSolver.invert(camera2charuco[first])
+        self.rotations_a, self.translations_a = motion_a[:, :3, :3], motion_a[:, :3, 3]
+        self.rotations_b, self.translations_b = motion_b[:, :3, :3], motion_b[:, :3, 3]
+        self.rotvecs_a = Rotation.from_matrix(self.rotations_a).as_rotvec()
+        self.rotvecs_b = Rotation.from_matrix(self.rotations_b).as_rotvec()
+
+        self.translation_terms = self.create_translation_terms()
+        self.solvers = {
+            cv2.CALIB_HAND_EYE_TSAI: self.solve_tsai,
+            cv2.CALIB_HAND_EYE_PARK: self.solve_park,
+            cv2.CALIB_HAND_EYE_ANDREFF: self.solve_andreff
+        }
+
+    @staticmethod
+    def to_homogeneous(rotations, translations):
+        rotations = np.asarray(rotations, dtype=np.float64).reshape(-1, 3, 3)
+        matrices = np.tile(np.eye(4), (len(rotations), 1, 1))
+        matrices[:, :3, :3] = rotations
+        matrices[:, :3, 3] = np.asarray(translations, dtype=np.float64).reshape(-1, 3)
+        return matrices
+
+    @staticmethod
+    def invert(transforms):
+        rotations_transposed = np.swapaxes(transforms[:, :3, :3], 1, 2)
+        inverted = np.tile(np.eye(4), (len(transforms), 1, 1))
+        inverted[:, :3, :3] = rotations_transposed
+        inverted[:, :3, 3] = -np.einsum('nij,nj->ni', rotations_transposed, transforms[:, :3, 3])
+        return inverted
+
+    @staticmethod
+    def skew(vectors):
+        x, y, z = vectors[..., 0], vectors[..., 1], vectors[..., 2]
+        zeros = np.zeros_like(x)
+        return np.stack([
+            np.stack([zeros, -z, y], axis=-1),
+            np.stack([z, zeros, -x], axis=-1),
+            np.stack([-y, x, zeros], axis=-1)
+        ], axis=-2)
+
+    @staticmethod
+    def closest_rotations(matrices):
+        # Nearest rotation (Frobenius) of every 3x3
+        u, _, vt = np.linalg.svd(matrices)
+        signs = np.sign(np.linalg.det(u @ vt))
+        u[:, :, 2] *= signs[:, None]
+        return u @ vt
+
+    def pair_weights(self, subsets):
+        # (S, pairs) number of times every dataset pair is a pair of the subset
+        subsets = np.sort(np.atleast_2d(subsets), axis=1)
+        first, second = np.triu_indices(subsets.shape[1], k=1)
+        pair_ids = self.pair_index[subsets[:, first], subsets[:, second]]
+
+        rows = np.broadcast_to(np.arange(len(subsets))[:, None], pair_ids.shape)
+        valid = pair_ids >= 0  # A pose paired with itself is no motion
+        weights = np.zeros((len(subsets), self.number_of_pairs))
+        np.add.at(weights, (rows[valid], pair_ids[valid]), 1.)
+        return weights
+
+    def create_translation_terms(self):
+        # (Ra - I) t = R tb - ta, normal equations split so that R can vary per subset
+        c = self.rotations_a - np.eye(3)
+        ctc = np.einsum('pki,pkj->pij', c, c)
+        ctr_tb = np.einsum('pki,pl->pikl', c, self.translations_b)  # times R[k, l]
+        ct_ta = np.einsum('pki,pk->pi', c, self.translations_a)
+        return ctc.reshape(-1, 9), ctr_tb.reshape(-1, 27), ct_ta
+
+    def solve_translations(self, weights, rotations):
+        ctc, ctr_tb, ct_ta = self.translation_terms
+        normal = (weights @ ctc).reshape(-1, 3, 3)
+        rhs = np.einsum('sikl,skl->si', (weights @ ctr_tb).reshape(-1, 3, 3, 3), rotations) - weights @ ct_ta
+        return np.einsum('sij,sj->si', np.linalg.pinv(normal), rhs)
+
+    def solve_tsai(self, weights):
+        # Modified Rodrigues vectors 2 sin(theta / 2) axis
+        angles_a = np.linalg.norm(self.rotvecs_a, axis=1, keepdims=True)
+        angles_b = np.linalg.norm(self.rotvecs_b, axis=1, keepdims=True)
+        p_a = 2 * np.sin(angles_a / 2) * np.divide(self.rotvecs_a, angles_a, out=np.zeros_like(self.rotvecs_a),
+                                                   where=angles_a > 0)
+        p_b = 2 * np.sin(angles_b / 2) * np.divide(self.rotvecs_b, angles_b, out=np.zeros_like(self.rotvecs_b),
+                                                   where=angles_b > 0)
+
+        # skew(pa + pb) x = pb - pa
+        s = HandEyeBatchSolver.skew(p_a + p_b)
+        sts = np.einsum('pki,pkj->pij', s, s).reshape(-1, 9)
+        st_rhs = np.einsum('pki,pk->pi', s, p_b - p_a)
+        p_prime = np.einsum('sij,sj->si', np.linalg.pinv((weights @ sts).reshape(-1, 3, 3)), weights @ st_rhs)
+
+        p = 2 * p_prime / np.sqrt(1 + np.sum(p_prime ** 2, axis=1, keepdims=True))
+        norms = np.sum(p ** 2, axis=1)[:, None, None]
+        rotations = ((1 - norms / 2) * np.eye(3)
+                     + 0.5 * (np.einsum('si,sj->sij', p, p) + np.sqrt(4 - norms) * HandEyeBatchSolver.skew(p)))
+        return rotations, self.solve_translations(weights, rotations)
+
+    def solve_park(self, weights):
+        # M = sum beta alpha^T, R = (M^T M)^(-1/2) M^T is the polar factor of M^T
+        outer = np.einsum('pi,pj->pij', self.rotvecs_b, self.rotvecs_a).reshape(-1, 9)
+        m = (weights @ outer).reshape(-1, 3, 3)
+        rotations = HandEyeBatchSolver.closest_rotations(np.swapaxes(m, 1, 2))
+        return rotations, self.solve_translations(weights, rotations)
+
+    def solve_andreff(self, weights):
+        # Linear in [vec(R) (column major), t]:
+        #   (I kron Ra - Rb^T kron I) vec(R) = 0
+        #   -(tb^T kron I) vec(R) + (Ra - I) t = -ta
+        pairs = len(self.rotations_a)
+        identity = np.eye(3)
+        k = np.zeros((pairs, 12, 12))
+        k[:, :9, :9] = (np.einsum('ij,pkl->pikjl', identity, self.rotations_a)
+                        - np.einsum('pji,kl->pikjl', self.rotations_b, identity)).reshape(pairs, 9, 9)
+        k[:, 9:, :9] = -np.einsum('pj,kl->pkjl', self.translations_b, identity).reshape(pairs, 3, 9)
+        k[:, 9:, 9:] = self.rotations_a - identity
+        r = np.zeros((pairs, 12))
+        r[:, 9:] = -self.translations_a
+
+        ktk = np.einsum('pki,pkj->pij', k, k).reshape(pairs, 144)
+        ktr = np.einsum('pki,pk->pi', k, r)
+        solution = np.einsum('sij,sj->si', np.linalg.pinv((weights @ ktk).reshape(-1, 12, 12)), weights @ ktr)
+
+        # Column major vec, orthonormalized, translation solved again for the rotation
+        rotations = HandEyeBatchSolver.closest_rotations(np.swapaxes(solution[:, :9].reshape(-1, 3, 3), 1, 2))
+        return rotations, self.solve_translations(weights, rotations)
+
+    def solve(self, method, subsets=None):
+        # (S,3,3) rotations and (S,3) translations camera -> gripper, one per subset
+        # (every pose when subsets is None)
+        if method not in self.solvers:
+            raise ValueError(f'No batched solver for hand-eye method {method}')
+        if subsets is None:
+            subsets = np.arange(self.number_of_poses)[None]
+
+        return self.solvers[method](self.pair_weights(subsets))
+
+    def compare_to_opencv(self, hand2world, camera2charuco, subsets):
+        # {method: (max rotation difference in degrees, max translation difference)} against
+        # cv2.calibrateHandEye on the same subsets
+        hand2world = np.asarray(hand2world, dtype=np.float64)
+        camera2charuco = np.asarray(camera2charuco, dtype=np.float64)
+        differences = dict()
+        for method in self.solvers:
+            rotations, translations = self.solve(method, subsets)
+            rotation_differences, translation_differences = list(), list()
+            for subset, rotation, translation in zip(np.atleast_2d(subsets), rotations, translations):
+                rotation_cv, translation_cv = cv2.calibrateHandEye(
+                    R_gripper2base=hand2world[subset, :3, :3],
+                    t_gripper2base=hand2world[subset, :3, 3],
+                    R_target2cam=camera2charuco[subset, :3, :3],
+                    t_target2cam=camera2charuco[subset, :3, 3],
+                    method=method
+                )
+                rotation_differences.append(
+                    np.degrees(Rotation.from_matrix(rotation.T @ rotation_cv).magnitude()))
+                translation_differences.append(np.linalg.norm(translation - translation_cv.ravel()))
+            differences[method] = (max(rotation_differences), max(translation_differences))
+        return differences
@@ -0,0 +1,196 @@
+import time
+
+import cv2
+import numpy as np
+from scipy.optimize import least_squares
+from scipy.spatial.transform import Rotation
+
+from camera_calibration.utils.HandEyeBatchSolver import HandEyeBatchSolver
+
+
+# Joint refinement of camera -> gripper (X) and target -> base (Y) by ChArUco corner
+# reprojection over every captured view, same conventions as cv2.calibrateHandEye:
+# hand2world A_i is gripper -> base, so a board corner p is seen at
+#   P = X^-1 A_i^-1 Y p  (camera frame).
+# Corners are undistorted once, the residuals are pinhole pixel errors and the Jacobian
+# is analytic. Rotations are updated as exp(w) R0, translations directly.
+class HandEyeRefiner(object):
+
+    def __init__(self, camera_matrix, dist_coefficients, board_corners):
+        self.camera_matrix = np.asarray(camera_matrix, dtype=np.float64).reshape(3, 3)
+        self.dist_coefficients = np.asarray(dist_coefficients, dtype=np.float64).ravel()
+        self.board_corners = np.asarray(board_corners, dtype=np.float64).reshape(-1, 3)
+        self.focal = self.camera_matrix[[0, 1], [0, 1]]
+        self.center = self.camera_matrix[[0, 1], [2, 2]]
+
+    def stack_observations(self, observations):
+        # observations[i] = (charuco ids, (M,2) corners) of view i or None,
+        # returns view index, board point and undistorted pixel per corner
+        views, points, pixels = list(), list(), list()
+        for view, observation in enumerate(observations):
+            if observation is None:
+                continue
+            ids, corners = observation
+            ids = np.asarray(ids, dtype=int).ravel()
+            views.append(np.full(len(ids), view))
+            points.append(self.board_corners[ids])
+            pixels.append(np.asarray(corners, dtype=np.float64).reshape(-1, 2))
+
+        if len(views) == 0:
+            return None
+
+        pixels = cv2.undistortPoints(np.concatenate(pixels).reshape(-1, 1, 2), self.camera_matrix,
+                                     self.dist_coefficients, P=self.camera_matrix).reshape(-1, 2)
+        return np.concatenate(views), np.concatenate(points), pixels
+
+    @staticmethod
+    def to_matrix(rotation, translation):
+        matrix = np.eye(4)
+        matrix[:3, :3] = rotation
+        matrix[:3, 3] = np.asarray(translation).ravel()
+        return matrix
+
+    @staticmethod
+    def target2base(hand2world, camera2charuco, camera2gripper):
+        # Y from every view A_i X B_i, rotations averaged by projection
+        targets = hand2world @ camera2gripper @ camera2charuco
+        rotation = HandEyeBatchSolver.closest_rotations(targets[:, :3, :3].sum(axis=0)[None])[0]
+        return HandEyeRefiner.to_matrix(rotation, targets[:, :3, 3].mean(axis=0))
+
+    @staticmethod
+    def left_jacobian(rotation_vector):
+        # d exp(w) / dw of SO(3), exp(w + dw) = exp(J dw) exp(w)
+        angle = np.linalg.norm(rotation_vector)
+        skew = HandEyeBatchSolver.skew(rotation_vector)
+        if angle < 1e-8:
+            return np.eye(3) + 0.5 * skew
+        return (np.eye(3) + (1 - np.cos(angle)) / angle ** 2 * skew
+                + (angle - np.sin(angle)) / angle ** 3 * skew @ skew)
+
+    def create_problem(self, hand2world, camera2gripper, target2base, stacked):
+        views, points, pixels = stacked
+        base2hand = HandEyeBatchSolver.invert(hand2world)
+        gripper2camera = HandEyeBatchSolver.invert(camera2gripper[None])[0]
+
+        rotations_base2hand = base2hand[views, :3, :3]
+        translations_base2hand = base2hand[views, :3, 3]
+        rotation_w0, rotation_y0 = gripper2camera[:3, :3], target2base[:3, :3]
+
+        def unpack(parameters):
+            rotation_w = Rotation.from_rotvec(parameters[0:3]).as_matrix() @ rotation_w0
+            rotation_y = Rotation.from_rotvec(parameters[6:9]).as_matrix() @ rotation_y0
+            return rotation_w, parameters[3:6], rotation_y, parameters[9:12]
+
+        def camera_points(parameters):
+            rotation_w, translation_w, rotation_y, translation_y = unpack(parameters)
+            board_in_target = points @ rotation_y.T  # R_y p
+            in_hand = np.einsum('mij,mj->mi', rotations_base2hand, board_in_target + translation_y) \
+                + translations_base2hand
+            hand_in_camera = in_hand @ rotation_w.T  # R_w s
+            return board_in_target, hand_in_camera, hand_in_camera + translation_w
+
+        def residuals(parameters):
+            _, _, camera = camera_points(parameters)
+            return (camera[:, :2] / camera[:, 2:] * self.focal + self.center - pixels).ravel()
+
+        def jacobian(parameters):
+            rotation_w, _, _, _ = unpack(parameters)
+            board_in_target, hand_in_camera, camera = camera_points(parameters)
+            x, y, z = camera[:, 0], camera[:, 1], camera[:, 2]
+            zeros = np.zeros_like(z)
+            projection = np.stack([
+                np.stack([self.focal[0] / z, zeros, -self.focal[0] * x / z ** 2], axis=-1),
+                np.stack([zeros, self.focal[1] / z, -self.focal[1] * y / z ** 2], axis=-1)
+            ], axis=1)  # (M, 2, 3)
+
+            target_to_camera = rotation_w @ rotations_base2hand  # d P / d t_y
+            d_rotation_w = -HandEyeBatchSolver.skew(hand_in_camera) @ HandEyeRefiner.left_jacobian(parameters[0:3])
+            d_rotation_y = target_to_camera @ (-HandEyeBatchSolver.skew(board_in_target)
+                                               @ HandEyeRefiner.left_jacobian(parameters[6:9]))
+            d_camera = np.concatenate([
+                d_rotation_w,
+                np.broadcast_to(np.eye(3), target_to_camera.shape),
+                d_rotation_y,
+                target_to_camera
+            ], axis=2)  # (M, 3, 12)
+            return (projection @ d_camera).reshape(-1, 12)
+
+        initial = np.concatenate([np.zeros(3), gripper2camera[:3, 3], np.zeros(3), target2base[:3, 3]])
+        return initial, unpack, residuals, jacobian
+
+    def reprojection_rms(self, hand2world, camera2gripper, target2base, stacked):
+        initial, _, residuals, _ = self.create_problem(hand2world, camera2gripper, target2base, stacked)
+        errors = residuals(initial).reshape(-1, 2)
+        return float(np.sqrt(np.mean(np.sum(errors ** 2, axis=1))))
+
+    def select_initial(self, hand2world, camera2charuco, candidates, stacked):
+        # Closed form candidate {name: (rotation, translation)} with the lowest reprojection error
+        best = None
+        for name, (rotation, translation) in candidates.items():
+            if rotation is None or translation is None or not np.isfinite(rotation).all() \
+                    or not np.isfinite(translation).all():
+                continue
+            camera2gripper = HandEyeRefiner.to_matrix(rotation, translation)
+            target2base = HandEyeRefiner.target2base(hand2world, camera2charuco, camera2gripper)
+            rms = self.reprojection_rms(hand2world, camera2gripper, target2base, stacked)
+            if best is None or rms < best[1]:
+                best = (name, rms, camera2gripper, target2base)
+        return best
+
+    def refine(self, hand2world, camera2charuco, observations, candidates, loss='huber', f_scale=1.):
+        # hand2world, camera2charuco (N,4,4), observations per view (see stack_observations),
+        # candidates {name: (rotation, translation)} camera -> gripper. None without corners
+        # or without a valid candidate.
+        start_time = time.perf_counter()
+        hand2world = np.asarray(hand2world, dtype=np.float64)
+        camera2charuco = np.asarray(camera2charuco, dtype=np.float64)
+        stacked = self.stack_observations(observations)
+        if stacked is None:
+            return None
+
+        # None when every closed form solve failed
+        best = self.select_initial(hand2world, camera2charuco, candidates, stacked)
+        if best is None:
+            return None
+        initial_name, initial_rms, camera2gripper, target2base = best
+        initial, unpack, residuals, jacobian = self.create_problem(hand2world, camera2gripper, target2base, stacked)
+
+        solution = least_squares(residuals, initial, jac=jacobian, method='trf', loss=loss, f_scale=f_scale,
+                                 x_scale='jac')
+
+        rotation_w, translation_w, rotation_y, translation_y = unpack(solution.x)
+        gripper2camera = HandEyeRefiner.to_matrix(rotation_w, translation_w)
+        refined_camera2gripper = HandEyeBatchSolver.invert(gripper2camera[None])[0]
+
+        errors = np.sqrt(np.sum(residuals(solution.x).reshape(-1, 2) ** 2, axis=1))
+        views = stacked[0]
+        view_rms = [np.sqrt(np.mean(errors[views == view] ** 2)) for view in np.unique(views)]
+
+        # Linearized covariance, propagated from (w_w, t_w) to camera -> gripper, rotation
+        # as a camera frame rotation vector like CalibrationUncertainty
+        jacobian_x = jacobian(solution.x)
+        degrees_of_freedom = max(1, jacobian_x.shape[0] - 12)
+        variance = float(np.sum(residuals(solution.x) ** 2) / degrees_of_freedom)
+        covariance = variance * np.linalg.pinv(jacobian_x.T @ jacobian_x)
+        left_jacobian = HandEyeRefiner.left_jacobian(solution.x[0:3])
+        propagation = np.zeros((6, 6))
+        propagation[:3, :3] = left_jacobian
+        propagation[3:, :3] = -rotation_w.T @ HandEyeBatchSolver.skew(translation_w) @ left_jacobian
+        propagation[3:, 3:] = -rotation_w.T
+        camera_covariance = propagation @ covariance[:6, :6] @ propagation.T
+
+        return {
+            'initial_method': initial_name,
+            'rotation': refined_camera2gripper[:3, :3],
+            'translation': refined_camera2gripper[:3, 3].reshape(3, 1),
+            'target2base': HandEyeRefiner.to_matrix(rotation_y, translation_y),
+            'views': len(view_rms),
+            'corners': int(len(errors)),
+            'initial_rms': initial_rms,
+            'rms': float(np.sqrt(np.mean(errors ** 2))),
+            'max_view_rms': float(np.max(view_rms)),
+            'translation_std': np.sqrt(np.diag(camera_covariance[3:, 3:])).tolist(),
+            'rotation_std_degrees': np.degrees(np.sqrt(np.diag(camera_covariance[:3, :3]))).tolist(),
+            'iterations': int(solution.nfev),
+            'seconds': time.perf_counter() - start_time
+        }
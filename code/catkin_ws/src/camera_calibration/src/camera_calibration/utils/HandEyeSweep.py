@@ -0,0 +1,146 @@
+import multiprocessing
+import os
+from itertools import combinations
+from math import comb
+
+import cv2
+import numpy as np
+
+# Pose arrays of the worker processes, set once by the pool initializer
+_arrays = None
+
+
+def _initialize_worker(arrays):
+    global _arrays
+    _arrays = arrays
+    # One OpenCV thread per process, the pool is the parallelism
+    cv2.setNumThreads(1)
+
+
+def _solve_subset(task):
+    method, sample_size, indices = task
+    rotations_hand2world, translations_hand2world, rotations_camera2charuco, translations_camera2charuco = _arrays
+    indices = list(indices)
+    try:
+        rotation, translation = cv2.calibrateHandEye(
+            R_gripper2base=rotations_hand2world[indices],
+            t_gripper2base=translations_hand2world[indices],
+            R_target2cam=rotations_camera2charuco[indices],
+            t_target2cam=translations_camera2charuco[indices],
+            method=method
+        )
+    except cv2.error:
+        return method, sample_size, indices, None, None
+
+    return method, sample_size, indices, rotation, translation
+
+
+# Random subset sweep of cv2.calibrateHandEye over a process pool. The pose arrays are
+# converted once and shipped to every worker once, the pool is started on the first run
+# and reused by every later run until close. Subsets are drawn uniformly at random
+# (seeded) instead of the first lexicographic combinations, results come back in task
+# order so a seeded sweep is reproducible.
+class HandEyeSweep(object):
+
+    def __init__(self, rotations_hand2world, translations_hand2world, rotations_camera2charuco,
+                 translations_camera2charuco, processes=None):
+        self.arrays = (
+            np.asarray(rotations_hand2world, dtype=np.float64).reshape(-1, 3, 3),
+            np.asarray(translations_hand2world, dtype=np.float64).reshape(-1, 3, 1),
+            np.asarray(rotations_camera2charuco, dtype=np.float64).reshape(-1, 3, 3),
+            np.asarray(translations_camera2charuco, dtype=np.float64).reshape(-1, 3, 1)
+        )
+        self.number_of_poses = len(self.arrays[0])
+        self.processes = processes if processes is not None else os.cpu_count()
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def get_pool(self):
+        # Spawned workers, forking a node with live ROS threads is not safe
+        if self.pool is None:
+            context = multiprocessing.get_context('spawn')
+            self.pool = context.Pool(processes=self.processes, initializer=_initialize_worker,
+                                     initargs=(self.arrays,))
+        return self.pool
+
+    def sample_subsets(self, rng, sample_size, max_subsets):
+        # Every combination when there are at most max_subsets of them, otherwise
+        # max_subsets distinct uniformly drawn ones
+        if comb(self.number_of_poses, sample_size) <= max_subsets:
+            return list(combinations(range(self.number_of_poses), sample_size))
+
+        subsets = set()
+        attempts = 0
+        while len(subsets) < max_subsets and attempts < 10 * max_subsets:
+            indices = rng.choice(self.number_of_poses, size=sample_size, replace=False)
+            subsets.add(tuple(sorted(indices.tolist())))
+            attempts += 1
+        return sorted(subsets)
+
+    def create_tasks(self, methods, sample_sizes, max_subsets, seed=None):
+        rng = np.random.default_rng(seed)
+        tasks = list()
+        for sample_size in sample_sizes:
+            subsets = self.sample_subsets(rng, sample_size, max_subsets)
+            for method in methods:
+                tasks += [(method, sample_size, indices) for indices in subsets]
+        return tasks
+
+    def sweep(self, methods, sample_sizes, max_subsets=300, seed=None):
+        # Yields (method, sample_size, indices, rotation, translation) in task order,
+        # rotation and translation are None when OpenCV failed on the subset
+        tasks = self.create_tasks(methods, sample_sizes, max_subsets, seed)
+        for result in self.run(tasks):
+            yield result
+
+    def solve_subsets(self, method, subsets):
+        # (S,3,3) rotations and (S,3) translations in subset order, NaN where OpenCV failed.
+        # Subsets may repeat poses (bootstrap resamples)
+        subsets = np.atleast_2d(subsets)
+        rotations = np.full((len(subsets), 3, 3), np.nan)
+        translations = np.full((len(subsets), 3), np.nan)
+        tasks = [(method, len(indices), tuple(indices.tolist())) for indices in subsets]
+        for index, (_, _, _, rotation, translation) in enumerate(self.run(tasks)):
+            if rotation is not None:
+                rotations[index], translations[index] = rotation, translation.ravel()
+        return rotations, translations
+
+    def run(self, tasks):
+        if len(tasks) == 0:
+            return
+
+        if self.processes is None or self.processes <= 1:
+            _initialize_worker(self.arrays)
+            for task in tasks:
+                yield _solve_subset(task)
+            return
+
+        chunk_size = max(1, len(tasks) // (self.processes * 8))
+        for result in self.get_pool().imap(_solve_subset, tasks, chunksize=chunk_size):
+            yield result
+
+    def collect(self, methods, sample_sizes, max_subsets=300, seed=None):
+        # {method: {sample_size: [(rotation, translation), ...]}}, failed subsets left out
+        poses = {method: {sample_size: list() for sample_size in sample_sizes} for method in methods}
+        failed = 0
+        for method, sample_size, _, rotation, translation in self.sweep(methods, sample_sizes, max_subsets, seed):
+            if rotation is None:
+                failed += 1
+                continue
+            poses[method][sample_size].append((rotation, translation))
+
+        if failed > 0:
+            print(f'{failed} subsets could not be solved')
+        return poses
@@ -1,5 +1,6 @@
 import json
 
+import numpy as np
 import rospkg
 from camera_calibration.params.calibration import config_path, extrinsic_calibration_results_path
 from datetime import datetime
@@ -82,6 +83,38 @@ class JSONHelper(object):
         hand2world_data = JSONHelper.read_json(path + '/hand2world')
         return JSONHelper.load_transform_list(camera2target_data), JSONHelper.load_transform_list(hand2world_data)
 
+    @staticmethod
+    def load_charuco_observations(load_data_directory, eye_in_hand):
+        # Corners of every captured view, None for data saved without them
+        if eye_in_hand:
+            path = extrinsic_calibration_results_path + 'eye_in_hand/' + load_data_directory
+        else:
+            path = extrinsic_calibration_results_path + 'eye_to_hand/' + load_data_directory
+
+        if not os.path.exists(path + '/charuco_corners.json'):
+            return None
+
+        observations = []
+        for view in JSONHelper.read_json(path + '/charuco_corners'):
+            if view is None:
+                observations.append(None)
+            else:
+                observations.append((np.array(view['ids'], dtype=int), np.array(view['corners'], dtype=np.float64)))
+        return observations
+
+    @staticmethod
+    def save_charuco_observations(observations, path):
+        data = []
+        for observation in observations:
+            if observation is None:
+                data.append(None)
+            else:
+                ids, corners = observation
+                data.append({'ids': np.asarray(ids).ravel().tolist(),
+                             'corners': np.asarray(corners).reshape(-1, 2).tolist()})
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
     @staticmethod
     def load_live_estimate_data(load_data_directory, eye_in_hand):
         if eye_in_hand:
@@ -94,7 +127,8 @@ class JSONHelper(object):
         return JSONHelper.load_transform_list(live_estimate_data)
 
     @staticmethod
-    def save_extrinsic_data(eye_in_hand, camera2target, hand2world, estimates, directory_name):
+    def save_extrinsic_data(eye_in_hand, camera2target, hand2world, estimates, directory_name, covariances=None,
+                            charuco_observations=None, refinement=None):
         time = str(datetime.now())
         if eye_in_hand:
             path = extrinsic_calibration_results_path + 'eye_in_hand/' + directory_name
@@ -108,6 +142,15 @@ class JSONHelper(object):
         JSONHelper.save_transform_list(camera2target, path + '/camera2target.json')
         JSONHelper.save_transform_list(hand2world, path + '/hand2world.json')
         JSONHelper.save_estimates(estimates, path + '/estimates.json')
+        if covariances is not None:
+            with open(path + '/covariances.json', 'w') as f:
+                json.dump(covariances, f)
+        if charuco_observations is not None:
+            JSONHelper.save_charuco_observations(charuco_observations, path + '/charuco_corners.json')
+        if refinement is not None:
+            with open(path + '/refinement.json', 'w') as f:
+                json.dump({key: value.tolist() if hasattr(value, 'tolist') else value
+                           for key, value in refinement.items()}, f)
 
     @staticmethod
     def save_live_estimate_result(eye_in_hand, estimate, data_points, directory_name):
@@ -193,7 +236,7 @@ class JSONHelper(object):
 
     @staticmethod
     def save_estimates(estimates, path):
-        methods = ['TSAI', 'PARK', 'HORAUD', 'ANDREFF', 'DANIILIDIS', 'MEAN']
+        methods = ['TSAI', 'PARK', 'HORAUD', 'ANDREFF', 'DANIILIDIS', 'MEAN', 'REFINED']
         estimates_json = {}
         for (method, entry) in zip(methods, estimates):
             estimates_json[method] = JSONHelper.create_json_from_estimate(entry)
@@ -216,7 +259,7 @@ class JSONHelper(object):
         return board_name, camera_name, camera_topic
 
     @staticmethod
-    def export_hsv(export_dict, save_dict_name):
+    def export_hsv(export_dict, save_dict_name, color_names=None):
         time = str(datetime.now())
         path = os.path.join(rospkg.RosPack().get_path('object_finder'), f'hsv_exports/{save_dict_name}')
         if not os.path.exists(path):
@@ -239,6 +282,9 @@ class JSONHelper(object):
                               'value_margin': color[5],
                               'noise': color[6],
                               'fill': color[7]}
+                # Colors are captured in color_names order on every camera
+                if color_names is not None and i < len(color_names):
+                    cube_color['name'] = color_names[i]
                 camera_dict[i] = cube_color
             json_export[key] = camera_dict
 
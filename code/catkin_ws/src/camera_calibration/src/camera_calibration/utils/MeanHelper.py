@@ -8,12 +8,14 @@ import cv2
 
 # TF
 import tf.transformations as tf
+from camera_calibration.utils.Profiler import Profiler
 from camera_calibration.utils.TypeConverter import TypeConverter
 
 
 class MeanHelper:
 
     @staticmethod
+    @Profiler.profile('riemannian_mean')
     def riemannian_mean(transformations, clean_translation=True, clean_rotation=True):
         translations = list()
         rotations = list()
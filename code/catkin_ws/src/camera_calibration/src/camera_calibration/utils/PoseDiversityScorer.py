@@ -0,0 +1,119 @@
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+
+# Conditioning of the hand-eye problem from the captured gripper rotations. Every pose pair
+# is a motion with rotation R_ij; the rotation step sees it through its rotation vector
+# (information a a^T) and the translation step through (R_ij - I)^T (R_ij - I), so the
+# smallest eigenvalues of the two sums tell how well the worst direction is observed
+# (near parallel rotation axes or small angles keep them at zero).
+# A new pose adds N pairs, so scoring or adding it is O(N).
+class PoseDiversityScorer(object):
+
+    def __init__(self, epsilon=1e-6):
+        self.epsilon = epsilon
+        self.rotations = np.zeros((0, 3, 3))
+        self.rotation_information = np.zeros((3, 3))
+        self.translation_information = np.zeros((3, 3))
+
+    @staticmethod
+    def pair_terms(rotation, rotations):
+        # (n,3,3) rotation and translation information of the motions between rotation and rotations
+        relative = np.swapaxes(rotations, 1, 2) @ rotation
+        rotation_vectors = Rotation.from_matrix(relative).as_rotvec() if len(relative) > 0 else np.zeros((0, 3))
+        c = relative - np.eye(3)
+        return (np.einsum('ni,nj->nij', rotation_vectors, rotation_vectors),
+                np.einsum('nki,nkj->nij', c, c))
+
+    def score(self, rotation_information=None, translation_information=None, poses=None):
+        if rotation_information is None:
+            rotation_information, translation_information = self.rotation_information, self.translation_information
+        if poses is None:
+            poses = len(self.rotations)
+        pairs = max(1, poses * (poses - 1) // 2)
+
+        rotation_eigenvalues = np.linalg.eigvalsh(rotation_information)
+        translation_eigenvalues = np.linalg.eigvalsh(translation_information)
+        return {
+            'poses': poses,
+            # 0 with all rotation axes parallel, 1 with axes evenly spread
+            'rotation_spread': float(rotation_eigenvalues[0] / max(rotation_eigenvalues[-1], self.epsilon)),
+            # RMS motion angle about the worst observed axis
+            'worst_axis_degrees': float(np.degrees(np.sqrt(max(rotation_eigenvalues[0], 0.) / pairs))),
+            'translation_conditioning': float(translation_eigenvalues[0] / pairs),
+            'log_det': float(PoseDiversityScorer.log_det(rotation_information, translation_information, self.epsilon))
+        }
+
+    @staticmethod
+    def log_det(rotation_information, translation_information, epsilon):
+        # Greedy objective, D-optimal on both least squares steps, works on stacks
+        identity = epsilon * np.eye(3)
+        return (np.linalg.slogdet(rotation_information + identity)[1]
+                + np.linalg.slogdet(translation_information + identity)[1])
+
+    def evaluate(self, rotation):
+        # Score with the pose added, nothing is stored
+        rotation_terms, translation_terms = self.pair_terms(rotation, self.rotations)
+        return self.score(self.rotation_information + rotation_terms.sum(axis=0),
+                          self.translation_information + translation_terms.sum(axis=0),
+                          poses=len(self.rotations) + 1)
+
+    def add(self, rotation):
+        rotation_terms, translation_terms = self.pair_terms(rotation, self.rotations)
+        self.rotation_information += rotation_terms.sum(axis=0)
+        self.translation_information += translation_terms.sum(axis=0)
+        self.rotations = np.concatenate([self.rotations, np.asarray(rotation)[None]])
+        return self.score()
+
+    def remove_last(self):
+        if len(self.rotations) == 0:
+            return self.score()
+        self.rotations, rotation = self.rotations[:-1], self.rotations[-1]
+        rotation_terms, translation_terms = self.pair_terms(rotation, self.rotations)
+        self.rotation_information -= rotation_terms.sum(axis=0)
+        self.translation_information -= translation_terms.sum(axis=0)
+        return self.score()
+
+    def reset(self, rotations=()):
+        self.rotations = np.zeros((0, 3, 3))
+        self.rotation_information = np.zeros((3, 3))
+        self.translation_information = np.zeros((3, 3))
+        for rotation in rotations:
+            self.add(rotation)
+        return self.score()
+
+    @staticmethod
+    def select(rotations, count, epsilon=1e-6):
+        # Greedy subset of count pose indices maximizing log_det, O(n) work per pick:
+        # the information every candidate would add to the picked set is kept up to date
+        rotations = np.asarray(rotations, dtype=np.float64).reshape(-1, 3, 3)
+        count = min(count, len(rotations))
+        if count == 0:
+            return []
+
+        candidate_rotation_information = np.zeros((len(rotations), 3, 3))
+        candidate_translation_information = np.zeros((len(rotations), 3, 3))
+        rotation_information, translation_information = np.zeros((3, 3)), np.zeros((3, 3))
+        available = np.ones(len(rotations), dtype=bool)
+
+        # Start from the pose farthest from the mean orientation
+        mean_rotation = Rotation.from_matrix(rotations).mean()
+        selected = [int(np.argmax((mean_rotation.inv() * Rotation.from_matrix(rotations)).magnitude()))]
+
+        while True:
+            picked = selected[-1]
+            available[picked] = False
+            rotation_information += candidate_rotation_information[picked]
+            translation_information += candidate_translation_information[picked]
+            if len(selected) == count:
+                return selected
+
+            rotation_terms, translation_terms = PoseDiversityScorer.pair_terms(rotations[picked], rotations)
+            candidate_rotation_information += rotation_terms
+            candidate_translation_information += translation_terms
+
+            objective = PoseDiversityScorer.log_det(rotation_information + candidate_rotation_information,
+                                                    translation_information + candidate_translation_information,
+                                                    epsilon)
+            objective[~available] = -np.inf
+            selected.append(int(np.argmax(objective)))
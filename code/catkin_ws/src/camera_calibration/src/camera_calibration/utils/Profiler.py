@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from functools import wraps
+
+import numpy as np
+
+
+# Process wide stage timing. Stages are timed with @Profiler.profile('stage') or
+# `with Profiler.stage('stage'):`, the last window durations per stage are kept for
+# p50/p95/p99 and, when tracing, every span is kept for a Chrome trace (chrome://tracing,
+# ui.perfetto.dev). Disabled (the default) a profiled call costs one flag check.
+# The nodes' PipelineStats keep their always on stage timings here as well (see add).
+class Profiler:
+    enabled = False
+    tracing = False
+    window = 1000
+
+    lock = threading.Lock()
+    durations = defaultdict(lambda: deque(maxlen=Profiler.window))
+    trace_events = deque(maxlen=200000)
+    start_time = time.perf_counter()
+
+    @staticmethod
+    def configure(enabled=True, window=1000, tracing=False, trace_size=200000):
+        with Profiler.lock:
+            Profiler.window = window
+            Profiler.durations.clear()
+            Profiler.trace_events = deque(maxlen=trace_size)
+            Profiler.tracing = tracing
+            Profiler.enabled = enabled
+
+    @staticmethod
+    def setup(parameters, node_name):
+        # "profiling": {"enabled": true, "window": 1000, "publish_period": 5, "trace_file": "/tmp/trace.json"}
+        # from a node config, nothing happens without it
+        if parameters is None or not parameters.get('enabled', False):
+            return
+
+        trace_file = parameters.get('trace_file')
+        Profiler.configure(window=parameters.get('window', 1000), tracing=trace_file is not None)
+
+        import rospy
+        publish_period = parameters.get('publish_period', 5.)
+        if publish_period > 0:
+            Profiler.start_publishing(node_name=node_name, period=publish_period)
+        if trace_file is not None:
+            rospy.on_shutdown(lambda: Profiler.dump_chrome_trace(trace_file))
+        print(f'Profiling {node_name}, trace: {trace_file}')
+
+    @staticmethod
+    def profile(stage=None):
+        # Decorator, stage defaults to the qualified function name
+        def decorator(function):
+            name = stage if stage is not None else function.__qualname__
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not Profiler.enabled:
+                    return function(*args, **kwargs)
+
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    Profiler.record(name, start, time.perf_counter())
+
+            return wrapper
+
+        return decorator
+
+    @staticmethod
+    def stage(name):
+        # Context manager, a shared no op when disabled
+        if not Profiler.enabled:
+            return Profiler.DISABLED
+        return Profiler.Span(name)
+
+    class Span:
+        __slots__ = ('name', 'start')
+
+        def __init__(self, name):
+            self.name = name
+            self.start = None
+
+        def __enter__(self):
+            self.start = time.perf_counter()
+            return self
+
+        def __exit__(self, *exc_info):
+            Profiler.record(self.name, self.start, time.perf_counter())
+            return False
+
+    DISABLED = nullcontext()
+
+    @staticmethod
+    def add(name, seconds, end=None):
+        # Duration measured by the caller, kept even when disabled (PipelineStats). With end
+        # (perf_counter when it finished) it is also a span of the trace
+        with Profiler.lock:
+            Profiler.durations[name].append(seconds)
+            if Profiler.tracing and end is not None:
+                Profiler.trace_events.append((name, end - seconds, end, threading.get_ident()))
+
+    @staticmethod
+    def record(name, start, end):
+        with Profiler.lock:
+            Profiler.durations[name].append(end - start)
+            if Profiler.tracing:
+                Profiler.trace_events.append((name, start, end, threading.get_ident()))
+
+    @staticmethod
+    def percentiles():
+        # {stage: (count, p50 ms, p95 ms, p99 ms)} over the last window calls of every stage
+        with Profiler.lock:
+            durations = {name: np.array(values) for name, values in Profiler.durations.items() if len(values) > 0}
+
+        return {
+            name: (len(values), *(float(value) * 1000 for value in np.percentile(values, (50, 95, 99))))
+            for name, values in durations.items()
+        }
+
+    @staticmethod
+    def report():
+        return '\n'.join(f'{name:<32} n {count:5d}  p50 {p50:8.3f}  p95 {p95:8.3f}  p99 {p99:8.3f} ms'
+                         for name, (count, p50, p95, p99) in sorted(Profiler.percentiles().items()))
+
+    @staticmethod
+    def start_publishing(node_name, period=5.):
+        # Percentiles on /diagnostics every period seconds, one status per stage
+        import rospy
+        from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+
+        publisher = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size=1)
+
+        def publish(event):
+            diagnostics = DiagnosticArray()
+            diagnostics.header.stamp = rospy.Time.now()
+            for name, (count, p50, p95, p99) in sorted(Profiler.percentiles().items()):
+                diagnostics.status.append(DiagnosticStatus(
+                    level=DiagnosticStatus.OK,
+                    name=f'{node_name}: {name}',
+                    hardware_id=node_name,
+                    message=f'p95 {p95:.2f} ms',
+                    values=[KeyValue(key='count', value=str(count)),
+                            KeyValue(key='p50_ms', value=f'{p50:.3f}'),
+                            KeyValue(key='p95_ms', value=f'{p95:.3f}'),
+                            KeyValue(key='p99_ms', value=f'{p99:.3f}')]
+                ))
+            publisher.publish(diagnostics)
+
+        return rospy.Timer(rospy.Duration(period), publish)
+
+    @staticmethod
+    def dump_chrome_trace(path):
+        # Complete ('X') events in microseconds, one row per thread
+        with Profiler.lock:
+            events = list(Profiler.trace_events)
+
+        process_id = os.getpid()
+        trace = {
+            'traceEvents': [
+                {
+                    'name': name,
+                    'ph': 'X',
+                    'ts': (start - Profiler.start_time) * 1e6,
+                    'dur': (end - start) * 1e6,
+                    'pid': process_id,
+                    'tid': thread_id
+                }
+                for name, start, end, thread_id in events
+            ],
+            'displayTimeUnit': 'ms'
+        }
+        with open(path, 'w') as trace_file:
+            json.dump(trace, trace_file)
+        print(f'Wrote {len(events)} trace events to {path}')
@@ -7,6 +7,12 @@ __all__ = [
     "TypeConverter",
     "DaVinci",
     "EyeHandSolver",
+    "CalibrationUncertainty",
+    "HandEyeBatchSolver",
+    "HandEyeRefiner",
+    "HandEyeSweep",
+    "PoseDiversityScorer",
     "SaveMe",
-    "JSONHelper"
+    "JSONHelper",
+    "Profiler"
 ]
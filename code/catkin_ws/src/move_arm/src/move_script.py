@@ -2,6 +2,7 @@
 # Python 2/3 compatibility imports
 from __future__ import print_function
 
+import math
 import time
 
 from six.moves import input
@@ -39,7 +40,7 @@ class MoveArmActionServer(object):
         self.place_point_translation = [goal.place_pose.position.x, goal.place_pose.position.y,
                                         goal.place_pose.position.z]
 
-        rotation = [1.0, 0., 0., 0.]
+        rotation = self.grasp_rotation(goal.pickup_pose.orientation)
         # rotation_90 = [0.7071, 0.7071, 0., 0.]
         # translation = [0.3, -0.2, 0.005]
         # translation_goal = [0.3, 0.2, 0.005]
@@ -65,6 +66,22 @@ class MoveArmActionServer(object):
         self.action_server.set_succeeded(self.result)
 
 
+    @staticmethod
+    def grasp_rotation(cube_orientation, symmetry=math.pi / 2):
+        # Gripper pointing down ([1, 0, 0, 0]) turned around z by the yaw of the cube edge.
+        # The yaw is wrapped to +-45 degrees since a cube looks the same every 90 degrees.
+        # An unset orientation (all zeros) keeps the gripper at yaw 0.
+        x, y, z, w = cube_orientation.x, cube_orientation.y, cube_orientation.z, cube_orientation.w
+        norm = math.sqrt(x * x + y * y + z * z + w * w)
+        if norm == 0:
+            return [1.0, 0., 0., 0.]
+
+        x, y, z, w = x / norm, y / norm, z / norm, w / norm
+        edge_yaw = math.atan2(2 * (x * y + z * w), 1 - 2 * (y * y + z * z))
+        yaw = (edge_yaw + symmetry / 2) % symmetry - symmetry / 2
+
+        return [math.cos(yaw / 2), math.sin(yaw / 2), 0., 0.]
+
     def create_pose(self, translation, rotation):
         # Create a Pose object
         pose = Pose()
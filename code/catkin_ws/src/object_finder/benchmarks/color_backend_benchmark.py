@@ -0,0 +1,106 @@
+#! /usr/bin/env python3.8
+# HSV boxes vs KMeansColorModel: time per frame and IoU against known cube masks.
+# Synthetic frames, shaded cubes on a noisy gradient table, colors picked by "clicking"
+# the first frame like in the UI. Run from anywhere: python3 color_backend_benchmark.py
+import os
+import sys
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from utils.ColorObjectFinder import ColorObjectFinder
+from utils.ColorSampler import ColorSampler
+from utils.HSVMaskEngine import HSVMaskEngine
+from utils.KMeansColorModel import KMeansColorModel
+
+RESOLUTIONS = [(480, 640), (720, 1280)]
+REPEATS = 50
+FRAMES = 10
+ROI_SIZE = 9
+
+CUBE_COLORS = [(40, 40, 200), (40, 170, 40), (200, 80, 30), (30, 200, 220), (160, 40, 160)]  # BGR
+
+
+def create_frame(shape, rng, cube_size):
+    # Frame and label image, label k = CUBE_COLORS[k - 1]
+    height, width = shape
+    gradient = np.linspace(90, 160, width, dtype=np.float32)[None, :, None]
+    image = np.broadcast_to(gradient, (height, width, 3)).copy()
+    label_image = np.zeros(shape, dtype=np.uint8)
+    centers = []
+
+    for label, color in enumerate(CUBE_COLORS, start=1):
+        for _ in range(2):
+            x = int(rng.integers(0, width - cube_size))
+            y = int(rng.integers(0, height - cube_size))
+            shading = np.linspace(0.7, 1.1, cube_size, dtype=np.float32)[:, None, None]
+            image[y:y + cube_size, x:x + cube_size] = np.array(color, dtype=np.float32) * shading
+            label_image[y:y + cube_size, x:x + cube_size] = label
+            centers.append((label, x + cube_size // 2, y + cube_size // 2))
+
+    image *= rng.uniform(0.85, 1.15)
+    image += rng.normal(0, 6, image.shape)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+
+    # Later cubes cover earlier ones, keep click points that are still on their own cube
+    centers = [(label, x, y) for label, x, y in centers if label_image[y, x] == label]
+
+    return image, label_image, centers
+
+
+def pick_states(image, centers):
+    # One click per color, no fill or noise so the classifiers are compared directly
+    states = []
+    for label in range(1, len(CUBE_COLORS) + 1):
+        x, y = next((x, y) for center_label, x, y in centers if center_label == label)
+        states.append(list(ColorSampler.get_colors(image, [(x, y)], ROI_SIZE)[0]) + [0, 0])
+    return states
+
+
+def mean_iou(label_image, expected):
+    ious = []
+    for label in range(1, len(CUBE_COLORS) + 1):
+        predicted = label_image == label
+        actual = expected == label
+        ious.append(np.count_nonzero(predicted & actual) / max(np.count_nonzero(predicted | actual), 1))
+    return float(np.mean(ious))
+
+
+def time_per_frame(function, *args):
+    function(*args)
+    start = perf_counter()
+    for _ in range(REPEATS):
+        function(*args)
+    return (perf_counter() - start) / REPEATS * 1000
+
+
+if __name__ == '__main__':
+    print(f'{len(CUBE_COLORS)} colors, {FRAMES} frames, {REPEATS} repeats, OpenCV {cv2.__version__}')
+    for shape in RESOLUTIONS:
+        rng = np.random.default_rng(0)
+        frames = [create_frame(shape, rng, cube_size=shape[0] // 8) for _ in range(FRAMES)]
+        first_image, _, first_centers = frames[0]
+        states = pick_states(first_image, first_centers)
+
+        hsv_finder = ColorObjectFinder()
+        kmeans_model = KMeansColorModel()
+        kmeans_finder = ColorObjectFinder(color_model=kmeans_model)
+
+        fit_ms = time_per_frame(kmeans_model.fit, first_image)
+        kmeans_model.fit(first_image)
+
+        hsv_iou = np.mean([mean_iou(hsv_finder.get_label_image(image, states), expected)
+                           for image, expected, _ in frames])
+        kmeans_iou = np.mean([mean_iou(kmeans_finder.get_label_image(image, states), expected)
+                              for image, expected, _ in frames])
+
+        lookup_tables = HSVMaskEngine.build_lookup_tables(states)
+        hsv_ms = time_per_frame(HSVMaskEngine.get_color_masks, first_image, states, lookup_tables)
+        kmeans_ms = time_per_frame(kmeans_model.get_color_masks, first_image, states)
+
+        print(f'{shape[1]}x{shape[0]}: hsv boxes {hsv_ms:.2f} ms IoU {hsv_iou:.3f}, '
+              f'k-means {kmeans_ms:.2f} ms ({hsv_ms / kmeans_ms:.2f}x) IoU {kmeans_iou:.3f}, '
+              f'k-means fit {fit_ms:.1f} ms once')
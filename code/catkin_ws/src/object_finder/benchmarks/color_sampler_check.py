@@ -0,0 +1,73 @@
+#! /usr/bin/env python3.8
+# ColorSampler against the pandas / scipy color picker it replaced, on random ROIs.
+# The reference is the old remove_outliers + wrapped_hue, except that the saturation
+# margin is the plain max - min range (the old code wrapped it with the 179 hue span).
+# Needs pandas and scipy. Run from anywhere: python3 color_sampler_check.py
+import os
+import sys
+
+import cv2
+import numpy as np
+import pandas as pd
+from scipy.stats import circmean, circvar
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from utils.ColorSampler import ColorSampler
+
+ROIS = 300
+ROI_SIZE = 9
+IMAGE_SIZE = 60
+
+
+def reference_color(image, x, y, roi_size):
+    y_lower = max(y - roi_size, 0)
+    y_upper = min(image.shape[0], y + roi_size)
+    x_lower = max(x - roi_size, 0)
+    x_upper = min(image.shape[1], x + roi_size)
+    hsv_roi = cv2.cvtColor(image[y_lower: y_upper, x_lower: x_upper], cv2.COLOR_BGR2HSV)
+
+    hue, saturation, value = cv2.split(hsv_roi)
+    df = pd.DataFrame({'hue': hue.flatten(), 'saturation': saturation.flatten(),
+                       'value': value.flatten()}).astype(np.int64)
+    q1 = df.quantile(0.25)
+    q3 = df.quantile(0.75)
+    iqr = q3 - q1
+    subset = df[~((df < (q1 - 1.5 * iqr)) | (df > (q3 + 1.5 * iqr)))].dropna()
+    if len(subset) == 0:
+        subset = df
+
+    means = subset.mean()
+    diff_saturation = subset['saturation'].max() - subset['saturation'].min()
+    diff_value = subset['value'].max() - subset['value'].min()
+
+    hue_list = list(hue.flatten())
+    hue_avg = circmean(hue_list, high=179, low=0)
+    hue_diff = circvar(hue_list, high=179, low=0) * 179
+
+    return (round(hue_avg), round(means['saturation']), round(means['value']), round(hue_diff),
+            round(diff_saturation), round(diff_value))
+
+
+def random_image(rng, index):
+    # Alternate uniform noise (wide ranges) and a noisy single color (narrow ranges)
+    if index % 2:
+        return rng.integers(0, 256, (IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.uint8)
+    color = rng.uniform(0, 255, 3)
+    return np.clip(rng.normal(color, rng.uniform(1, 60), (IMAGE_SIZE, IMAGE_SIZE, 3)), 0, 255).astype(np.uint8)
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    mismatches = 0
+    for index in range(ROIS):
+        image = random_image(rng, index)
+        x, y = (int(value) for value in rng.integers(0, IMAGE_SIZE, 2))
+        expected = reference_color(image, x, y, ROI_SIZE)
+        actual = ColorSampler.get_colors(image, [(x, y)], ROI_SIZE)[0]
+        if actual != expected:
+            mismatches += 1
+            print(f'ROI {index} at ({x}, {y}): reference {expected}, ColorSampler {actual}')
+
+    print(f'{ROIS - mismatches}/{ROIS} ROIs match the pandas reference')
+    sys.exit(1 if mismatches > 0 else 0)
@@ -0,0 +1,71 @@
+#! /usr/bin/env python3.8
+# cv_bridge vs ImageMessageAdapter: time per frame to get a bgr8 color and a 16UC1 depth
+# image out of a sensor_msgs/Image, plus the old depth display path (GRAY2BGR).
+# Needs a ROS environment (sensor_msgs, cv_bridge). Run: python3 image_conversion_benchmark.py
+import os
+import sys
+from time import perf_counter
+
+import cv2
+import numpy as np
+from cv_bridge import CvBridge
+from sensor_msgs.msg import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from utils.ImageMessageAdapter import ImageMessageAdapter
+
+RESOLUTIONS = [(720, 1280), (1080, 1920)]
+REPEATS = 200
+
+
+def create_message(array, encoding):
+    message = Image()
+    message.height, message.width = array.shape[:2]
+    message.encoding = encoding
+    message.is_bigendian = 0
+    message.step = array.strides[0]
+    message.data = array.tobytes()  # rospy delivers uint8[] as bytes
+    return message
+
+
+def time_per_frame(convert, message):
+    convert(message)
+    start = perf_counter()
+    for _ in range(REPEATS):
+        convert(message)
+    return (perf_counter() - start) / REPEATS * 1000
+
+
+def main():
+    rng = np.random.default_rng(0)
+    cv_bridge = CvBridge()
+
+    for height, width in RESOLUTIONS:
+        color_message = create_message(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), 'bgr8')
+        depth_message = create_message(rng.integers(0, 4000, (height, width), dtype=np.uint16), '16UC1')
+
+        assert np.array_equal(ImageMessageAdapter.to_bgr8(color_message),
+                              cv_bridge.imgmsg_to_cv2(color_message, desired_encoding="bgr8"))
+        assert np.array_equal(ImageMessageAdapter.to_depth(depth_message),
+                              cv_bridge.imgmsg_to_cv2(depth_message, desired_encoding="passthrough"))
+
+        results = {
+            'color cv_bridge': time_per_frame(
+                lambda message: cv_bridge.imgmsg_to_cv2(message, desired_encoding="bgr8"), color_message),
+            'color adapter': time_per_frame(ImageMessageAdapter.to_bgr8, color_message),
+            'depth cv_bridge': time_per_frame(
+                lambda message: cv_bridge.imgmsg_to_cv2(message, desired_encoding="passthrough"), depth_message),
+            'depth adapter': time_per_frame(ImageMessageAdapter.to_depth, depth_message),
+            'depth cv_bridge + GRAY2BGR': time_per_frame(
+                lambda message: cv2.cvtColor(cv_bridge.imgmsg_to_cv2(message, desired_encoding="passthrough"),
+                                             cv2.COLOR_GRAY2BGR), depth_message),
+        }
+
+        print(f'{width}x{height}')
+        for name, milliseconds in results.items():
+            print(f'  {name:<28} {milliseconds:8.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
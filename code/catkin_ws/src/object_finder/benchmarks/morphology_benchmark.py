@@ -0,0 +1,76 @@
+#! /usr/bin/env python3.8
+# Time per frame of the fill/noise stage, the former per color morphologyEx (3 close
+# iterations, then 3 open iterations) vs MaskMorphology.
+# Run from anywhere: python3 morphology_benchmark.py
+import os
+import sys
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from utils.MaskMorphology import MaskMorphology
+from utils.Const import Const
+
+RESOLUTIONS = [(480, 640), (720, 1280)]
+REPEATS = 50
+
+# 10 cube colors, noise 5 / fill 10 like the default export, two with other settings
+STATES = [[0, 0, 0, 0, 0, 0, 5, 10] for _ in range(8)] + [[0, 0, 0, 0, 0, 0, 3, 6], [0, 0, 0, 0, 0, 0, 5, 0]]
+
+
+def create_masks(shape, count, seed=0):
+    rng = np.random.default_rng(seed)
+    masks = []
+    for _ in range(count):
+        noise = (rng.random(shape) > 0.97).astype(np.uint8) * 255
+        for _ in range(6):
+            x, y = rng.integers(0, shape[1] - 80), rng.integers(0, shape[0] - 80)
+            cv2.rectangle(noise, (x, y), (x + 60, y + 60), 255, -1)
+        masks.append(noise)
+    return masks
+
+
+def fill_holes(mask, kernel_size, iterations=3):
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+    return cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=iterations)
+
+
+def remove_noise(mask, kernel_size, iterations=3):
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+    return cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=iterations)
+
+
+def current_implementation(masks, states):
+    cleaned = []
+    for mask, state in zip(masks, states):
+        if state[Const.FILL] > 0:
+            mask = fill_holes(mask, state[Const.FILL])
+        if state[Const.NOISE] > 0:
+            mask = remove_noise(mask, state[Const.NOISE])
+        cleaned.append(mask)
+    return cleaned
+
+
+def time_per_frame(function, *args):
+    function(*args)
+    start = perf_counter()
+    for _ in range(REPEATS):
+        function(*args)
+    return (perf_counter() - start) / REPEATS * 1000
+
+
+if __name__ == '__main__':
+    print(f'{len(STATES)} colors, {REPEATS} repeats, OpenCV {cv2.__version__}, {cv2.getNumThreads()} threads')
+    for shape in RESOLUTIONS:
+        masks = create_masks(shape, len(STATES))
+
+        expected = current_implementation(masks, STATES)
+        identical = all(np.array_equal(a, b) for a, b in zip(expected, MaskMorphology.clean_masks(masks, STATES)))
+
+        current_ms = time_per_frame(current_implementation, masks, STATES)
+        fused_ms = time_per_frame(MaskMorphology.clean_masks, masks, STATES)
+        print(f'{shape[1]}x{shape[0]}: morphologyEx {current_ms:.2f} ms, '
+              f'fused {fused_ms:.2f} ms ({current_ms / fused_ms:.2f}x), identical: {identical}')
@@ -0,0 +1,149 @@
+#! /usr/bin/env python3.8
+import os
+import time
+
+import rospkg
+import rospy
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from camera_calibration.utils.JSONHelper import JSONHelper
+from camera_calibration.utils.Profiler import Profiler
+
+from utils.ColorLookupTable import ColorLookupTable
+from utils.CubeFuser import CubeFuser
+from utils.CubeTracker import CubeTracker
+from utils.PipelineStats import PipelineStats
+from utils.TransformCache import TransformCache
+
+import geometry_msgs.msg as gm
+from my_robot_msgs.msg import DetectedCube, DetectedCubeArray
+
+
+# Camera frame detections of every camera (detected_cubes) -> one world frame cube list (fused_cubes).
+# The camera poses come from TF (calibrated extrinsics, the wrist camera through the arm) at the
+# stamp of each frame. The fused cubes are tracked, fused_cubes holds the confirmed tracks with
+# their ids, smoothed positions, confidence and age.
+class CubeFusion:
+
+    def __init__(self, world_frame='world', merge_distance=0.03, max_age=0.5, noise_scales=None, tf_timeout=0.1,
+                 stats_interval=5., tracker_parameters=None, static_frames=()):
+        self.world_frame = world_frame
+        self.fuser = CubeFuser(merge_distance=merge_distance, max_age=max_age, noise_scales=noise_scales)
+        self.tracker = CubeTracker(**(tracker_parameters if tracker_parameters is not None else dict()))
+
+        self.stats = PipelineStats()
+        self.stats_interval = stats_interval
+        self.last_report = time.perf_counter()
+
+        # Static cameras are looked up once, the wrist camera at every frame stamp
+        self.transform_cache = TransformCache(timeout=tf_timeout, static_frames=static_frames, stats=self.stats)
+
+        self.fused_publisher = rospy.Publisher('fused_cubes', DetectedCubeArray, queue_size=1)
+        self.detection_subscriber = rospy.Subscriber('detected_cubes', DetectedCubeArray,
+                                                     callback=self.detection_callback, queue_size=10)
+
+    @Profiler.profile('detection_callback')
+    def detection_callback(self, cube_array):
+        world_to_camera = self.transform_cache.lookup_matrix(self.world_frame, cube_array.header.frame_id,
+                                                             stamp=cube_array.header.stamp)
+        if world_to_camera is None:
+            return
+
+        start_time = time.perf_counter()
+        rotation_matrix = world_to_camera[:3, :3]
+        camera_rotation = Rotation.from_matrix(rotation_matrix)
+
+        cubes = cube_array.cubes
+        labels = [cube.label for cube in cubes]
+        positions = np.array([[cube.position.x, cube.position.y, cube.position.z] for cube in cubes]).reshape(-1, 3)
+        covariances = np.array([cube.covariance for cube in cubes]).reshape(-1, 3, 3)
+        orientations = np.array([[cube.orientation.x, cube.orientation.y, cube.orientation.z, cube.orientation.w]
+                                 for cube in cubes]).reshape(-1, 4)
+
+        # Camera -> world, covariances rotate as R C R^T
+        positions = positions @ rotation_matrix.T + world_to_camera[:3, 3]
+        covariances = rotation_matrix @ covariances @ rotation_matrix.T
+        if len(orientations) > 0:
+            orientations = (camera_rotation * Rotation.from_quat(orientations)).as_quat()
+
+        fused_labels, fused_positions, fused_covariances, fused_orientations, _ = self.fuser.update(
+            camera=cube_array.camera,
+            stamp=cube_array.header.stamp.to_sec(),
+            labels=labels,
+            positions=positions,
+            covariances=covariances,
+            orientations=orientations
+        )
+        self.tracker.update(
+            stamp=cube_array.header.stamp.to_sec(),
+            labels=fused_labels,
+            positions=fused_positions,
+            covariances=fused_covariances,
+            orientations=fused_orientations
+        )
+        tracks = self.tracker.get_tracks()
+
+        fused_array = DetectedCubeArray()
+        fused_array.header.stamp = cube_array.header.stamp
+        fused_array.header.frame_id = self.world_frame
+        fused_array.camera = 'fused'
+        for index, track_id in enumerate(tracks['ids']):
+            cube = DetectedCube()
+            cube.id = int(track_id)
+            cube.label = int(tracks['labels'][index])
+            cube.position = gm.Point(*tracks['positions'][index])
+            cube.orientation = gm.Quaternion(*tracks['orientations'][index])
+            cube.covariance = tracks['covariances'][index].ravel().tolist()
+            cube.confidence = tracks['confidences'][index]
+            cube.age = tracks['ages'][index]
+            fused_array.cubes.append(cube)
+        self.fused_publisher.publish(fused_array)
+
+        done_time = time.perf_counter()
+        self.stats.add(f'fuse/{cube_array.camera}', done_time - start_time, end=done_time)
+        self.stats.set_counter('fused_cubes', len(fused_labels))
+        self.stats.set_counter('tracked_cubes', len(tracks['ids']))
+        if self.stats_interval > 0 and done_time - self.last_report >= self.stats_interval:
+            print(self.stats.report())
+            self.last_report = done_time
+
+
+if __name__ == '__main__':
+    rospy.init_node('cube_fusion')
+
+    path = os.path.join(rospkg.RosPack().get_path('object_finder'), 'config/')
+    config_file_name = rospy.get_param(param_name='cube_fusion/config')
+
+    parameters = JSONHelper.read_json(path + config_file_name)
+    Profiler.setup(parameters.get('profiling'), node_name='cube_fusion')
+
+    # Detections are merged by label, which has to be the same color on every camera
+    lookup_table_export = parameters.get('lookup_table_export')
+    if lookup_table_export is not None:
+        try:
+            ColorLookupTable.check_shared_labels(
+                hsv_file=os.path.join(rospkg.RosPack().get_path('object_finder'),
+                                      f'hsv_exports/{lookup_table_export}/hsv'),
+                topics=parameters['camera_topics'],
+                color_names=parameters.get('color_names'))
+        except ValueError as e:
+            print(f'Not fusing cubes: {e}')
+            raise SystemExit(1)
+
+    cube_fusion = CubeFusion(
+        world_frame=parameters.get('world_frame', 'world'),
+        merge_distance=parameters.get('fusion_merge_distance', 0.03),
+        max_age=parameters.get('fusion_max_age', 0.5),
+        noise_scales=parameters.get('camera_noise_scales'),
+        tf_timeout=parameters.get('fusion_tf_timeout', 0.1),
+        stats_interval=parameters.get('stats_interval', 5.),
+        tracker_parameters=CubeTracker.parameters_from_config(parameters),
+        static_frames=parameters.get('static_frames', [])
+    )
+
+    try:
+        rospy.spin()
+
+    except KeyboardInterrupt:
+        print('Shutting down.')
@@ -0,0 +1,36 @@
+#! /usr/bin/env python3.8
+import os
+
+import rospkg
+import rospy
+
+from camera_calibration.utils.JSONHelper import JSONHelper
+
+from utils.HSVFitter import HSVFitter
+
+# Offline: fits the cube colors to labelled frames and exports a ready to use hsv.json
+
+if __name__ == '__main__':
+    rospy.init_node('hsv_color_fitter')
+
+    package_path = rospkg.RosPack().get_path('object_finder')
+    config_file_name = rospy.get_param(param_name='hsv_color_fitter/config')
+
+    parameters = JSONHelper.read_json(os.path.join(package_path, 'config/', config_file_name))
+    frames_directory = os.path.join(package_path, parameters['frames_directory'])
+
+    print(f'Fitting colors to {frames_directory}...')
+    fitted_colors = HSVFitter.fit_colors(
+        frames_directory=frames_directory,
+        roi_size=parameters['roi_size'],
+        noise_candidates=parameters['noise_candidates'],
+        fill_candidates=parameters['fill_candidates'],
+        processes=parameters['processes']
+    )
+
+    for color, (state, iou) in fitted_colors.items():
+        print(f'color [{color}]: {state}, IoU {iou:.3f}')
+
+    export_values = {parameters['camera_slot']: [state for state, _ in fitted_colors.values()]}
+    JSONHelper.export_hsv(export_values, parameters['save_dict_name'])
+    print(f'Exported to hsv_exports/{parameters["save_dict_name"]}')
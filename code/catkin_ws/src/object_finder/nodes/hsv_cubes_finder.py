@@ -1,5 +1,7 @@
 #! /usr/bin/env python3.8
+import copy
 import os
+import time
 
 import rospkg
 import rospy
@@ -11,17 +13,25 @@ from camera_calibration.params.calibration import calibration_path_d455, calibra
 from camera_calibration.utils.TypeConverter import TypeConverter
 from camera_calibration.utils.TFPublish import TFPublish
 from camera_calibration.utils.JSONHelper import JSONHelper
+from camera_calibration.utils.Profiler import Profiler
 
 from utils.DaVinci import DaVinci
 from utils.ColorObjectFinder import ColorObjectFinder
-
-from cv_bridge import CvBridge, CvBridgeError
+from utils.IncrementalSegmenter import IncrementalSegmenter
+from utils.PipelineStats import PipelineStats
+from utils.DebugImagePublisher import DebugImagePublisher
+from utils.TransformCache import TransformCache
+from utils.ImageMessageAdapter import ImageMessageAdapter
 
 from sensor_msgs.msg import Image
 
 import tf2_ros
 import actionlib
+from actionlib_msgs.msg import GoalStatus
 from my_robot_msgs.msg import MoveArmAction, MoveArmGoal, MoveArmResult, MoveArmFeedback
+from my_robot_msgs.srv import CollectCube, CollectCubeResponse
+from std_srvs.srv import Trigger, TriggerResponse
+import message_filters
 
 import matplotlib.pyplot as plt
 import matplotlib.colors as col
@@ -38,32 +48,51 @@ import pandas as pd
 
 class ObjectFinder:
 
-    def __init__(self, pose_estimate, camera_topic, intrinsic_matrix=None):
+    def __init__(self, pose_estimate, camera_topic, intrinsic_matrix=None, full_frame_interval=0, tracking_padding=20,
+                 sync_slop=0.02, sync_queue_size=10, stats_interval=5., headless=False, debug_image_rate=0.,
+                 debug_image_scale=0.25, tf_timeout=1.):
         # print(pose_estimate)
         self.pose_estimate = pose_estimate
         self.intrinsic_matrix = intrinsic_matrix
         self.cof = ColorObjectFinder()
-        self.cv_bridge = CvBridge()
         self.depth_image = None
 
         self.camera_name = camera_topic
 
+        # Headless: no window, no drawing, commands only through the services below
+        self.headless = headless
+
         # todo get camera pose in world frame
         self.window = 'ColorDetection'
         self.gui_created = False
         self.start_state = self.cof.get_state()
         self.current_image = None
 
-        self.camera_subscriber = rospy.Subscriber(
-            camera_topic + '/color/image_raw',
-            Image, self.camera_color_callback)
+        # Tracking mode, full frame every full_frame_interval frames, 0 = always full frame
+        self.incremental_segmenter = None
+        if full_frame_interval > 0:
+            self.incremental_segmenter = IncrementalSegmenter(full_frame_interval=full_frame_interval,
+                                                              padding=tracking_padding)
+
+        self.stats = PipelineStats()
+        self.stats_interval = stats_interval
+        self.last_report = time.perf_counter()
+
         if self.pose_estimate:
+            # Color and depth paired by stamp, the position always uses the depth of the segmented frame
             print('estimating pose')
-            self.aligned_depth_subscriber = rospy.Subscriber(camera_topic + '/aligned_depth_to_color/image_raw', Image,
-                                                             self.camera_depth_aligned_callback)
+            self.camera_subscriber = message_filters.Subscriber(camera_topic + '/color/image_raw', Image)
+            self.aligned_depth_subscriber = message_filters.Subscriber(
+                camera_topic + '/aligned_depth_to_color/image_raw', Image)
+            self.synchronizer = message_filters.ApproximateTimeSynchronizer(
+                [self.camera_subscriber, self.aligned_depth_subscriber], queue_size=sync_queue_size, slop=sync_slop)
+            self.synchronizer.registerCallback(self.camera_synchronized_callback)
+        else:
+            self.camera_subscriber = rospy.Subscriber(
+                camera_topic + '/color/image_raw',
+                Image, self.camera_color_only_callback)
 
-        self.tf_buffer = tf2_ros.Buffer()
-        self.listener = tf2_ros.TransformListener(self.tf_buffer)
+        self.transform_cache = TransformCache(timeout=tf_timeout, stats=self.stats)
 
         self.center_x = None
         self.center_y = None
@@ -87,6 +116,22 @@ class ObjectFinder:
 
         self.cube_poses = {1: None, 2: None, 3: None, 4: None}
         self.total_height = 0
+        # Remaining (pick, place) moves of a running stack, None when no stack is running
+        self.stack_moves = None
+
+        self.debug_image_publisher = DebugImagePublisher(
+            topic_name='~debug_image', rate=debug_image_rate, scale=debug_image_scale)
+
+        # Same commands as the keys, e.g. rosservice call /object_detection/collect 2
+        self.services = [
+            rospy.Service('~collect', CollectCube, self.collect_service),
+            rospy.Service('~pick', Trigger,
+                          lambda request: self.trigger_response(self.set_pickup_pose(), 'pickup pose')),
+            rospy.Service('~place', Trigger,
+                          lambda request: self.trigger_response(self.set_place_pose(), 'place pose')),
+            rospy.Service('~move', Trigger, lambda request: self.trigger_response(self.move_cube(), 'move')),
+            rospy.Service('~stack', Trigger, lambda request: self.trigger_response(self.stack_cubes(), 'stack'))
+        ]
 
     def create_layout(self):
         cv2.namedWindow(self.window)
@@ -148,30 +193,56 @@ class ObjectFinder:
                 roi_size=self.roi_size
             )
             self.update_trackbars()
+            if self.incremental_segmenter is not None:
+                self.incremental_segmenter.request_full_frame()
+
+    def camera_synchronized_callback(self, input_image, aligned_depth):
+        # One color/depth pair, mask and position from the same moment
+        self.stats.add('pair_skew', abs((input_image.header.stamp - aligned_depth.header.stamp).to_sec()))
+        self.stats.add('pair_age', (rospy.Time.now() - max(input_image.header.stamp, aligned_depth.header.stamp)).to_sec())
+
+        with self.stats.stage('color'):
+            self.camera_color_callback(input_image)
+        with self.stats.stage('depth'):
+            self.camera_depth_aligned_callback(aligned_depth)
+        self.report_stats()
+
+    def camera_color_only_callback(self, input_image):
+        # Without pose estimation there is no depth to pair
+        with self.stats.stage('color'):
+            self.camera_color_callback(input_image)
+        self.report_stats()
+
+    def report_stats(self):
+        now = time.perf_counter()
+        if self.stats_interval > 0 and now - self.last_report >= self.stats_interval:
+            print(self.stats.report())
+            self.last_report = now
 
     def camera_depth_aligned_callback(self, aligned_depth):
         # print(aligned_depth)
         aligned_input_depth = None
         try:
-            aligned_input_depth = self.cv_bridge.imgmsg_to_cv2(
-                aligned_depth, desired_encoding="passthrough")
+            aligned_input_depth = ImageMessageAdapter.to_depth(aligned_depth)
 
-        except CvBridgeError as e:
+        except ValueError as e:
             print(e)
-        self.depth_image = cv2.cvtColor(aligned_input_depth, cv2.COLOR_GRAY2BGR)
+        if not self.headless:
+            self.depth_image = aligned_input_depth
 
         # print(aligned_input_depth[a])
         # Find 3D point
         # cv2.imshow('test', aligned_input_depth)
         if self.center_x is not None and aligned_input_depth is not None and self.center_y is not None:
-            depth_array = np.array(aligned_input_depth, dtype=np.float32)
-            # print(depth_array.shape)
-            if self.center_x <= depth_array.shape[1] and self.center_y <= depth_array.shape[0]:
-                # print(self.center_x, depth_array.shape[1])
-                depth = depth_array[self.center_y][self.center_x] / 1000
-
-                # todo find depth of coordinate (x,y)
-                position = self.cof.pixel_to_3d_coordinate((self.center_x, self.center_y), depth, self.intrinsic_matrix)
+            # Median of a depth patch around the center, NaN when there is no depth
+            position = self.cof.deproject_pixels(
+                depth_image=aligned_input_depth,
+                pixels=[(self.center_x, self.center_y)],
+                camera_matrix=self.intrinsic_matrix
+            )[0]
+
+            if not np.isnan(position).any():
+                position = tuple(position)
                 # print(position)
                 pose_info = f"x{position[0]:.2f} : y{position[1]:.2f}, z{position[2]:.2f}"
 
@@ -187,8 +258,8 @@ class ObjectFinder:
         # Normalize the depth values to a range suitable for color mapping
         normalized_depth = cv2.normalize(self.depth_image, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
 
-        # Apply a color map to the normalized depth image
-        self.depth_image = cv2.applyColorMap(normalized_depth, cv2.COLORMAP_JET)
+        # Apply a color map to the normalized depth image, single channel in, BGR out
+        return cv2.applyColorMap(normalized_depth, cv2.COLORMAP_JET)
 
     def broadcast_point(self):
         # transform = TypeConverter.vectors_to_stamped_transform(translation=[self.x, self.y, self.z],
@@ -206,38 +277,46 @@ class ObjectFinder:
 
     def camera_color_callback(self, input_image):
         try:
-            self.current_image = self.cv_bridge.imgmsg_to_cv2(input_image, desired_encoding="bgr8")
+            self.current_image = ImageMessageAdapter.to_bgr8(input_image)
 
-        except CvBridgeError as e:
+        except ValueError as e:
             print(e)
+            return
 
-        if not self.gui_created:
-            self.create_layout()
-            self.gui_created = True
-        # image = self.current_image
+        # Mask
+        if self.incremental_segmenter is not None:
+            label_image, _ = self.incremental_segmenter.segment(image=self.current_image,
+                                                                get_label_image=self.cof.get_label_image)
+            mask_image = cv2.compare(label_image, 0, cv2.CMP_GT)
+        else:
+            mask_image = self.cof.get_hsv_mask(image=self.current_image)
 
-        hsv_image = cv2.cvtColor(self.current_image, cv2.COLOR_BGR2HSV)
+        # Find center
+        self.center_x, self.center_y = self.cof.find_mask_center(mask_image)
 
-        hues = hsv_image[:, :, :1]
+        if self.debug_image_publisher.is_due():
+            self.debug_image_publisher.publish(
+                image=self.current_image,
+                mask=mask_image,
+                points=[(self.center_x, self.center_y)] if self.center_x is not None else []
+            )
 
-        saturations = hsv_image[:, :, 1:2]
-        values = hsv_image[:, :, 2:]
+        if not self.headless:
+            self.update_gui(mask_image)
 
-        # Mask
-        mask_image = self.cof.get_hsv_mask(image=self.current_image)
-        output = cv2.connectedComponentsWithStats(mask_image)
+    def update_gui(self, mask_image):
+        if not self.gui_created:
+            self.create_layout()
+            self.gui_created = True
 
         res = cv2.bitwise_and(self.current_image, self.current_image, mask=mask_image)
-        mask = cv2.cvtColor(mask_image, cv2.COLOR_GRAY2BGR)
 
-        # Find center
-        self.center_x, self.center_y = self.cof.find_mask_center(mask_image)
-        if self.depth_image is not None:
-            self.colorize_depth_image()
+        depth_display_image = self.colorize_depth_image() if self.depth_image is not None else None
         pose_info = ""
         if self.center_x is not None:
             self.cof.draw_dot(res, self.center_x, self.center_y)
-            self.cof.draw_dot(self.depth_image, self.center_x, self.center_y)
+            if depth_display_image is not None:
+                self.cof.draw_dot(depth_display_image, self.center_x, self.center_y)
         display_image = self.current_image.copy()
         if self.hovered_x is not None:
             display_image = DaVinci.draw_roi_rectangle(image=display_image,
@@ -278,8 +357,10 @@ class ObjectFinder:
 
         cv2.imshow(self.window, cv2.resize(stacked, None, fx=self.scale, fy=self.scale))
         # cv2.imshow(self.window, stacked)
-        # cv2.imshow('test', self.depth_image)
-        # Input
+        # cv2.imshow('test', depth_display_image)
+        self.read_input()
+
+    def read_input(self):
         key = cv2.waitKey(1) & 0xFF
         key_str = chr(key)
 
@@ -289,48 +370,19 @@ class ObjectFinder:
             # self.update_trackbars()
             # print(f"Switching to state {key_number}")
 
-            self.get_world_cube_transform(key_number)
-
-        # elif key == ord('m'):
-        #     world_to_cube = None
-        #     while world_to_cube is None:
-        #         try:
-        #             world_to_cube = self.tf_buffer.lookup_transform('world', 'cube', rospy.Time())
-        #         except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
-        #             print(f"No transform found between 'world' and 'cube'.")
-        #     self.call_move_arm(world_to_cube)
+            self.collect_cube(key_number)
 
         elif key == ord('u'):  # Pick up pose
-            self.world_to_cube_pickup = None
-            print('Waiting for transform world to cube...')
-            while self.world_to_cube_pickup is None:
-                try:
-                    self.world_to_cube_pickup = self.tf_buffer.lookup_transform('world', 'cube', rospy.Time())
-                except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
-                    pass
-            print(self.world_to_cube_pickup)
+            self.set_pickup_pose()
 
         elif key == ord('d'):  # Place pose
-            self.world_to_cube_place = None
-            print('Waiting for transform world to cube...')
-            while self.world_to_cube_place is None:
-                try:
-                    self.world_to_cube_place = self.tf_buffer.lookup_transform('world', 'cube', rospy.Time())
-                except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
-                    pass
-            print(self.world_to_cube_place)
+            self.set_place_pose()
 
         elif key == ord('m'):
-            if self.world_to_cube_pickup is not None:
-                self.call_move_arm(self.world_to_cube_pickup, self.world_to_cube_place)
+            self.move_cube()
 
         elif key == ord('s'):
-            print(self.cube_poses)
-            for key in self.cube_poses.keys():
-                if key == 1:
-                    continue
-                self.call_move_arm(self.cube_poses[key], self.cube_poses[1])
-                self.cube_poses[1].transform.translation.z += self.cube_poses[key].transform.translation.z
+            self.stack_cubes()
 
         elif key == ord('q'):
             rospy.signal_shutdown('Bye :)')
@@ -345,6 +397,11 @@ class ObjectFinder:
             self.roi_size += 2
         elif key == ord('t'):
             # shape: (y, x, z)
+            hsv_image = cv2.cvtColor(self.current_image, cv2.COLOR_BGR2HSV)
+
+            hues = hsv_image[:, :, :1]
+            saturations = hsv_image[:, :, 1:2]
+            values = hsv_image[:, :, 2:]
 
             x_list = []
             y_list = []
@@ -366,6 +423,85 @@ class ObjectFinder:
             df_v.hist('val', ax=axes[2], bins=255)
             plt.show()
 
+    # ----------------------------------------- Commands, keys and services
+
+    def lookup_world_cube(self):
+        # None when world -> cube is not available within tf_timeout
+        print('Waiting for transform world to cube...')
+        return self.transform_cache.lookup('world', 'cube')
+
+    def collect_cube(self, slot):
+        cube_transform = self.lookup_world_cube()
+        if cube_transform is None:
+            return False
+
+        print(cube_transform)
+        print(slot)
+        self.cube_poses[slot] = cube_transform
+        return True
+
+    def set_pickup_pose(self):
+        self.world_to_cube_pickup = self.lookup_world_cube()
+        print(self.world_to_cube_pickup)
+        return self.world_to_cube_pickup is not None
+
+    def set_place_pose(self):
+        self.world_to_cube_place = self.lookup_world_cube()
+        print(self.world_to_cube_place)
+        return self.world_to_cube_place is not None
+
+    def move_cube(self):
+        if self.world_to_cube_pickup is None:
+            return False
+
+        self.call_move_arm(self.world_to_cube_pickup, self.world_to_cube_place)
+        return True
+
+    def stack_cubes(self):
+        # Every collected cube on top of cube 1. The moves are chained from the action's done
+        # callback, neither the image callback (key) nor the service thread waits for the arm
+        print(self.cube_poses)
+        base_pose = self.cube_poses.get(1)
+        if base_pose is None or self.stack_moves is not None:
+            return False
+
+        place_pose = copy.deepcopy(base_pose)
+        stack_moves = list()
+        for slot, cube_pose in self.cube_poses.items():
+            if slot == 1 or cube_pose is None:
+                continue
+            stack_moves.append((cube_pose, copy.deepcopy(place_pose)))
+            place_pose.transform.translation.z += cube_pose.transform.translation.z
+
+        self.stack_moves = stack_moves
+        self.send_stack_move()
+        return True
+
+    def send_stack_move(self):
+        if len(self.stack_moves) == 0:
+            print('Stack done')
+            self.stack_moves = None
+            return
+
+        pick_pose, place_pose = self.stack_moves.pop(0)
+        self.call_move_arm(pick_pose, place_pose, done_callback=self.stack_move_done)
+
+    def stack_move_done(self, state, result):
+        if state != GoalStatus.SUCCEEDED:
+            print(f'Stack move ended with state {state}, stopping the stack')
+            self.stack_moves = None
+            return
+        self.send_stack_move()
+
+    def collect_service(self, request):
+        success = self.collect_cube(request.slot)
+        return CollectCubeResponse(success=success,
+                                   message=f"cube [{request.slot}] {'collected' if success else 'not found'}")
+
+    @staticmethod
+    def trigger_response(success, command):
+        return TriggerResponse(success=success, message=f"{command} {'done' if success else 'failed'}")
+
     def plot_3d(self, dataframe):
         import matplotlib.cm as cm
         fig = plt.figure()
@@ -381,7 +517,7 @@ class ObjectFinder:
 
         plt.show()
 
-    def call_move_arm(self, pick_pose, place_pose):
+    def call_move_arm(self, pick_pose, place_pose, done_callback=None):
         pick_pose_translation = pick_pose.transform.translation
         pick_translation = [pick_pose_translation.x, pick_pose_translation.y, pick_pose_translation.z]
         random_y = np.random.uniform(-0.3, 0.4)
@@ -404,7 +540,7 @@ class ObjectFinder:
             move_arm_goal.place_pose.position.y = place_translation[1]
             move_arm_goal.place_pose.position.z = place_translation[2] + pick_translation[2] + 0.04
 
-        self.action_client.send_goal(move_arm_goal, feedback_cb=self.feedback_callback)
+        self.action_client.send_goal(move_arm_goal, done_cb=done_callback, feedback_cb=self.feedback_callback)
         #
         # self.action_client.wait_for_result()
         # print(self.action_client.get_state())
@@ -412,18 +548,6 @@ class ObjectFinder:
     def feedback_callback(self, m):
         print(m)
 
-    def get_world_cube_transform(self, key):
-        current_cube_transform = None
-        print('Waiting for transform world to cube...')
-        while current_cube_transform is None:
-            try:
-                current_cube_transform = self.tf_buffer.lookup_transform('world', 'cube', rospy.Time())
-            except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
-                pass
-        print(current_cube_transform)
-        print(key)
-        self.cube_poses[key] = current_cube_transform
-
 
 def load_intrinsics(topics, intrinsic_names):
     print("ArUcoFinder launched with internal parameters:")
@@ -447,6 +571,7 @@ if __name__ == '__main__':
     config_file_path = path + config_file_name
 
     parameters = JSONHelper.read_json(config_file_path)
+    Profiler.setup(parameters.get('profiling'), node_name='object_detection')
     find_pose = parameters['find_pose']
     topics = parameters['camera_topic']
     intrinsic_names = parameters['camera_intrinsics']
@@ -457,7 +582,16 @@ if __name__ == '__main__':
 
     # todo make sure topics ans intrinsics are aligned
     object_finder = ObjectFinder(
-        pose_estimate=find_pose, camera_topic=topics[0], intrinsic_matrix=intrinsics[topics[0]]
+        pose_estimate=find_pose, camera_topic=topics[0], intrinsic_matrix=intrinsics[topics[0]],
+        full_frame_interval=parameters.get('tracking_full_frame_interval', 0),
+        tracking_padding=parameters.get('tracking_padding', 20),
+        sync_slop=parameters.get('sync_slop', 0.02),
+        sync_queue_size=parameters.get('sync_queue_size', 10),
+        stats_interval=parameters.get('stats_interval', 5.),
+        headless=parameters.get('headless', False),
+        debug_image_rate=parameters.get('debug_image_rate', 0.),
+        debug_image_scale=parameters.get('debug_image_scale', 0.25),
+        tf_timeout=parameters.get('tf_timeout', 1.)
     )
 
     # Update Freq
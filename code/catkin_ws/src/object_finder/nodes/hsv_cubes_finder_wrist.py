@@ -8,11 +8,12 @@ from camera_calibration.params.calibration import calibration_path_d455, calibra
 from camera_calibration.utils.TypeConverter import TypeConverter
 from camera_calibration.utils.TFPublish import TFPublish
 from camera_calibration.utils.JSONHelper import JSONHelper
+from camera_calibration.utils.Profiler import Profiler
 
 from utils.DaVinci import DaVinci
 from utils.ColorObjectFinder import ColorObjectFinder
-
-from cv_bridge import CvBridge, CvBridgeError
+from utils.TransformCache import TransformCache
+from utils.ImageMessageAdapter import ImageMessageAdapter
 
 from sensor_msgs.msg import Image
 
@@ -31,12 +32,11 @@ from my_robot_msgs.msg import MoveArmAction, MoveArmGoal, MoveArmResult, MoveArm
 
 class ObjectFinder:
 
-    def __init__(self, pose_estimate, camera_topic, intrinsic_matrix=None):
+    def __init__(self, pose_estimate, camera_topic, intrinsic_matrix=None, tf_timeout=1.):
         print(pose_estimate)
         self.pose_estimate = pose_estimate
         self.intrinsic_matrix = intrinsic_matrix
         self.cof = ColorObjectFinder()
-        self.cv_bridge = CvBridge()
 
         # todo get camera pose in world frame
         self.window = 'ColorDetection'
@@ -52,8 +52,7 @@ class ObjectFinder:
             self.aligned_depth_subscriber = rospy.Subscriber('/camera/aligned_depth_to_color/image_raw', Image,
                                                              self.camera_depth_aligned_callback)
 
-        self.tf_buffer = tf2_ros.Buffer()
-        self.listener = tf2_ros.TransformListener(self.tf_buffer)
+        self.transform_cache = TransformCache(timeout=tf_timeout)
 
         self.center_x = None
         self.center_y = None
@@ -145,25 +144,25 @@ class ObjectFinder:
         # print(aligned_depth)
         aligned_input_depth = None
         try:
-            aligned_input_depth = self.cv_bridge.imgmsg_to_cv2(
-                aligned_depth, desired_encoding="passthrough")
+            aligned_input_depth = ImageMessageAdapter.to_depth(aligned_depth)
 
-        except CvBridgeError as e:
+        except ValueError as e:
             print(e)
-        self.depth_image = cv2.cvtColor(aligned_input_depth, cv2.COLOR_GRAY2BGR)
+        self.depth_image = aligned_input_depth
 
         # print(aligned_input_depth[a])
         # Find 3D point
         # cv2.imshow('test', aligned_input_depth)
         if self.center_x is not None and aligned_input_depth is not None:
-            depth_array = np.array(aligned_input_depth, dtype=np.float32)
-            # print(depth_array.shape)
-            if self.center_x <= depth_array.shape[1] and self.center_y <= depth_array.shape[0]:
-                # print(self.center_x, depth_array.shape[1])
-                depth = depth_array[self.center_y][self.center_x] / 1000
-
-                # todo find depth of coordinate (x,y)
-                position = self.cof.pixel_to_3d_coordinate((self.center_x, self.center_y), depth, self.intrinsic_matrix)
+            # Median of a depth patch around the center, NaN when there is no depth
+            position = self.cof.deproject_pixels(
+                depth_image=aligned_input_depth,
+                pixels=[(self.center_x, self.center_y)],
+                camera_matrix=self.intrinsic_matrix
+            )[0]
+
+            if not np.isnan(position).any():
+                position = tuple(position)
                 # print(position)
                 pose_info = f"x{position[0]:.2f} : y{position[1]:.2f}, z{position[2]:.2f}"
 
@@ -179,8 +178,8 @@ class ObjectFinder:
         # Normalize the depth values to a range suitable for color mapping
         normalized_depth = cv2.normalize(self.depth_image, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
 
-        # Apply a color map to the normalized depth image
-        self.depth_image = cv2.applyColorMap(normalized_depth, cv2.COLORMAP_JET)
+        # Apply a color map to the normalized depth image, single channel in, BGR out
+        return cv2.applyColorMap(normalized_depth, cv2.COLORMAP_JET)
 
     def broadcast_point(self):
         # transform = TypeConverter.vectors_to_stamped_transform(translation=[self.x, self.y, self.z],
@@ -196,12 +195,14 @@ class ObjectFinder:
                                            rotation=[0., 0., 0., 1.],
                                            translation=self.position)
 
+    @Profiler.profile('camera_color_callback')
     def camera_color_callback(self, input_image):
         try:
-            self.current_image = self.cv_bridge.imgmsg_to_cv2(input_image, desired_encoding="bgr8")
+            self.current_image = ImageMessageAdapter.to_bgr8(input_image)
 
-        except CvBridgeError as e:
+        except ValueError as e:
             print(e)
+            return
 
         if not self.gui_created:
             self.create_layout()
@@ -215,20 +216,23 @@ class ObjectFinder:
 
         # Find center
         self.center_x, self.center_y = self.cof.find_mask_center(mask_image)
-        self.colorize_depth_image()
+        depth_display_image = self.colorize_depth_image() if self.depth_image is not None else None
         pose_info = ""
         if self.center_x is not None:
             self.cof.draw_dot(res, self.center_x, self.center_y)
-            self.cof.draw_dot(self.depth_image, self.center_x, self.center_y)
+            if depth_display_image is not None:
+                self.cof.draw_dot(depth_display_image, self.center_x, self.center_y)
 
+        # The camera image is a read only view on the message, draw on a copy
+        display_image = self.current_image
         if self.hovered_x is not None:
-            self.current_image = DaVinci.draw_roi_rectangle(image=self.current_image,
-                                                            x=int(self.hovered_x / self.scale),
-                                                            y=int(self.hovered_y / self.scale),
-                                                            roi=self.roi_size)
+            display_image = DaVinci.draw_roi_rectangle(image=self.current_image.copy(),
+                                                       x=int(self.hovered_x / self.scale),
+                                                       y=int(self.hovered_y / self.scale),
+                                                       roi=self.roi_size)
 
         # Show Image
-        stacked = np.hstack((self.current_image, res))
+        stacked = np.hstack((display_image, res))
 
         info = "[0-9] states, [m]ove to, [q]uit"
         DaVinci.draw_text_box(
@@ -252,7 +256,8 @@ class ObjectFinder:
 
         cv2.imshow(self.window, cv2.resize(stacked, None, fx=self.scale, fy=self.scale))
         # cv2.imshow(self.window, stacked)
-        cv2.imshow('test', self.depth_image)
+        if depth_display_image is not None:
+            cv2.imshow('test', depth_display_image)
         # Input
         key = cv2.waitKey(1) & 0xFF
         key_str = chr(key)
@@ -275,23 +280,13 @@ class ObjectFinder:
         #     self.call_move_arm(world_to_cube)
 
         elif key == ord('u'):  # Pick up pose
-            self.world_to_cube_pickup = None
             print('Waiting for transform world to cube...')
-            while self.world_to_cube_pickup is None:
-                try:
-                    self.world_to_cube_pickup = self.tf_buffer.lookup_transform('world', 'cube', rospy.Time())
-                except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
-                    pass
+            self.world_to_cube_pickup = self.transform_cache.lookup('world', 'cube')
             print(self.world_to_cube_pickup)
 
         elif key == ord('d'):  # Place pose
-            self.world_to_cube_place = None
             print('Waiting for transform world to cube...')
-            while self.world_to_cube_place is None:
-                try:
-                    self.world_to_cube_place = self.tf_buffer.lookup_transform('world', 'cube', rospy.Time())
-                except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
-                    pass
+            self.world_to_cube_place = self.transform_cache.lookup('world', 'cube')
             print(self.world_to_cube_place)
 
         elif key == ord('m'):
@@ -350,13 +345,10 @@ class ObjectFinder:
         print(m)
 
     def get_world_cube_transform(self, key):
-        current_cube_transform = None
         print('Waiting for transform world to cube...')
-        while current_cube_transform is None:
-            try:
-                current_cube_transform = self.tf_buffer.lookup_transform('world', 'cube', rospy.Time())
-            except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
-                pass
+        current_cube_transform = self.transform_cache.lookup('world', 'cube')
+        if current_cube_transform is None:
+            return
         print(current_cube_transform)
         print(key)
         self.cube_poses[key] = current_cube_transform
@@ -384,6 +376,7 @@ if __name__ == '__main__':
     find_pose = rospy.get_param(param_name='object_detection/find_pose')
 
     camera_topic = rospy.get_param(param_name='object_detection/camera_topic')
+    Profiler.setup(rospy.get_param(param_name='object_detection/profiling', default=None), node_name='object_detection')
     intrinsic_camera = None
     if find_pose:
         intrinsic_camera = load_intrinsics(eye_in_hand=True)
@@ -1,5 +1,6 @@
 #! /usr/bin/env python3.8
 import os
+import time
 
 import rospkg
 import rospy
@@ -10,20 +11,29 @@ from camera_calibration.params.calibration import calibration_path_d455, calibra
 from camera_calibration.utils.TypeConverter import TypeConverter
 from camera_calibration.utils.TFPublish import TFPublish
 from camera_calibration.utils.JSONHelper import JSONHelper
+from camera_calibration.utils.Profiler import Profiler
 
 from utils.DaVinci import DaVinci
 from utils.UI import UI
 from utils.ColorObjectFinder import ColorObjectFinder
-
-from cv_bridge import CvBridge, CvBridgeError
+from utils.ColorLookupTable import ColorLookupTable
+from utils.IncrementalSegmenter import IncrementalSegmenter
+from utils.KMeansColorModel import KMeansColorModel
+from utils.CubePoseEstimator import CubePoseEstimator
+from utils.CubeTracker import CubeTracker
+from utils.CameraRig import CameraRig
+from utils.PipelineStats import PipelineStats
+from utils.ImageMessageAdapter import ImageMessageAdapter
+from utils.DebugImagePublisher import DebugImagePublisher
 
 from sensor_msgs.msg import Image
 
 import tf2_ros
 import actionlib
 from my_robot_msgs.msg import MoveArmAction, MoveArmGoal, MoveArmResult, MoveArmFeedback
+from my_robot_msgs.msg import DetectedCube, DetectedCubeArray
 import geometry_msgs.msg as gm
-import message_filters
+from std_srvs.srv import Trigger, TriggerResponse
 
 
 class ObjectFinderController:
@@ -34,6 +44,23 @@ class ObjectFinderController:
             camera_topics,
             save_dict_name,
             camera_matrices=None,
+            lookup_tables=None,
+            color_models=None,
+            full_frame_interval=0,
+            tracking_padding=20,
+            depth_patch_size=2,
+            pose_from_mask=False,
+            stats_interval=5.,
+            sync_slop=0.02,
+            sync_queue_size=10,
+            frame_queue_size=1,
+            headless=False,
+            debug_image_rate=0.,
+            debug_image_scale=0.25,
+            depth_noise=0.003,
+            cube_tf_rate=0.,
+            tracker_parameters=None,
+            color_names=None
 
     ):
 
@@ -42,10 +69,43 @@ class ObjectFinderController:
         self.save_dict_name = save_dict_name
         self.camera_topics = camera_topics
         self.intrinsic_matrices = camera_matrices
+        self.depth_patch_size = depth_patch_size
+
+        # Headless: no window and no segmented display images, see run_headless
+        self.headless = headless
+        self.debug_image_publishers = {
+            topic: DebugImagePublisher(topic_name=f'~{topic}/debug_image', rate=debug_image_rate,
+                                       scale=debug_image_scale)
+            for topic in camera_topics
+        }
+
+        # Position and orientation from every masked depth pixel, otherwise the depth at the center
+        self.pose_estimators = dict()
+        self.pose_size_warnings = set()
+        if pose_from_mask and camera_matrices is not None:
+            self.pose_estimators = {topic: CubePoseEstimator(camera_matrix=camera_matrices[topic])
+                                    for topic in camera_topics}
+        self.lookup_tables = lookup_tables if lookup_tables is not None else dict()
+        # Published labels are indices in the shared color_names, every table camera has its own
+        # export order. Without color_names the labels stay the export order (see cube_fusion)
+        self.color_names = color_names
+        self.label_maps = dict()
+        if color_names is not None:
+            self.label_maps = {topic: lookup_table.label_ids(color_names)
+                               for topic, lookup_table in self.lookup_tables.items()}
+        # Per camera k-means models, cameras without one use the HSV boxes
+        self.color_models = color_models if color_models is not None else dict()
+
+        # Tracking mode, full frame every full_frame_interval frames, 0 = always full frame
+        self.incremental_segmenters = dict()
+        if full_frame_interval > 0:
+            self.incremental_segmenters = {
+                topic: IncrementalSegmenter(full_frame_interval=full_frame_interval, padding=tracking_padding)
+                for topic in camera_topics
+            }
 
         self.cof = ColorObjectFinder()
         self.ui = UI()
-        self.cv_bridge = CvBridge()
 
         self.display_images = {}
         self.display_width = 640
@@ -59,28 +119,26 @@ class ObjectFinderController:
 
         self.current_image_dict = {topic: np.zeros((480, 640, 3)) for topic in camera_topics}
         self.current_segmented_image_dict = {topic: np.zeros((480, 640, 3)) for topic in camera_topics}
+        self.current_label_image_dict = {topic: np.zeros((480, 640), dtype=np.uint8) for topic in camera_topics}
+        self.current_segments_dict = {topic: list() for topic in camera_topics}
 
         self.selected_background_colors = []
         self.selected_block_colors = []
 
-        # Camera COLOR Topics
-
-        self.hand_subscriber = rospy.Subscriber(f'{camera_topics[0]}/color/image_raw', Image,
-                                                callback=self.callback_hand)
-        self.front_subscriber = rospy.Subscriber(f'{camera_topics[1]}/color/image_raw', Image,
-                                                 callback=self.callback_front)
-        self.top_subscriber = rospy.Subscriber(f'{camera_topics[2]}/color/image_raw', Image, callback=self.callback_top)
-
-        # Camera DEPTH Topics
-        if pose_estimation:
-            self.camera_depth_subscribers = {}
-            for camera_topic in camera_topics:
-                self.camera_depth_subscribers[camera_topic] = rospy.Subscriber(
-                    name=f'{camera_topic}/aligned_depth_to_color/image_raw',
-                    data_class=Image,
-                    callback=self.camera_depth_callback,
-                    callback_args=camera_topic
-                )
+        # One pipeline per camera topic: subscribers only fill a bounded drop-oldest queue, a thread
+        # per camera segments (OpenCV releases the GIL) and the GUI runs in its own loop, see run_gui.
+        # With pose estimation color and depth are paired by stamp.
+        self.stats = PipelineStats()
+        self.stats_interval = stats_interval
+        self.camera_rig = CameraRig(
+            camera_topics=camera_topics,
+            process=self.process_frame,
+            with_depth=pose_estimation,
+            queue_size=frame_queue_size,
+            sync_slop=sync_slop,
+            sync_queue_size=sync_queue_size,
+            stats=self.stats
+        )
 
         # Find Position
         self.segment_coordinates = {topic: dict() for topic in camera_topics}
@@ -88,15 +146,39 @@ class ObjectFinderController:
             self.segment_coordinates[topic]["segment_centers_x"] = list()  # Pixel
             self.segment_coordinates[topic]["segment_centers_y"] = list()  # Pixel
             self.segment_coordinates[topic]["segment_centers_z"] = list()  # Depth
+            self.segment_coordinates[topic]["segment_labels"] = list()  # Color index (1-based)
             self.segment_coordinates[topic]["positions"] = list()
 
+        # One DetectedCubeArray per camera frame, per cube TF frames only at cube_tf_rate (0 = off)
+        self.depth_noise = depth_noise
+        self.cube_publisher = rospy.Publisher('detected_cubes', DetectedCubeArray, queue_size=len(camera_topics) * 2)
+        self.cube_tf_interval = 1. / cube_tf_rate if cube_tf_rate > 0 else None
+        self.last_cube_tf = {topic: 0. for topic in camera_topics}
+
+        # Camera frame tracks, cube ids (and TF names) stay the same when the segment order changes
+        tracker_parameters = tracker_parameters if tracker_parameters is not None else dict()
+        self.cube_trackers = {topic: CubeTracker(**tracker_parameters) for topic in camera_topics}
+
+        # World frame cubes of all cameras, see cube_fusion.py
+        self.fused_cubes = None
+        self.fused_cubes_subscriber = rospy.Subscriber('fused_cubes', DetectedCubeArray,
+                                                       callback=self.fused_cubes_callback, queue_size=1)
+
         # Move Arm
-        self.tf_buffer = tf2_ros.Buffer()
-        self.listener = tf2_ros.TransformListener(self.tf_buffer)
         self.center_broadcaster = tf2_ros.TransformBroadcaster()
         self.action_client = actionlib.SimpleActionClient('/pick_and_place', MoveArmAction)
         self.action_client.wait_for_server()
 
+        # Key commands that make sense without a window
+        self.services = [
+            rospy.Service('~full_frame', Trigger,
+                          lambda request: self.trigger_response(self.request_full_frames, 'full frame')),
+            rospy.Service('~refit_colors', Trigger,
+                          lambda request: self.trigger_response(self.refit_color_models, 'refit colors'))
+        ]
+
+        self.camera_rig.start()
+
     def mouse_callback(self, event, x, y, flags, param):
         self.ui.update_mouse_hover(x, y)
         if event == cv2.EVENT_LBUTTONDOWN:
@@ -107,132 +189,286 @@ class ObjectFinderController:
                 scale=self.scale
             )
             self.ui.update_trackbars(self.cof.get_state())
+            self.request_full_frames()
+
+    def request_full_frames(self):
+        for incremental_segmenter in self.incremental_segmenters.values():
+            incremental_segmenter.request_full_frame()
+
+    def refit_color_models(self):
+        # Centers are fitted again on the next full frame of every camera
+        for color_model in self.color_models.values():
+            color_model.reset()
+        self.request_full_frames()
+
+    @staticmethod
+    def trigger_response(command, name):
+        command()
+        return TriggerResponse(success=True, message=f'{name} requested')
 
     # ----------------------------------------- Image Processing
 
-    def camera_depth_callback(self, aligned_depth, topic_name):
+    def camera_depth_callback(self, aligned_depth, topic_name, stamp):
+        # Called by the camera pipeline with the depth frame paired to the frame just segmented
         aligned_input_depth = None
         try:
-            aligned_input_depth = self.cv_bridge.imgmsg_to_cv2(
-                aligned_depth, desired_encoding="passthrough")
+            aligned_input_depth = ImageMessageAdapter.to_depth(aligned_depth)
 
-        except CvBridgeError as e:
+        except ValueError as e:
             print(e)
 
         # Find 3D point
         segment_centers_x = self.segment_coordinates[topic_name]['segment_centers_x']
         segment_centers_y = self.segment_coordinates[topic_name]['segment_centers_y']
-        self.segment_coordinates[topic_name]['segment_centers_z'].clear()
-        self.segment_coordinates[topic_name]['positions'].clear()
-
-        # for segment_center_x, segment_center_y in zip(segment_centers_x, segment_centers_y):
-        for idx, (segment_center_x, segment_center_y) in enumerate(
-                zip(segment_centers_x, segment_centers_y)):
-
-            if segment_center_x is not None and aligned_input_depth is not None:
-                depth_array = np.array(aligned_input_depth, dtype=np.float32)
-
-                if segment_center_x <= depth_array.shape[1] and segment_center_y <= depth_array.shape[0]:
-                    depth = depth_array[segment_center_y][segment_center_x] / 1000
-
-                    position = self.cof.pixel_to_3d_coordinate(
-                        pixel_coord=(segment_center_x, segment_center_y),
-                        depth_value=depth,
-                        camera_matrix=self.intrinsic_matrices[topic_name]
-                    )
-
-                    self.segment_coordinates[topic_name]['segment_centers_z'].append(position[2])
-                    self.segment_coordinates[topic_name]['positions'].append(position)
-                    self.broadcast_point(
-                        point=position,
-                        child_name=f'cube[{idx}]_from_{topic_name}',
-                        parent_name=topic_name
-                    )
-
-    def callback_top(self, image):
-        topic_name = 'cam_top'
-        try:
+        segment_centers_z, segment_positions = list(), list()
+        self.segment_coordinates[topic_name]['segment_centers_z'] = segment_centers_z
+        self.segment_coordinates[topic_name]['positions'] = segment_positions
+
+        cube_array = DetectedCubeArray()
+        cube_array.header.stamp = stamp
+        cube_array.header.frame_id = topic_name
+        cube_array.camera = topic_name
+
+        segment_centers = list(zip(segment_centers_x, segment_centers_y))
+        if aligned_input_depth is None or len(segment_centers) == 0:
+            self.cube_trackers[topic_name].update(
+                stamp=stamp.to_sec(), labels=[], positions=[], covariances=[], orientations=[])
+            self.cube_publisher.publish(cube_array)
+            return
+
+        # All centers at once, median of a depth patch per center
+        positions = self.cof.deproject_pixels(
+            depth_image=aligned_input_depth,
+            pixels=np.array(segment_centers),
+            camera_matrix=self.intrinsic_matrices[topic_name],
+            patch_size=self.depth_patch_size
+        )
+        rotations = np.tile([0., 0., 0., 1.], (len(positions), 1))
+
+        # Full mask estimate where available, same segment order as the centers
+        pose_estimator = self.pose_estimators.get(topic_name)
+        label_image = self.current_label_image_dict[topic_name]
+        segments = self.current_segments_dict[topic_name]
+        if pose_estimator is not None and len(segments) == len(positions):
+            # The label image is the top left display crop of the color frame (see
+            # resize_and_crop_image), the same crop of the depth keeps pixels and intrinsics aligned
+            label_height, label_width = label_image.shape[:2]
+            cropped_depth = aligned_input_depth[:label_height, :label_width]
+            if cropped_depth.shape[:2] == label_image.shape[:2]:
+                mask_positions, mask_rotations = pose_estimator.estimate(
+                    depth_image=cropped_depth, label_image=label_image, segments=segments)
+                estimated = ~np.isnan(mask_positions).any(axis=1)
+                positions[estimated] = mask_positions[estimated]
+                rotations[estimated] = mask_rotations[estimated]
+            elif topic_name not in self.pose_size_warnings:
+                self.pose_size_warnings.add(topic_name)
+                rospy.logwarn(f'{topic_name}: depth {aligned_input_depth.shape[1]}x{aligned_input_depth.shape[0]} '
+                              f'is smaller than the {label_width}x{label_height} label image, '
+                              f'pose_from_mask falls back to the depth at the segment centers')
+
+        covariances = self.cof.position_covariances(
+            positions=positions,
+            camera_matrix=self.intrinsic_matrices[topic_name],
+            depth_noise=self.depth_noise
+        )
+        labels = self.shared_labels(topic_name, np.array(self.segment_coordinates[topic_name]['segment_labels']))
+
+        valid = ~np.isnan(positions).any(axis=1)
+        cube_tracker = self.cube_trackers[topic_name]
+        track_ids = np.zeros(len(positions), dtype=np.int64)
+        track_ids[valid] = cube_tracker.update(
+            stamp=stamp.to_sec(),
+            labels=labels[valid],
+            positions=positions[valid],
+            covariances=covariances[valid],
+            orientations=rotations[valid]
+        )
+        track_index = {track_id: index for index, track_id in enumerate(cube_tracker.ids)}
+
+        now = time.perf_counter()
+        broadcast_tf = self.cube_tf_interval is not None and now - self.last_cube_tf[topic_name] >= self.cube_tf_interval
+        if broadcast_tf:
+            self.last_cube_tf[topic_name] = now
+
+        for idx, (position, rotation) in enumerate(zip(positions, rotations)):
+            if not valid[idx]:
+                continue
+
+            position = tuple(position)
+            segment_centers_z.append(position[2])
+            segment_positions.append(position)
+
+            cube = DetectedCube()
+            cube.label = int(labels[idx])
+            cube.position = gm.Point(*position)
+            cube.orientation = gm.Quaternion(*rotation)
+            cube.covariance = covariances[idx].ravel().tolist()
+            if len(segments) == len(positions):
+                cube.bbox = segments[idx]['bbox']
+            cube.id = int(track_ids[idx])
+            tracked = track_index[track_ids[idx]]
+            cube.confidence = cube_tracker.confidences[tracked]
+            cube.age = stamp.to_sec() - cube_tracker.first_stamps[tracked]
+            cube_array.cubes.append(cube)
+
+            if broadcast_tf:
+                self.broadcast_point(
+                    point=position,
+                    child_name=f'cube[{track_ids[idx]}]_from_{topic_name}',
+                    parent_name=topic_name,
+                    rotation=list(rotation)
+                )
 
-            current_image = self.cv_bridge.imgmsg_to_cv2(image, desired_encoding="bgr8")
-            current_image = DaVinci.resize_and_crop_image(current_image, width=self.display_width,
-                                                          height=self.display_height)
-            self.current_image_dict[topic_name] = current_image
-            self.segment(topic_name=topic_name, current_image=current_image)
+        self.cube_publisher.publish(cube_array)
 
-        except CvBridgeError as e:
-            print(e)
+    def shared_labels(self, topic_name, labels):
+        # Table labels through the camera's map, the live UI colors after all shared colors
+        label_map = self.label_maps.get(topic_name)
+        if label_map is None or len(labels) == 0:
+            return labels
+        table_colors = len(label_map) - 1
+        return np.where(labels <= table_colors, label_map[np.minimum(labels, table_colors)],
+                        labels - table_colors + len(self.color_names))
 
-    def callback_front(self, image):
-        topic_name = 'cam_front'
+    def process_frame(self, topic_name, image, aligned_depth):
+        # Runs on the camera's pipeline thread, aligned_depth is the stamp paired depth or None
+        start_time = time.perf_counter()
         try:
+            # View on the message buffer, nothing writes into the camera image
+            current_image = ImageMessageAdapter.to_bgr8(image)
 
-            current_image = self.cv_bridge.imgmsg_to_cv2(image, desired_encoding="bgr8")
-            current_image = DaVinci.resize_and_crop_image(current_image, width=self.display_width,
-                                                          height=self.display_height)
-            self.current_image_dict[topic_name] = current_image
-            self.segment(topic_name=topic_name, current_image=current_image)
-
-        except CvBridgeError as e:
+        except ValueError as e:
             print(e)
+            return
 
-    def segment(self, topic_name, current_image):
+        current_image = DaVinci.resize_and_crop_image(
+            current_image,
+            width=self.display_width,
+            height=self.display_height
+        )
+        converted_time = time.perf_counter()
+        self.stats.add(f'{topic_name}/convert', converted_time - start_time, end=converted_time)
+
+        self.current_image_dict[topic_name] = current_image
+        self.segment(topic_name=topic_name, current_image=current_image)
+
+        segmented_time = time.perf_counter()
+        self.stats.add(f'{topic_name}/segment', segmented_time - converted_time, end=segmented_time)
+
+        # Positions from the depth frame of the same pair
+        if aligned_depth is not None:
+            with self.stats.stage(f'{topic_name}/position'):
+                self.camera_depth_callback(aligned_depth=aligned_depth, topic_name=topic_name,
+                                           stamp=image.header.stamp)
+
+        debug_image_publisher = self.debug_image_publishers[topic_name]
+        if debug_image_publisher.is_due():
+            coordinates = self.segment_coordinates[topic_name]
+            debug_image_publisher.publish(
+                image=current_image,
+                mask=self.current_label_image_dict[topic_name],
+                points=list(zip(coordinates['segment_centers_x'], coordinates['segment_centers_y']))
+            )
+
+    def get_label_image(self, topic_name, image):
         # Remove background colors
         inv_mask = None
         if len(self.selected_background_colors) != 0:
             background_mask_image = self.cof.get_hsv_mask(
-                image=current_image,
+                image=image,
                 color_list=self.selected_background_colors
             )
             inv_mask = cv2.bitwise_not(background_mask_image)
 
-        # Add selected colors
-        current_color_mask_image = self.cof.get_hsv_mask(
-            image=current_image,
-            color_list=self.selected_block_colors + [self.cof.get_current_state()])
-
+        # Add selected colors, label k = k:th color
+        live_colors = self.selected_block_colors + [self.cof.get_current_state()]
+        lookup_table = self.lookup_tables.get(topic_name)
+        if lookup_table is not None:
+            labels = lookup_table.label(image)
+            masks, _ = self.cof.clean_masks(
+                masks=lookup_table.get_color_masks(labels),
+                color_list=lookup_table.states)
+            # Clicked / trackbar colors on top, labels after the table's and the table wins
+            # overlaps. Headless has no window to change them, the table alone is used
+            if not self.headless:
+                live_masks, _ = self.cof.get_hsv_masks(
+                    image=image,
+                    color_list=live_colors,
+                    color_model=self.color_models.get(topic_name))
+                masks = masks + live_masks
+        else:
+            masks, _ = self.cof.get_hsv_masks(
+                image=image,
+                color_list=live_colors,
+                color_model=self.color_models.get(topic_name))
+
+        label_image = self.cof.masks_to_label_image(masks)
         if inv_mask is not None:
-            current_color_mask_image = cv2.bitwise_and(inv_mask, current_color_mask_image)
+            label_image = cv2.bitwise_and(inv_mask, label_image)
 
-        # Segment image
+        return label_image
+
+    def segment(self, topic_name, current_image):
+        incremental_segmenter = self.incremental_segmenters.get(topic_name)
+        if incremental_segmenter is not None:
+            label_image, segments = incremental_segmenter.segment(
+                image=current_image,
+                get_label_image=lambda image: self.get_label_image(topic_name, image))
+        else:
+            label_image = self.get_label_image(topic_name, current_image)
+            segments = self.cof.find_label_segments(label_image)
+        self.current_label_image_dict[topic_name] = label_image
+        self.current_segments_dict[topic_name] = segments
+
+        # Update center coordinates, lists are replaced whole since the depth callback reads them
+        segment_centers_x, segment_centers_y, segment_labels = list(), list(), list()
+        for segment in segments:
+            x, y = [int(center_val) for center_val in segment['centroid']]
+            segment_centers_x.append(x)
+            segment_centers_y.append(y)
+            segment_labels.append(segment['label'])
+
+        self.segment_coordinates[topic_name]['segment_centers_x'] = segment_centers_x
+        self.segment_coordinates[topic_name]['segment_centers_y'] = segment_centers_y
+        self.segment_coordinates[topic_name]['segment_labels'] = segment_labels
+
+        if self.headless:
+            return
+
+        # Segment image with centers, only for the GUI
         segmented_image = cv2.bitwise_and(
             src1=current_image,
             src2=current_image,
-            mask=current_color_mask_image
+            mask=label_image
         )
-
-        # Update center coordinates
-        self.segment_coordinates[topic_name]['segment_centers_x'] = list()
-        self.segment_coordinates[topic_name]['segment_centers_y'] = list()
-        segment_coordinates = self.cof.find_segment_coordinates(current_color_mask_image)
-
-        # Draw Centers
-        for coordinate in segment_coordinates:
-            x, y = coordinate
-            self.segment_coordinates[topic_name]['segment_centers_x'].append(x)
-            self.segment_coordinates[topic_name]['segment_centers_y'].append(y)
+        for x, y in zip(segment_centers_x, segment_centers_y):
             self.cof.draw_dot(segmented_image, x, y)
 
-        # ---------------------------------
-
         # Save segment image
         self.current_segmented_image_dict[topic_name] = segmented_image
 
-    def callback_hand(self, image):
-        topic_name = 'cam_wrist'
-        try:
-            current_image = self.cv_bridge.imgmsg_to_cv2(image, desired_encoding="bgr8")
-            current_image = DaVinci.resize_and_crop_image(
-                current_image,
-                width=self.display_width,
-                height=self.display_height
-            )
-            self.current_image_dict[topic_name] = current_image
-            self.segment(topic_name=topic_name, current_image=current_image)
-
-        except CvBridgeError as e:
-            print(e)
-
-        self.update_callback()
+    def run_gui(self, rate):
+        # GUI loop on the main thread (OpenCV windows), independent of the camera rates
+        gui_rate = rospy.Rate(rate)
+        last_report = time.perf_counter()
+        while not rospy.is_shutdown():
+            start_time = time.perf_counter()
+            with self.stats.stage('gui/render'):
+                self.update_callback()
+
+            if self.stats_interval > 0 and start_time - last_report >= self.stats_interval:
+                print(self.stats.report())
+                last_report = start_time
+
+            gui_rate.sleep()
+
+    def run_headless(self):
+        # Cameras are processed on the rig threads, only the stats are reported here
+        report_rate = rospy.Rate(1. / self.stats_interval if self.stats_interval > 0 else 1.)
+        while not rospy.is_shutdown():
+            report_rate.sleep()
+            if self.stats_interval > 0:
+                print(self.stats.report())
 
     def combine_images(self):
         # stack segmentation with camera horizontally
@@ -295,72 +531,44 @@ class ObjectFinderController:
         #     state = self.cof.get_current_state().copy()
         #     self.selected_block_colors.append(state)
         elif key == ord('e'):
-            JSONHelper.export_hsv(self.export_values, self.save_dict_name)
+            JSONHelper.export_hsv(self.export_values, self.save_dict_name, color_names=self.color_names)
         elif key == ord('u') and self.selected_camera in self.export_values.keys():
             if len(self.export_values[self.selected_camera]) > 0:
                 self.export_values[self.selected_camera].pop()
         elif key == ord('s'):
             print(self.export_values)
+        elif key == ord('f'):
+            self.request_full_frames()
+        elif key == ord('n'):
+            self.refit_color_models()
 
-    def broadcast_point(self, point, child_name, parent_name):
+    def broadcast_point(self, point, child_name, parent_name, rotation=(0., 0., 0., 1.)):
         TFPublish.publish_static_transform(publisher=self.center_broadcaster,
                                            parent_name=parent_name,
                                            child_name=child_name,
-                                           rotation=[0., 0., 0., 1.],
+                                           rotation=list(rotation),
                                            translation=point)
 
-    def move_arm(self):
-        world_to_cube = None
-        transforms = []
-
-        while world_to_cube is None:
-            try:
-                for camera_topic in self.camera_topics:
-                    world_to_cube = self.tf_buffer.lookup_transform(
-                        'world',
-                        f'cube_from_{camera_topic}',
-                        rospy.Time()
-                    )
-                    transforms.append(world_to_cube)
+    def fused_cubes_callback(self, cube_array):
+        self.fused_cubes = cube_array
 
-            except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
-                print(f"No transform found between 'world' and 'cube'.")
+    def move_arm(self, label=None):
+        # First fused cube (of the color label), the cube fusion node merges all cameras in the world frame
+        if self.fused_cubes is None:
+            print("No fused cubes received, is cube_fusion running?")
+            return
 
-        average_pose = self.compute_average_transform(transforms)
-        self.call_move_arm(average_pose)
+        cubes = [cube for cube in self.fused_cubes.cubes if label is None or cube.label == label]
+        if len(cubes) == 0:
+            print(f"No fused cube with label {label}.")
+            return
 
-    @staticmethod
-    def compute_average_transform(stamped_transforms):
-        translation_sum = np.zeros(3)
-        rotation_sum = np.zeros(4)
-
-        for stamped_transform in stamped_transforms:
-            transform = stamped_transform.transform
-            translation_sum += np.array(
-                [
-                    transform.translation.x,
-                    transform.translation.y,
-                    transform.translation.z
-                ]
-            )
-
-            rotation_sum += np.array(
-                [
-                    transform.rotation.x,
-                    transform.rotation.y,
-                    transform.rotation.z,
-                    transform.rotation.w
-                ]
-            )
-
-        translation_avg = translation_sum / len(stamped_transforms)
-        rotation_avg = rotation_sum / len(stamped_transforms)
-
-        avg_transform = gm.TransformStamped()
-        avg_transform.transform.translation = gm.Vector3(*translation_avg)
-        avg_transform.transform.rotation = gm.Quaternion(*rotation_avg)
-
-        return avg_transform
+        world_to_cube = gm.TransformStamped()
+        world_to_cube.header = self.fused_cubes.header
+        world_to_cube.transform.translation = gm.Vector3(cubes[0].position.x, cubes[0].position.y,
+                                                         cubes[0].position.z)
+        world_to_cube.transform.rotation = cubes[0].orientation
+        self.call_move_arm(world_to_cube)
 
     def call_move_arm(self, pick_pose):
         pick_pose_translation = pick_pose.transform.translation
@@ -373,6 +581,7 @@ class ObjectFinderController:
         move_arm_goal.pickup_pose.position.x = pick_translation[0]
         move_arm_goal.pickup_pose.position.y = pick_translation[1]
         move_arm_goal.pickup_pose.position.z = pick_translation[2]
+        move_arm_goal.pickup_pose.orientation = pick_pose.transform.rotation  # cube orientation, gives the grasp yaw
 
         move_arm_goal.place_pose.position.x = random_x
         move_arm_goal.place_pose.position.y = random_y
@@ -398,6 +607,26 @@ def load_intrinsics(topics, intrinsic_names):
     return camera_matrices
 
 
+def load_lookup_tables(topics, hsv_export, bits):
+    hsv_file = os.path.join(rospkg.RosPack().get_path('object_finder'), f'hsv_exports/{hsv_export}/hsv')
+    return ColorLookupTable.from_hsv_export_topics(hsv_file=hsv_file, topics=topics, bits=bits)
+
+
+def load_color_models(topics, parameters):
+    # "color_backend": "hsv" (default) or "kmeans", one model per camera
+    if parameters.get('color_backend', 'hsv') != 'kmeans':
+        return None
+
+    print(f"k-means color backend, {parameters.get('kmeans_clusters', 12)} clusters")
+    return {
+        topic: KMeansColorModel(
+            clusters=parameters.get('kmeans_clusters', 12),
+            bits=parameters.get('kmeans_bits', 5),
+            subsample=parameters.get('kmeans_subsample', 4))
+        for topic in topics
+    }
+
+
 if __name__ == '__main__':
     rospy.init_node('object_detection')
 
@@ -407,30 +636,53 @@ if __name__ == '__main__':
     config_file_path = path + config_file_name
 
     parameters = JSONHelper.read_json(config_file_path)
+    Profiler.setup(parameters.get('profiling'), node_name='object_detection')
     find_pose = parameters['find_pose']
     topics = parameters['camera_topics']
     intrinsic_names = parameters['camera_intrinsics']
     save_dict_name = parameters['save_dict_name']
+    lookup_table_export = parameters.get('lookup_table_export')
 
     intrinsics = None
     if find_pose:
         intrinsics = load_intrinsics(topics=topics, intrinsic_names=intrinsic_names)
 
+    lookup_tables = None
+    if lookup_table_export is not None:
+        lookup_tables = load_lookup_tables(topics=topics, hsv_export=lookup_table_export,
+                                           bits=parameters.get('lookup_table_bits', 8))
+
     object_finder = ObjectFinderController(
         camera_matrices=intrinsics,
         camera_topics=topics,
         pose_estimation=find_pose,
-        save_dict_name = save_dict_name
+        save_dict_name = save_dict_name,
+        lookup_tables=lookup_tables,
+        color_models=load_color_models(topics=topics, parameters=parameters),
+        full_frame_interval=parameters.get('tracking_full_frame_interval', 0),
+        tracking_padding=parameters.get('tracking_padding', 20),
+        depth_patch_size=parameters.get('depth_patch_size', 2),
+        pose_from_mask=parameters.get('pose_from_mask', False),
+        stats_interval=parameters.get('stats_interval', 5.),
+        sync_slop=parameters.get('sync_slop', 0.02),
+        sync_queue_size=parameters.get('sync_queue_size', 10),
+        frame_queue_size=parameters.get('frame_queue_size', 1),
+        headless=parameters.get('headless', False),
+        debug_image_rate=parameters.get('debug_image_rate', 0.),
+        debug_image_scale=parameters.get('debug_image_scale', 0.25),
+        depth_noise=parameters.get('depth_noise', 0.003),
+        cube_tf_rate=parameters.get('cube_tf_rate', 0.),
+        tracker_parameters=CubeTracker.parameters_from_config(parameters),
+        color_names=parameters.get('color_names')
     )
 
-    # Update Freq
-    rate = rospy.Rate(10)
-
     try:
-        rospy.spin()
-        rate.sleep()
+        if parameters.get('headless', False):
+            object_finder.run_headless()
+        else:
+            object_finder.run_gui(rate=parameters.get('gui_rate', 30))
 
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, rospy.ROSInterruptException):
         print('Shutting down.')
 
     cv2.destroyAllWindows()
@@ -4,128 +4,74 @@ import os
 
 import rospkg
 import rospy
-from cv_bridge import CvBridge, CvBridgeError
-
-from sensor_msgs.msg import Image
 
 from camera_calibration.utils.JSONHelper import JSONHelper
 
+from utils.ColorLookupTable import ColorLookupTable
+from utils.ColorObjectFinder import ColorObjectFinder
+from utils.CameraRig import CameraRig
+from utils.ImageMessageAdapter import ImageMessageAdapter
+
 
 class TowerBuilder(object):
-    def __init__(self, camera_topics):
+    def __init__(self, camera_topics, lookup_tables, sync_slop=0.02, sync_queue_size=10, frame_queue_size=1):
         self.current_image_dict = {}
-        self.cv_bridge = CvBridge()
-        self.camera_topics = camera_topics.keys()
-
-        self.hand_subscriber = rospy.Subscriber(f'{camera_topics[0]}/color/image_raw', Image,
-                                                callback=self.callback_hand)
-        self.front_subscriber = rospy.Subscriber(f'{camera_topics[1]}/color/image_raw', Image,
-                                                 callback=self.callback_front)
-        self.top_subscriber = rospy.Subscriber(f'{camera_topics[2]}/color/image_raw', Image, callback=self.callback_top)
-
-        self.hand_depth_subscriber = rospy.Subscriber(f'{camera_topics[0]}/aligned_depth_to_color/image_raw', Image,
-                                                      callback=self.callback_hand_depth)
-        self.front_depth_subscriber = rospy.Subscriber(f'{camera_topics[1]}/aligned_depth_to_color/image_raw', Image,
-                                                       callback=self.callback_front_depth)
-        self.top_depth_subscriber = rospy.Subscriber(f'{camera_topics[2]}/aligned_depth_to_color/image_raw', Image,
-                                                     callback=self.callback_top_depth)
-
-        self.camera_depth_subscribers = {}
-        for camera_topic in camera_topics:
-            self.camera_depth_subscribers[camera_topic] = rospy.Subscriber(
-                name=f'{camera_topic}/aligned_depth_to_color/image_raw',
-                data_class=Image,
-                callback=self.camera_depth_callback,
-                callback_args=camera_topic
-            )
-
-    def callback_hand(self, image):
-        topic_name = 'cam_wrist'
-        try:
-
-            current_image = self.cv_bridge.imgmsg_to_cv2(image, desired_encoding="bgr8")
-
-            self.current_image_dict[topic_name] = current_image
-            self.segment(topic_name=topic_name, current_image=current_image)
-
-        except CvBridgeError as e:
-            print(e)
-
-    def callback_front(self, image):
-        topic_name = 'cam_front'
+        self.current_depth_dict = {}
+        self.current_label_dict = {}
+        self.current_segments_dict = {}
+        self.lookup_tables = lookup_tables
+        self.camera_topics = camera_topics
+
+        # Color and aligned depth of every camera, paired by stamp and processed on a thread per camera
+        self.camera_rig = CameraRig(camera_topics=camera_topics, process=self.process_frame, with_depth=True,
+                                    queue_size=frame_queue_size, sync_slop=sync_slop,
+                                    sync_queue_size=sync_queue_size)
+        self.camera_rig.start()
+
+    def process_frame(self, topic_name, image, aligned_depth):
         try:
+            current_image = ImageMessageAdapter.to_bgr8(image)
+            current_depth = ImageMessageAdapter.to_depth(aligned_depth)
 
-            current_image = self.cv_bridge.imgmsg_to_cv2(image, desired_encoding="bgr8")
-
-            self.current_image_dict[topic_name] = current_image
-            self.segment(topic_name=topic_name, current_image=current_image)
-
-        except CvBridgeError as e:
+        except ValueError as e:
             print(e)
+            return
 
-    def callback_top(self, image):
-        topic_name = 'cam_top'
-        try:
-
-            current_image = self.cv_bridge.imgmsg_to_cv2(image, desired_encoding="bgr8")
-
-            self.current_image_dict[topic_name] = current_image
-            self.segment(topic_name=topic_name, current_image=current_image)
-
-        except CvBridgeError as e:
-            print(e)
-
-    def callback_hand_depth(self, image):
-        topic_name = 'cam_wrist'
-        try:
-
-            current_image = self.cv_bridge.imgmsg_to_cv2(image, desired_encoding="bgr8")
-
-            self.current_image_dict[topic_name] = current_image
-            self.segment(topic_name=topic_name, current_image=current_image)
-
-        except CvBridgeError as e:
-            print(e)
-
-    def callback_front_depth(self, image):
-        topic_name = 'cam_front'
-        try:
-
-            current_image = self.cv_bridge.imgmsg_to_cv2(image, desired_encoding="bgr8")
-
-            self.current_image_dict[topic_name] = current_image
-            self.segment(topic_name=topic_name, current_image=current_image)
-
-        except CvBridgeError as e:
-            print(e)
-
-    def callback_top_depth(self, image):
-        topic_name = 'cam_top'
-        try:
-
-            current_image = self.cv_bridge.imgmsg_to_cv2(image, desired_encoding="bgr8")
-
-            self.current_image_dict[topic_name] = current_image
-            self.segment(topic_name=topic_name, current_image=current_image)
-
-        except CvBridgeError as e:
-            print(e)
+        self.current_image_dict[topic_name] = current_image
+        self.current_depth_dict[topic_name] = current_depth
+        self.segment(topic_name=topic_name, current_image=current_image)
 
     def segment(self, topic_name, current_image):
-        pass
+        # 0 = background, k = k:th exported color of the camera
+        lookup_table = self.lookup_tables.get(topic_name)
+        if lookup_table is not None:
+            labels = lookup_table.label(current_image)
+            self.current_label_dict[topic_name] = labels
+            self.current_segments_dict[topic_name] = ColorObjectFinder.find_label_segments(
+                labels, label_count=len(lookup_table.states))
 
 
 if __name__ == '__main__':
     rospy.init_node('tower_builder_node')
 
-    path = os.path.join(rospkg.RosPack().get_path('object_finder'), 'hsv_exports/')
-
-    config_dict_name = rospy.get_param(param_name='tower_builder_node/config')
-
-    config_file_path = path + config_dict_name + '/hsv'
+    package_path = rospkg.RosPack().get_path('object_finder')
 
+    # Node config (camera_topics, sync) like the object finder, colors from an hsv export
+    config_file_path = os.path.join(package_path, 'config/', rospy.get_param(param_name='tower_builder_node/config'))
     parameters = JSONHelper.read_json(config_file_path)
-
-    print(parameters)
-
-    # tower_builder = TowerBuilder(cameras)
+    topics = parameters['camera_topics']
+
+    hsv_export = rospy.get_param(param_name='tower_builder_node/hsv_export')
+    lookup_tables = ColorLookupTable.from_hsv_export_topics(
+        hsv_file=os.path.join(package_path, f'hsv_exports/{hsv_export}/hsv'),
+        topics=topics,
+        bits=parameters.get('lookup_table_bits', 8))
+
+    tower_builder = TowerBuilder(
+        camera_topics=topics,
+        lookup_tables=lookup_tables,
+        sync_slop=parameters.get('sync_slop', 0.02),
+        sync_queue_size=parameters.get('sync_queue_size', 10),
+        frame_queue_size=parameters.get('frame_queue_size', 1)
+    )
+    rospy.spin()
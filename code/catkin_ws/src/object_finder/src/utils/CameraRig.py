@@ -0,0 +1,112 @@
+import threading
+import time
+import traceback
+from collections import deque
+
+import rospy
+import message_filters
+from sensor_msgs.msg import Image
+
+from utils.LatestFrameSlot import LatestFrameSlot
+from utils.PipelineStats import PipelineStats
+
+
+# One camera: color (and optionally stamp paired aligned depth) subscribers that only
+# fill a bounded drop-oldest queue, and a processing thread that calls
+# process(topic_name, image, aligned_depth) with the queued frames. aligned_depth is None
+# without depth. Stats are kept under '<topic_name>/...'.
+class CameraPipeline:
+    FPS_WINDOW = 30
+
+    def __init__(self, topic_name, process, stats, with_depth=False, queue_size=1, sync_slop=0.02,
+                 sync_queue_size=10):
+        self.topic_name = topic_name
+        self.process = process
+        self.stats = stats
+        self.frame_slot = LatestFrameSlot(size=queue_size)
+        self.processed_times = deque(maxlen=self.FPS_WINDOW)
+        self.errors = 0
+
+        # queue_size=2 so rospy does not buffer old frames either, buff_size fits a whole image
+        if with_depth:
+            color_subscriber = message_filters.Subscriber(
+                f'{topic_name}/color/image_raw', Image, queue_size=2, buff_size=2 ** 24)
+            depth_subscriber = message_filters.Subscriber(
+                f'{topic_name}/aligned_depth_to_color/image_raw', Image, queue_size=2, buff_size=2 ** 24)
+            self.synchronizer = message_filters.ApproximateTimeSynchronizer(
+                [color_subscriber, depth_subscriber], queue_size=sync_queue_size, slop=sync_slop)
+            self.synchronizer.registerCallback(self.synchronized_callback)
+        else:
+            self.color_subscriber = rospy.Subscriber(f'{topic_name}/color/image_raw', Image,
+                                                     callback=self.color_callback, queue_size=2, buff_size=2 ** 24)
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def color_callback(self, image):
+        self.frame_slot.put((image, None))
+
+    def synchronized_callback(self, image, aligned_depth):
+        # Stamp difference of the pair and how old the pair is when it is complete
+        self.stats.add(f'{self.topic_name}/pair_skew', abs((image.header.stamp - aligned_depth.header.stamp).to_sec()))
+        self.stats.add(f'{self.topic_name}/pair_age',
+                       (rospy.Time.now() - max(image.header.stamp, aligned_depth.header.stamp)).to_sec())
+        self.frame_slot.put((image, aligned_depth))
+
+    def run(self):
+        while not rospy.is_shutdown():
+            frame, received_time = self.frame_slot.take(timeout=0.5)
+            if frame is None:
+                continue
+            image, aligned_depth = frame
+
+            start_time = time.perf_counter()
+            self.stats.add(f'{self.topic_name}/wait', start_time - received_time, end=start_time)
+            self.stats.add(f'{self.topic_name}/age', (rospy.Time.now() - image.header.stamp).to_sec())
+
+            # rospy used to catch and log callback errors, one bad frame must not end the thread
+            try:
+                self.process(self.topic_name, image, aligned_depth)
+            except Exception:
+                self.errors += 1
+                rospy.logerr(f'{self.topic_name}: processing a frame failed\n{traceback.format_exc()}')
+                self.stats.set_counter(f'{self.topic_name}/errors', self.errors)
+                continue
+
+            done_time = time.perf_counter()
+            self.stats.add(f'{self.topic_name}/process', done_time - start_time, end=done_time)
+            self.stats.add(f'{self.topic_name}/latency', done_time - received_time)
+            self.stats.set_counter(f'{self.topic_name}/received', self.frame_slot.received)
+            self.stats.set_counter(f'{self.topic_name}/dropped', self.frame_slot.dropped)
+
+            self.processed_times.append(done_time)
+            self.stats.set_counter(f'{self.topic_name}/fps', round(self.get_fps(), 1))
+
+    def get_fps(self):
+        # Processed frames per second over the last FPS_WINDOW frames
+        if len(self.processed_times) < 2:
+            return 0.
+        return (len(self.processed_times) - 1) / max(self.processed_times[-1] - self.processed_times[0], 1e-9)
+
+
+# A CameraPipeline per entry of the config's camera_topics, all sharing one PipelineStats.
+# Adding a camera only means adding its topic to the config.
+class CameraRig:
+
+    def __init__(self, camera_topics, process, with_depth=False, queue_size=1, sync_slop=0.02, sync_queue_size=10,
+                 stats=None):
+        self.stats = stats if stats is not None else PipelineStats()
+        self.pipelines = {
+            topic: CameraPipeline(topic_name=topic, process=process, stats=self.stats, with_depth=with_depth,
+                                  queue_size=queue_size, sync_slop=sync_slop, sync_queue_size=sync_queue_size)
+            for topic in camera_topics
+        }
+
+    def start(self):
+        for pipeline in self.pipelines.values():
+            pipeline.start()
+
+    def get_fps(self):
+        return {topic: pipeline.get_fps() for topic, pipeline in self.pipelines.items()}
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+
+from utils.HSVMaskEngine import HSVMaskEngine
+
+
+# Precompiled BGR -> label classifier for a fixed set of HSV color states.
+# Label 0 is background, label k is states[k - 1]. When colors overlap the
+# lowest index wins. Fill and noise are spatial and are not part of the table.
+# Every camera has its own exported colors in its own order, an optional 'name' per
+# exported color maps the camera's labels to the config's shared color_names (see label_ids).
+class ColorLookupTable:
+    HSV_KEYS = ['hue', 'saturation', 'value', 'hue_margin', 'saturation_margin', 'value_margin', 'noise', 'fill']
+
+    def __init__(self, states, bits=8, table=None, names=None):
+        self.states = states
+        self.names = names if names is not None else [None] * len(states)
+        self.bits = bits
+        self.shift = 8 - bits
+        self.table = table if table is not None else self.compile(states, bits)
+
+    @staticmethod
+    def compile(states, bits=8):
+        # Classify one representative BGR value per cell (the cell center when quantized)
+        size = 1 << bits
+        shift = 8 - bits
+        values = (np.arange(size, dtype=np.uint16) << shift) + ((1 << shift) >> 1)
+        values = values.astype(np.uint8)
+
+        blue, green, red = np.meshgrid(values, values, values, indexing='ij')
+        colors = np.stack((blue, green, red), axis=-1).reshape(size, size * size, 3)
+
+        table = np.zeros((size, size * size), dtype=np.uint8)
+        masks = HSVMaskEngine.get_color_masks(image=colors, states=states)
+        for label in range(len(masks), 0, -1):
+            table[masks[label - 1] > 0] = label
+
+        return table.reshape((size, size, size))
+
+    def label(self, image):
+        # Whole frame in one fancy index, (H, W) uint8 labels
+        if self.shift == 0:
+            return self.table[image[..., 0], image[..., 1], image[..., 2]]
+
+        quantized = image >> self.shift
+        return self.table[quantized[..., 0], quantized[..., 1], quantized[..., 2]]
+
+    def get_color_masks(self, labels):
+        # Raw 0/255 mask per state from a label image, same layout as HSVMaskEngine
+        return [cv2.compare(labels, label, cv2.CMP_EQ) for label in range(1, len(self.states) + 1)]
+
+    @staticmethod
+    def states_from_json(camera_colors):
+        # {'0': {'hue': .., ...}, '1': ...} as exported by JSONHelper.export_hsv
+        return [[camera_colors[key][name] for name in ColorLookupTable.HSV_KEYS]
+                for key in sorted(camera_colors.keys(), key=int)]
+
+    @staticmethod
+    def names_from_json(camera_colors):
+        return [camera_colors[key].get('name') for key in sorted(camera_colors.keys(), key=int)]
+
+    @staticmethod
+    def names_to_ids(names, color_names):
+        # Camera label -> 1-based index in the shared color_names, 0 stays background
+        missing = [name for name in names if name not in color_names]
+        if len(missing) > 0:
+            raise ValueError(f'Exported colors {missing} are not in color_names {color_names}')
+        return np.array([0] + [color_names.index(name) + 1 for name in names], dtype=np.uint8)
+
+    def label_ids(self, color_names):
+        return ColorLookupTable.names_to_ids(self.names, color_names)
+
+    @staticmethod
+    def check_shared_labels(hsv_file, topics, color_names=None):
+        # Raises ValueError when the labels of the exported cameras do not mean the same color.
+        # With color_names every exported color needs a known name, without them the labels
+        # are the export order and are only comparable for a single exported camera.
+        with open(f'{hsv_file}.json', 'r') as json_file:
+            camera_colors = json.load(json_file)
+        slots = [str(slot) for slot in range(len(topics)) if str(slot) in camera_colors]
+        if color_names is not None:
+            for slot in slots:
+                ColorLookupTable.names_to_ids(ColorLookupTable.names_from_json(camera_colors[slot]), color_names)
+        elif len(slots) > 1:
+            raise ValueError(f'Slots {slots} of {hsv_file} are labelled in their own export order, '
+                             f'name the exported colors and set color_names in the config')
+
+    @staticmethod
+    def from_hsv_export(hsv_file, camera, bits=8):
+        # hsv_file without .json like JSONHelper.read_json, cached next to it keyed by file hash
+        with open(f'{hsv_file}.json', 'rb') as json_file:
+            content = json_file.read()
+
+        digest = hashlib.sha1(content + f'{camera}:{bits}'.encode()).hexdigest()
+        cache_directory = os.path.join(os.path.dirname(hsv_file), 'lookup_tables')
+        cache_file = os.path.join(cache_directory, f'{camera}_{bits}bit_{digest}.npy')
+
+        camera_colors = json.loads(content)[str(camera)]
+        states = ColorLookupTable.states_from_json(camera_colors)
+        names = ColorLookupTable.names_from_json(camera_colors)
+
+        if os.path.exists(cache_file):
+            return ColorLookupTable(states=states, bits=bits, table=np.load(cache_file), names=names)
+
+        lookup_table = ColorLookupTable(states=states, bits=bits, names=names)
+        if not os.path.exists(cache_directory):
+            os.mkdir(cache_directory)
+        np.save(cache_file, lookup_table.table)
+
+        return lookup_table
+
+    @staticmethod
+    def from_hsv_export_topics(hsv_file, topics, bits=8):
+        # {topic: table}, hsv.json keys are the camera slots, slot i is topics[i]
+        with open(f'{hsv_file}.json', 'r') as json_file:
+            exported_slots = json.load(json_file).keys()
+
+        lookup_tables = dict()
+        for slot, topic in enumerate(topics):
+            if str(slot) in exported_slots:
+                lookup_tables[topic] = ColorLookupTable.from_hsv_export(hsv_file=hsv_file, camera=slot, bits=bits)
+                print(f'{topic} classified with {os.path.basename(os.path.dirname(hsv_file))} slot [{slot}] lookup table')
+        return lookup_tables
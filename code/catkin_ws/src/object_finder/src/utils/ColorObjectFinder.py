@@ -1,11 +1,12 @@
 import cv2
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 from scipy import stats
-from scipy.stats import circmean, circstd, circvar
 
 from utils.Const import Const
+from utils.ColorSampler import ColorSampler
+from utils.HSVMaskEngine import HSVMaskEngine
+from utils.MaskMorphology import MaskMorphology
 
 
 class ColorObjectFinder:
@@ -17,8 +18,9 @@ class ColorObjectFinder:
 
 
 
-    def __init__(self) -> None:
-        pass
+    def __init__(self, color_model=None) -> None:
+        # Anything with get_color_masks(image, states), HSV boxes by default
+        self.color_model = HSVMaskEngine if color_model is None else color_model
 
     # Hue (degrees), Sat (percentage), Val (percentage)
     def set_color(self, hue, sat, val):
@@ -36,104 +38,35 @@ class ColorObjectFinder:
             self.saved_state[Const.SATURATION_MARGIN] = sat
             self.saved_state[Const.VALUE_MARGIN] = val
 
-    def remove_noise(self, mask, kernel_size):
-        iterations = 3
-        # kernel_size = self.saved_states[self.NOISE]
-
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
-        cleaned_mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=iterations)
-
-        return cleaned_mask
-
-    def fill_holes(self, mask, kernel_size):
-        iterations = 3
-        # kernel_size = self.saved_states[self.FILL]
+    def get_hsv_mask(self, image, color_list=None):
+        _, final_mask = self.get_hsv_masks(image=image, color_list=color_list)
 
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
-        filled_mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=iterations)
+        return final_mask
 
-        return filled_mask
+    def get_hsv_masks(self, image, color_list=None, color_model=None):
+        # Per color masks and their union, HSV conversion done once for all colors
+        if color_model is None:
+            color_model = self.color_model
 
-    def get_hsv_mask(self, image, color_list=None):
         if color_list is None or len(color_list) == 0:
             current_states = [self.get_state()]
 
         else:
             current_states = color_list
 
-        final_mask = np.zeros((image.shape[0], image.shape[1]), dtype='uint8')
-
-        for current_state in current_states:
-            # print(current_state)
-            hue_range_l1 = current_state[Const.HUE] - current_state[Const.HUE_MARGIN]
-
-            sat_range_l1 = current_state[Const.SATURATION] - current_state[Const.SATURATION_MARGIN]
-
-            val_range_l1 = current_state[Const.VALUE] - current_state[Const.VALUE_MARGIN]
-
-            lower_range_1 = np.array((
-                hue_range_l1,
-                sat_range_l1,
-                val_range_l1
-            ))
-
-            hue_range_u1 = current_state[Const.HUE] + current_state[Const.HUE_MARGIN]
-
-            sat_range_u1 = current_state[Const.SATURATION] + current_state[Const.SATURATION_MARGIN]
+        masks = color_model.get_color_masks(image=image, states=current_states)
 
-            val_range_u1 = current_state[Const.VALUE] + current_state[Const.VALUE_MARGIN]
+        return self.clean_masks(masks=masks, color_list=current_states)
 
-            upper_range_1 = np.array((
-                hue_range_u1,
-                sat_range_u1,
-                val_range_u1
-            ))
-
-            lower_range_2 = lower_range_1.copy()
-            lower_range_2_compare = upper_range_1.copy()
-
-            if hue_range_l1 < 0:
-                lower_range_2[0] = Const.HUE_MAX + hue_range_l1
-                lower_range_2_compare[0] = Const.HUE_MAX
-            # if sat_range_l1 < 0:
-            #     lower_range_2[1] = Const.SAT_MAX + sat_range_l1
-            #     lower_range_2_compare[1] = Const.SAT_MAX
-            # if val_range_l1 < 0:
-            #     lower_range_2[2] = Const.VAL_MAX + val_range_l1
-            #     lower_range_2_compare[2] = Const.VAL_MAX
-
-            upper_range_2 = upper_range_1.copy()
-            upper_range_2_compare = lower_range_1.copy()
-
-            if hue_range_u1 > Const.HUE_MAX:
-                upper_range_2[0] = hue_range_u1 - Const.HUE_MAX
-                upper_range_2_compare[0] = 0
-            # if sat_range_u1 > Const.SAT_MAX:
-            #     upper_range_2[1] = sat_range_u1 - Const.SAT_MAX
-            #     upper_range_2_compare[1] = 0
-            # if val_range_u1 > Const.VAL_MAX:
-            #     upper_range_2[2] = val_range_u1 - Const.VAL_MAX
-            #     upper_range_2_compare[2] = 0
-
-            # Convert the image to HSV color space
-            hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-
-            mask = cv2.inRange(hsv_image, lower_range_1, upper_range_1)
-            lower_wrap_mask = cv2.inRange(hsv_image, lower_range_2, lower_range_2_compare)
-            upper_wrap_mask = cv2.inRange(hsv_image, upper_range_2_compare, upper_range_2)
-
-            mask = cv2.bitwise_or(mask, lower_wrap_mask)
-            mask = cv2.bitwise_or(mask, upper_wrap_mask)
-
-            if current_state[Const.FILL] > 0:
-                mask = self.fill_holes(mask, current_state[Const.FILL])
-
-            if current_state[Const.NOISE] > 0:
-                mask = self.remove_noise(mask, current_state[Const.NOISE])
+    def clean_masks(self, masks, color_list):
+        # Fill and noise removal per color, returns cleaned masks and their union
+        masks = MaskMorphology.clean_masks(masks=masks, states=color_list)
 
+        final_mask = np.zeros(masks[0].shape[:2], dtype='uint8')
+        for mask in masks:
             final_mask = cv2.bitwise_or(mask, final_mask)
 
-        return final_mask
+        return masks, final_mask
 
     @staticmethod
     def find_mask_center(mask):
@@ -158,6 +91,68 @@ class ColorObjectFinder:
 
         return segment_coordinates
 
+    @staticmethod
+    def masks_to_label_image(masks):
+        # uint8 label image, 0 = background, k = masks[k - 1], lowest index wins on overlap
+        label_image = np.zeros(masks[0].shape[:2], dtype='uint8')
+        for label in range(len(masks), 0, -1):
+            label_image[masks[label - 1] > 0] = label
+
+        return label_image
+
+    def get_label_image(self, image, color_list=None, color_model=None):
+        masks, _ = self.get_hsv_masks(image=image, color_list=color_list, color_model=color_model)
+
+        return self.masks_to_label_image(masks)
+
+    @staticmethod
+    def find_label_segments(label_image, label_count=None):
+        # Components of every label from one connected components pass over the union.
+        # Touching components of different labels are split inside their bounding box only.
+        if label_count is None:
+            label_count = int(label_image.max())
+
+        num_components, components, stats, centroids = cv2.connectedComponentsWithStats(
+            (label_image > 0).astype('uint8'))
+
+        # Pixel count of each label inside each component
+        label_histogram = np.bincount(
+            components.ravel() * (label_count + 1) + label_image.ravel(),
+            minlength=num_components * (label_count + 1)
+        ).reshape(num_components, label_count + 1)
+
+        segments = []
+        for component in range(1, num_components):
+            component_labels = np.flatnonzero(label_histogram[component, 1:]) + 1
+
+            if len(component_labels) == 1:
+                segments.append(ColorObjectFinder.create_segment(
+                    label=component_labels[0], stats=stats[component], centroid=centroids[component]))
+                continue
+
+            x, y, w, h = stats[component, :cv2.CC_STAT_AREA]
+            roi_labels = label_image[y:y + h, x:x + w]
+            roi_components = components[y:y + h, x:x + w] == component
+            for label in component_labels:
+                label_mask = ((roi_labels == label) & roi_components).astype('uint8')
+                num_parts, _, part_stats, part_centroids = cv2.connectedComponentsWithStats(label_mask)
+                for part in range(1, num_parts):
+                    part_stats[part, cv2.CC_STAT_LEFT] += x
+                    part_stats[part, cv2.CC_STAT_TOP] += y
+                    segments.append(ColorObjectFinder.create_segment(
+                        label=label, stats=part_stats[part], centroid=part_centroids[part] + (x, y)))
+
+        return segments
+
+    @staticmethod
+    def create_segment(label, stats, centroid):
+        return {
+            'label': int(label),
+            'area': int(stats[cv2.CC_STAT_AREA]),
+            'bbox': [int(value) for value in stats[:cv2.CC_STAT_AREA]],  # x, y, width, height
+            'centroid': [float(value) for value in centroid]
+        }
+
     @staticmethod
     def draw_dot(image, x, y, color=(255, 0, 255), radius=20, thickness=3):
         cv2.circle(image, (x, y), radius, color, thickness)
@@ -177,6 +172,66 @@ class ColorObjectFinder:
 
         return x, y, z
 
+    @staticmethod
+    def pixels_to_3d_coordinates(pixels, depths, camera_matrix):
+        # Same as pixel_to_3d_coordinate for (N, 2) pixels and (N,) depths, (N, 3)
+        pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 2)
+        depths = np.asarray(depths, dtype=np.float64)
+
+        x = (pixels[:, 0] - camera_matrix[0, 2]) * depths / camera_matrix[0, 0]
+        y = (pixels[:, 1] - camera_matrix[1, 2]) * depths / camera_matrix[1, 1]
+
+        return np.stack((x, y, depths), axis=1)
+
+    @staticmethod
+    def sample_depths(depth_image, pixels, patch_size=2, depth_scale=0.001):
+        # Median of the non zero depths in a (2 patch_size + 1)^2 patch around every pixel.
+        # Only the patches are read and converted, NaN where the patch has no depth or the
+        # pixel is outside the image.
+        pixels = np.asarray(pixels, dtype=np.int64).reshape(-1, 2)
+        height, width = depth_image.shape[:2]
+
+        offsets = np.arange(-patch_size, patch_size + 1)
+        xs = np.clip(pixels[:, 0, None, None] + offsets[None, None, :], 0, width - 1)
+        ys = np.clip(pixels[:, 1, None, None] + offsets[None, :, None], 0, height - 1)
+        patches = depth_image[ys, xs].reshape(len(pixels), -1)
+
+        # Zeros sort first, the median of the valid values sits in the upper part of the row
+        patches = np.sort(patches, axis=1)
+        valid_counts = np.count_nonzero(patches, axis=1)
+        first_valid = patches.shape[1] - valid_counts
+        rows = np.arange(len(pixels))
+        lower = patches[rows, np.minimum(first_valid + (valid_counts - 1) // 2, patches.shape[1] - 1)]
+        upper = patches[rows, np.minimum(first_valid + valid_counts // 2, patches.shape[1] - 1)]
+        depths = (lower.astype(np.float64) + upper) / 2 * depth_scale
+
+        outside = (pixels[:, 0] < 0) | (pixels[:, 0] >= width) | (pixels[:, 1] < 0) | (pixels[:, 1] >= height)
+        depths[(valid_counts == 0) | outside] = np.nan
+
+        return depths
+
+    @staticmethod
+    def deproject_pixels(depth_image, pixels, camera_matrix, patch_size=2, depth_scale=0.001):
+        # (N, 3) camera frame positions of (N, 2) pixels, rows without depth are NaN
+        depths = ColorObjectFinder.sample_depths(depth_image, pixels, patch_size, depth_scale)
+
+        return ColorObjectFinder.pixels_to_3d_coordinates(pixels, depths, camera_matrix)
+
+    @staticmethod
+    def position_covariances(positions, camera_matrix, depth_noise=0.003, pixel_noise=1.):
+        # (N, 3, 3) camera frame covariances of (N, 3) deprojected positions. Stereo depth noise
+        # grows with z^2 and acts along the viewing ray, pixel noise is lateral and grows with z.
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        depths = positions[:, 2]
+        rays = positions / depths[:, None]
+
+        depth_variances = (depth_noise * depths ** 2) ** 2
+        covariances = depth_variances[:, None, None] * rays[:, :, None] * rays[:, None, :]
+        covariances[:, 0, 0] += (pixel_noise * depths / camera_matrix[0, 0]) ** 2
+        covariances[:, 1, 1] += (pixel_noise * depths / camera_matrix[1, 1]) ** 2
+
+        return covariances
+
     def update_value(self, value, param):
         self.saved_state[param] = value
 
@@ -185,126 +240,28 @@ class ColorObjectFinder:
 
     @staticmethod
     def get_image_coordinate_color(image, x, y, roi_size, scale=1):
-        x = int(x / scale)
-        y = int(y / scale)
-        b, g, r = image[y, x]
-        hsv = cv2.cvtColor(np.uint8([[(b, g, r)]]), cv2.COLOR_BGR2HSV)
-        hue, saturation, value = hsv[0][0]
-        y_lower = max(y - roi_size, 0)
-        y_upper = min(image.shape[0], y + roi_size)
-        x_lower = max(x - roi_size, 0)
-        x_upper = min(image.shape[1], x + roi_size)
-        roi = image[y_lower: y_upper, x_lower: x_upper]
-        hsv_roi = cv2.cvtColor(roi, cv2.COLOR_BGR2HSV)
-        hsv_clean = ColorObjectFinder.remove_outliers(hsv_roi)
-        # hsv_lower = np.min(hsv_roi, axis=(0, 1))
-        # hsv_upper = np.max(hsv_roi, axis=(0, 1))
-        #
-        # hue_diff = (hsv_upper[0] - hsv_lower[0]) / 2
-        # sat_diff = (hsv_upper[1] - hsv_lower[1]) / 2
-        # val_diff = (hsv_upper[2] - hsv_lower[2]) / 2
-        return hsv_clean
+        return ColorSampler.get_colors(image, [(x, y)], roi_size, scale)[0]
+
+    @staticmethod
+    def get_image_coordinate_colors(image, points, roi_size, scale=1):
+        # Same as get_image_coordinate_color for many (x, y) points in one go
+        return ColorSampler.get_colors(image, points, roi_size, scale)
 
     @staticmethod
     def remove_outliers(image):
-        # Convert image to HSV color space
-        # hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-
-        # Split image into separate channels
-        hue, saturation, value = cv2.split(image)
-        data = {'hue': hue.flatten(), 'saturation': saturation.flatten(), 'value': value.flatten()}
-        df = pd.DataFrame(data)
-        # plt.figure()
-        # df['hue'].hist(bins=179)
-        # plt.show()
-        q1 = df.quantile(0.25)
-        q3 = df.quantile(0.75)
-        iqr = q3 - q1
-
-        # Do twice! Right shift lower values once
-        # remove pixels with outliers
-        true_list = ~((df < (q1 - 1.5 * iqr)) | (df > (q3 + 1.5 * iqr)))
-        subset = df[true_list]
-        subset = subset.dropna()
-        #
-        # plt.figure()
-        # subset['hue'].hist(bins=179)
-        # plt.show()
-
-        means = subset.mean()
-        max_values = subset.max()
-        min_values = subset.min()
-        medians = subset.median()
-        print(f'mean values:\n{means}'
-              f'\nmax values:\n{max_values}'
-              f'\nmin values:\n{min_values}'
-              f'\nmedian:\n{medians}'
-        )
-        # # Remove outliers using z-score
-        # z_scores = stats.zscore(hue.flatten())
-        # hue = hue.flatten()[np.abs(z_scores) < 1]
-        #
-        # z_scores = stats.zscore(saturation.flatten())
-        # saturation = saturation.flatten()[np.abs(z_scores) < 1]
-        # # print(z_scores)
-        # z_scores = stats.zscore(value.flatten())
-        # value = value.flatten()[np.abs(z_scores) < 1]
-        # print(hue, saturation, value)
-        # diff_hue = ColorObjectFinder.calculate_distance(min_values['hue'], max_values['hue'])
-        diff_saturation = ColorObjectFinder.calculate_distance(min_values['saturation'], max_values['saturation'])
-        diff_value = max_values['value'] - min_values['value']
-
-        # if max['hue'] - min['hue'] > abs(min['hue'] - (179 - max['hue'])):
-        #     total_sum = 0
-        #     count = 0
-        #     for hue_value in subset['hue']:
-        #         if (179 - hue_value) < hue_value:
-        #
-        #             total_sum += 0 - (179 - hue_value)
-        #         else:
-        #
-        #             total_sum += hue_value
-        #         count += 1
-        #     print('total_sum: ', total_sum/count)
-
-        # mean_hue = ColorObjectFinder.average(subset['hue'])
-        # print(mean_hue)
-
-        # Calculate average hue, saturation, and value
-        # avg_hue = int(np.mean(hue))
-        # avg_saturation = int(np.mean(saturation))
-        # avg_value = int(np.mean(value))
-
-        hue_avg, hue_diff = ColorObjectFinder.wrapped_hue(image)
-
-        print(hue_avg, hue_diff)
-
-        return round(hue_avg), round(means['saturation']), round(means['value']), round(hue_diff), round(
-            diff_saturation), round(diff_value)
+        # image is an HSV roi
+        hsv_pixels = image.reshape(-1, 3)
+        statistics = ColorSampler.describe(hsv_pixels, np.zeros(len(hsv_pixels), dtype=int), 1)[0]
+
+        return tuple(round(float(value)) for value in statistics)
 
     @staticmethod
     def wrapped_hue(image):
-        # roi = 100
-        # image = cv2.cvtColor(image[:roi, :roi], cv2.COLOR_BGR2HSV)
-        hue, saturation, value = cv2.split(image)
-        hue_list = list(hue.flatten())
-
-        # Remove circular outliers
-        hue_mean = circmean(hue_list, high=179, low=0)
-        hue_std = circstd(hue_list, high=179, low=0)
-        hue_var = circvar(hue_list, high=179, low=0)
-        # print(hue_mean)
-        # print(hue_std)
-        # print(hue_var)
-
-        # Remove circular outliers based on quantiles
-        q1 = np.percentile(hue_list, 25)
-        q4 = np.percentile(hue_list, 75)
-        hue_filtered = [val for val in hue_list if q1 <= val <= q4]
-        # todo try variance on hue_filtered
-        hue_diff = hue_var * 179
-
-        return hue_mean, hue_diff
+        hue_histogram = ColorSampler.histograms(image[..., 0].ravel(), np.zeros(image[..., 0].size, dtype=int), 1,
+                                                bins=ColorSampler.HUE_BINS)
+        hue_mean, hue_var = ColorSampler.circular_hue(hue_histogram[:, 0])
+
+        return hue_mean[0], hue_var[0] * ColorSampler.HUE_PERIOD
 
     @staticmethod
     def calculate_distance(value1, value2):
@@ -0,0 +1,119 @@
+import cv2
+import numpy as np
+
+from utils.Const import Const
+
+
+# Color statistics of many ROIs at once, pure NumPy.
+# All ROI pixels are converted to HSV in one call and every statistic comes from
+# per ROI histograms (np.bincount), so adding sample points costs almost nothing.
+class ColorSampler:
+    BINS = 256
+    HUE_BINS = Const.HUE_MAX + 1
+    HUE_PERIOD = Const.HUE_MAX  # same period as circmean(high=179, low=0)
+
+    @staticmethod
+    def get_roi_pixels(image, points, roi_size, scale=1):
+        # HSV pixels of all ROIs stacked (M, 3) and the ROI index of every pixel (M,)
+        rois = []
+        for x, y in points:
+            x = int(x / scale)
+            y = int(y / scale)
+            y_lower = max(y - roi_size, 0)
+            y_upper = min(image.shape[0], y + roi_size)
+            x_lower = max(x - roi_size, 0)
+            x_upper = min(image.shape[1], x + roi_size)
+            rois.append(image[y_lower: y_upper, x_lower: x_upper].reshape(-1, 3))
+
+        roi_index = np.repeat(np.arange(len(rois)), [len(roi) for roi in rois])
+        bgr_pixels = np.concatenate(rois).reshape(-1, 1, 3)
+        hsv_pixels = cv2.cvtColor(bgr_pixels, cv2.COLOR_BGR2HSV).reshape(-1, 3)
+
+        return hsv_pixels, roi_index
+
+    @staticmethod
+    def histograms(values, roi_index, roi_count, bins=BINS):
+        # (roi_count, channels, bins) counts
+        values = values.reshape(len(values), -1).astype(np.int64)
+        channels = values.shape[1]
+        flat_index = (roi_index[:, None] * channels + np.arange(channels)) * bins + values
+
+        return np.bincount(flat_index.ravel(), minlength=roi_count * channels * bins).reshape(
+            roi_count, channels, bins)
+
+    @staticmethod
+    def quantiles(histograms, q):
+        # Linear interpolation like np.percentile / pandas quantile, (roi_count, channels)
+        cumulative = np.cumsum(histograms, axis=-1)
+        position = q * (cumulative[..., -1] - 1)
+        lower_rank = np.floor(position)
+
+        lower = ColorSampler.value_at_rank(cumulative, lower_rank)
+        upper = ColorSampler.value_at_rank(cumulative, np.minimum(lower_rank + 1, cumulative[..., -1] - 1))
+
+        return lower + (position - lower_rank) * (upper - lower)
+
+    @staticmethod
+    def value_at_rank(cumulative, rank):
+        # Value of the rank:th smallest sample (0-based) from cumulative counts
+        return np.sum(cumulative <= rank[..., None], axis=-1)
+
+    @staticmethod
+    def circular_hue(hue_histograms):
+        # Circular mean and variance (1 - R) of hue from (roi_count, 180) histograms
+        angles = np.arange(ColorSampler.HUE_BINS) * 2 * np.pi / ColorSampler.HUE_PERIOD
+        counts = np.maximum(hue_histograms.sum(axis=-1), 1)
+
+        sin_mean = hue_histograms @ np.sin(angles) / counts
+        cos_mean = hue_histograms @ np.cos(angles) / counts
+
+        mean_angle = np.arctan2(sin_mean, cos_mean) % (2 * np.pi)
+        mean_hue = mean_angle * ColorSampler.HUE_PERIOD / (2 * np.pi)
+        variance = 1 - np.hypot(sin_mean, cos_mean)
+
+        return mean_hue, variance
+
+    @staticmethod
+    def describe(hsv_pixels, roi_index, roi_count):
+        # (roi_count, 6) hue, sat, val, hue margin, sat margin, val margin
+        # Saturation and value come from IQR filtered pixels, hue from circular statistics
+        histograms = ColorSampler.histograms(hsv_pixels, roi_index, roi_count)
+        q1 = ColorSampler.quantiles(histograms, 0.25)
+        q3 = ColorSampler.quantiles(histograms, 0.75)
+        iqr = q3 - q1
+
+        lower_fence = (q1 - 1.5 * iqr)[roi_index]
+        upper_fence = (q3 + 1.5 * iqr)[roi_index]
+        keep = np.all((hsv_pixels >= lower_fence) & (hsv_pixels <= upper_fence), axis=1)
+
+        # Fall back to every pixel for a ROI where nothing survives
+        kept_counts = np.bincount(roi_index[keep], minlength=roi_count)
+        keep |= (kept_counts == 0)[roi_index]
+        kept_counts = np.bincount(roi_index[keep], minlength=roi_count)
+
+        kept_pixels = hsv_pixels[keep].astype(np.float64)
+        kept_index = roi_index[keep]
+        means = np.stack([np.bincount(kept_index, weights=kept_pixels[:, channel], minlength=roi_count)
+                          for channel in range(3)], axis=1) / kept_counts[:, None]
+
+        kept_histograms = ColorSampler.histograms(hsv_pixels[keep], kept_index, roi_count)
+        present = kept_histograms > 0
+        minimums = np.argmax(present, axis=-1)
+        maximums = ColorSampler.BINS - 1 - np.argmax(present[..., ::-1], axis=-1)
+
+        # Saturation and value are linear 0-255 ranges, only hue wraps
+        saturation_distance = maximums[:, 1] - minimums[:, 1]
+        value_distance = maximums[:, 2] - minimums[:, 2]
+
+        hue_mean, hue_variance = ColorSampler.circular_hue(histograms[:, 0, :ColorSampler.HUE_BINS])
+
+        return np.stack((hue_mean, means[:, 1], means[:, 2],
+                         hue_variance * ColorSampler.HUE_PERIOD, saturation_distance, value_distance), axis=1)
+
+    @staticmethod
+    def get_colors(image, points, roi_size, scale=1):
+        # One (hue, sat, val, hue margin, sat margin, val margin) tuple of ints per point
+        hsv_pixels, roi_index = ColorSampler.get_roi_pixels(image, points, roi_size, scale)
+        statistics = ColorSampler.describe(hsv_pixels, roi_index, len(points))
+
+        return [tuple(round(float(value)) for value in row) for row in statistics]
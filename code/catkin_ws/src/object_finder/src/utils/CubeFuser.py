@@ -0,0 +1,88 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+
+# Fuses world frame cube detections of several cameras into one list of cubes.
+# Every camera keeps only its latest frame, a new frame replaces it and the fusion runs
+# again. Detections with the same label closer than merge_distance (also through other
+# detections) are one cube, its position is the inverse covariance weighted mean so
+# noisy (far, low quality depth) detections count less.
+class CubeFuser:
+
+    def __init__(self, merge_distance=0.03, max_age=0.5, noise_scales=None):
+        self.merge_distance = merge_distance
+        self.max_age = max_age
+        # Per camera factor on the position standard deviation, e.g. {'cam_top': 1.5}
+        self.noise_scales = noise_scales if noise_scales is not None else dict()
+        self.frames = dict()
+
+    def update(self, camera, stamp, labels, positions, covariances, orientations):
+        # One camera frame, positions (N, 3), covariances (N, 3, 3), orientations xyzw (N, 4), all world frame
+        noise_scale = self.noise_scales.get(camera, 1.)
+        self.frames[camera] = {
+            'stamp': stamp,
+            'labels': np.asarray(labels, dtype=np.int64).reshape(-1),
+            'positions': np.asarray(positions, dtype=np.float64).reshape(-1, 3),
+            'covariances': np.asarray(covariances, dtype=np.float64).reshape(-1, 3, 3) * noise_scale ** 2,
+            'orientations': np.asarray(orientations, dtype=np.float64).reshape(-1, 4)
+        }
+
+        # Frames of cameras that stopped seeing anything recent are left out
+        for old_camera in [name for name, frame in self.frames.items() if stamp - frame['stamp'] > self.max_age]:
+            del self.frames[old_camera]
+
+        return self.fuse()
+
+    def fuse(self):
+        # labels (M,), positions (M, 3), covariances (M, 3, 3), orientations (M, 4), camera counts (M,)
+        frames = list(self.frames.values())
+        labels = np.concatenate([frame['labels'] for frame in frames]) if frames else np.zeros(0, dtype=np.int64)
+        if len(labels) == 0:
+            return labels, np.zeros((0, 3)), np.zeros((0, 3, 3)), np.zeros((0, 4)), np.zeros(0, dtype=np.int64)
+
+        positions = np.concatenate([frame['positions'] for frame in frames])
+        covariances = np.concatenate([frame['covariances'] for frame in frames])
+        orientations = np.concatenate([frame['orientations'] for frame in frames])
+        cameras = np.concatenate([np.full(len(frame['labels']), index) for index, frame in enumerate(frames)])
+
+        clusters = self.cluster(labels, positions)
+        cluster_count = clusters.max() + 1
+
+        # Information form: sum of inverse covariances and of inverse covariance times position
+        informations = np.linalg.inv(covariances)
+        information_sums = np.zeros((cluster_count, 3, 3))
+        np.add.at(information_sums, clusters, informations)
+        weighted_sums = np.zeros((cluster_count, 3))
+        np.add.at(weighted_sums, clusters, np.einsum('nij,nj->ni', informations, positions))
+
+        fused_covariances = np.linalg.inv(information_sums)
+        fused_positions = np.einsum('nij,nj->ni', fused_covariances, weighted_sums)
+
+        # Cube orientations are only defined up to the cube symmetry, averaging them is not
+        # meaningful, the most certain detection of the cluster gives the orientation
+        certainty = -np.trace(covariances, axis1=1, axis2=2)
+        order = np.lexsort((certainty, clusters))
+        last_of_cluster = np.r_[clusters[order][1:] != clusters[order][:-1], True]
+        best = order[last_of_cluster]
+
+        camera_counts = np.array([len(np.unique(cameras[clusters == cluster])) for cluster in range(cluster_count)])
+
+        # Stable output order, by label then position
+        fused_labels = labels[best]
+        output_order = np.lexsort((fused_positions[:, 1], fused_positions[:, 0], fused_labels))
+
+        return (fused_labels[output_order], fused_positions[output_order], fused_covariances[output_order],
+                orientations[best][output_order], camera_counts[output_order])
+
+    def cluster(self, labels, positions):
+        # Cluster index per detection, connected components of same label pairs within merge_distance.
+        # The label is added as a far away coordinate so one tree query handles all labels.
+        separated = np.column_stack((positions, labels * (self.merge_distance * 10 + np.ptp(positions) + 1)))
+        pairs = cKDTree(separated).query_pairs(r=self.merge_distance, output_type='ndarray')
+
+        adjacency = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(labels), len(labels)))
+        _, clusters = connected_components(adjacency, directed=False)
+
+        return clusters
@@ -0,0 +1,140 @@
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+
+# Cube positions and orientations from every masked depth pixel of a segment.
+# The rays (u - cx) / fx and (v - cy) / fy are cached per image size, so a point
+# is ray * depth. Depth outliers (sides, background between cubes) are dropped
+# around the median depth before the centroid and the PCA of every cube.
+#
+# The normal of the visible face is the PCA axis of least variance. A square face has
+# no main in-plane PCA axis, so the edge direction comes from the 4-fold moment
+# sum r^4 e^(4i theta) of the points in the face plane, which is defined modulo 90 degrees.
+class CubePoseEstimator:
+    MIN_POINTS = 10
+
+    def __init__(self, camera_matrix, depth_scale=0.001, depth_tolerance=0.02):
+        self.camera_matrix = np.asarray(camera_matrix, dtype=np.float64)
+        self.depth_scale = depth_scale
+        self.depth_tolerance = depth_tolerance  # meters from the median depth
+
+        self.ray_shape = None
+        self.rays_x = None
+        self.rays_y = None
+
+    def get_rays(self, shape):
+        # (H, W) float32 x and y of the ray through every pixel at depth 1
+        if self.ray_shape != shape[:2]:
+            height, width = shape[:2]
+            fx, fy = self.camera_matrix[0, 0], self.camera_matrix[1, 1]
+            cx, cy = self.camera_matrix[0, 2], self.camera_matrix[1, 2]
+
+            self.rays_x = np.broadcast_to(((np.arange(width) - cx) / fx).astype(np.float32), (height, width))
+            self.rays_y = np.broadcast_to(((np.arange(height) - cy) / fy).astype(np.float32)[:, None], (height, width))
+            self.ray_shape = shape[:2]
+
+        return self.rays_x, self.rays_y
+
+    def gather_points(self, depth_image, label_image, segments):
+        # Points (M, 3) of all segments stacked and the segment index of every point (M,)
+        rays_x, rays_y = self.get_rays(depth_image.shape)
+
+        points, segment_index = [], []
+        for index, segment in enumerate(segments):
+            x, y, w, h = segment['bbox']
+            depth_roi = depth_image[y:y + h, x:x + w]
+            inside = (label_image[y:y + h, x:x + w] == segment['label']) & (depth_roi > 0)
+
+            depths = depth_roi[inside].astype(np.float32) * self.depth_scale
+            points.append(np.column_stack((rays_x[y:y + h, x:x + w][inside] * depths,
+                                           rays_y[y:y + h, x:x + w][inside] * depths,
+                                           depths)))
+            segment_index.append(np.full(len(depths), index))
+
+        if len(points) == 0:
+            return np.zeros((0, 3), dtype=np.float32), np.zeros(0, dtype=int)
+
+        return np.concatenate(points), np.concatenate(segment_index)
+
+    @staticmethod
+    def segment_medians(values, segment_index, segment_count):
+        # Median of values per segment, NaN for segments without values
+        order = np.lexsort((values, segment_index))
+        sorted_values = values[order]
+        counts = np.bincount(segment_index, minlength=segment_count)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+        medians = np.full(segment_count, np.nan)
+        present = counts > 0
+        lower = sorted_values[starts[present] + (counts[present] - 1) // 2]
+        upper = sorted_values[starts[present] + counts[present] // 2]
+        medians[present] = (lower.astype(np.float64) + upper) / 2
+
+        return medians
+
+    def estimate(self, depth_image, label_image, segments):
+        # positions (N, 3) and rotations (N, 4) x, y, z, w in the camera frame, NaN rows where
+        # a segment has fewer than MIN_POINTS valid depths. Rotation columns: edge, edge, normal
+        # with the normal pointing towards the camera.
+        segment_count = len(segments)
+        positions = np.full((segment_count, 3), np.nan)
+        rotations = np.full((segment_count, 4), np.nan)
+        if segment_count == 0:
+            return positions, rotations
+
+        points, segment_index = self.gather_points(depth_image, label_image, segments)
+
+        # Drop points far from the median depth of their segment
+        median_depths = self.segment_medians(points[:, 2], segment_index, segment_count)
+        inliers = np.abs(points[:, 2] - median_depths[segment_index]) <= self.depth_tolerance
+        points = points[inliers].astype(np.float64)
+        segment_index = segment_index[inliers]
+
+        counts = np.bincount(segment_index, minlength=segment_count)
+        valid = counts >= self.MIN_POINTS
+        safe_counts = np.maximum(counts, 1)
+
+        centroids = np.stack([np.bincount(segment_index, weights=points[:, axis], minlength=segment_count)
+                              for axis in range(3)], axis=1) / safe_counts[:, None]
+
+        # Covariance of every segment at once, (N, 3, 3), from the 6 unique products
+        centered = points - centroids[segment_index]
+        covariances = np.empty((segment_count, 3, 3))
+        for i, j in ((0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)):
+            covariances[:, i, j] = np.bincount(segment_index, weights=centered[:, i] * centered[:, j],
+                                               minlength=segment_count)
+            covariances[:, j, i] = covariances[:, i, j]
+        covariances /= safe_counts[:, None, None]
+        covariances[~valid] = np.eye(3)
+
+        # eigh sorts eigenvalues ascending, column 0 is the face normal
+        _, eigenvectors = np.linalg.eigh(covariances)
+        normals = eigenvectors[:, :, 0]
+        normals[normals[:, 2] > 0] *= -1
+        in_plane_u = eigenvectors[:, :, 2]
+        in_plane_v = np.cross(normals, in_plane_u)
+
+        # 4-fold moment in the face plane, sum of (u + iv)^4 = r^4 e^(4i theta)
+        plane_points = (np.einsum('ij,ij->i', centered, in_plane_u[segment_index]) +
+                        1j * np.einsum('ij,ij->i', centered, in_plane_v[segment_index]))
+        plane_points *= plane_points
+        plane_points *= plane_points
+        moments = np.bincount(segment_index, weights=plane_points.real, minlength=segment_count) + \
+            1j * np.bincount(segment_index, weights=plane_points.imag, minlength=segment_count)
+        edge_angles = (np.angle(moments) + np.pi) / 4
+
+        edges = np.cos(edge_angles)[:, None] * in_plane_u + np.sin(edge_angles)[:, None] * in_plane_v
+        matrices = np.stack((edges, np.cross(normals, edges), normals), axis=2)
+
+        positions[valid] = centroids[valid]
+        rotations[valid] = Rotation.from_matrix(matrices[valid]).as_quat()
+
+        return positions, rotations
+
+    @staticmethod
+    def yaw(rotation, symmetry=np.pi / 2):
+        # Angle of the first edge around z of the parent frame, in [-symmetry / 2, symmetry / 2)
+        edge = Rotation.from_quat(rotation).apply([1., 0., 0.])
+        angle = np.arctan2(edge[..., 1], edge[..., 0])
+
+        return (angle + symmetry / 2) % symmetry - symmetry / 2
@@ -0,0 +1,173 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+
+# Multi cube tracker, one constant position Kalman filter per cube, all tracks updated
+# together as arrays. Detections are associated to tracks of the same label by
+# Mahalanobis distance (Hungarian or greedy), unmatched detections start new tracks and
+# tracks that are not seen for max_misses frames are dropped. Track ids never repeat.
+class CubeTracker:
+    GATE = 16.27  # chi^2, 3 dof, 99.9 %
+
+    def __init__(self, process_noise=0.01, max_misses=10, min_hits=3, association='hungarian', smoothing=0.2):
+        self.process_noise = process_noise  # m / sqrt(s), how fast a resting cube may drift
+        self.max_misses = max_misses
+        self.min_hits = min_hits
+        self.association = association
+        self.smoothing = smoothing  # confidence moving average factor
+
+        self.next_id = 1
+        self.last_stamp = None
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.labels = np.zeros(0, dtype=np.int64)
+        self.positions = np.zeros((0, 3))
+        self.covariances = np.zeros((0, 3, 3))
+        self.orientations = np.zeros((0, 4))
+        self.hits = np.zeros(0, dtype=np.int64)
+        self.misses = np.zeros(0, dtype=np.int64)
+        self.confidences = np.zeros(0)
+        self.first_stamps = np.zeros(0)
+
+    @staticmethod
+    def parameters_from_config(parameters):
+        # "tracker_*" node config keys -> constructor arguments
+        return {
+            'process_noise': parameters.get('tracker_process_noise', 0.01),
+            'max_misses': parameters.get('tracker_max_misses', 10),
+            'min_hits': parameters.get('tracker_min_hits', 3),
+            'association': parameters.get('tracker_association', 'hungarian')
+        }
+
+    def update(self, stamp, labels, positions, covariances, orientations):
+        # One frame of detections, returns the track id of every detection (D,)
+        labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        covariances = np.asarray(covariances, dtype=np.float64).reshape(-1, 3, 3)
+        orientations = np.asarray(orientations, dtype=np.float64).reshape(-1, 4)
+
+        # Predict, the position stays, the uncertainty grows with time
+        dt = 0. if self.last_stamp is None else max(stamp - self.last_stamp, 0.)
+        self.last_stamp = stamp
+        self.covariances += np.eye(3) * self.process_noise ** 2 * dt
+
+        track_indices, detection_indices = self.associate(labels, positions, covariances)
+
+        # Correct matched tracks
+        if len(track_indices) > 0:
+            innovation_covariances = self.covariances[track_indices] + covariances[detection_indices]
+            gains = self.covariances[track_indices] @ np.linalg.inv(innovation_covariances)
+            innovations = positions[detection_indices] - self.positions[track_indices]
+            self.positions[track_indices] += np.einsum('nij,nj->ni', gains, innovations)
+            self.covariances[track_indices] = (np.eye(3) - gains) @ self.covariances[track_indices]
+            self.orientations[track_indices] = orientations[detection_indices]
+
+        matched = np.zeros(len(self.ids), dtype=bool)
+        matched[track_indices] = True
+        self.hits[matched] += 1
+        self.misses[matched] = 0
+        self.misses[~matched] += 1
+        self.confidences += self.smoothing * (matched - self.confidences)
+
+        detection_ids = np.zeros(len(labels), dtype=np.int64)
+        detection_ids[detection_indices] = self.ids[track_indices]
+
+        # Drop lost tracks, start tracks for the unmatched detections
+        self.keep(self.misses <= self.max_misses)
+        new = np.ones(len(labels), dtype=bool)
+        new[detection_indices] = False
+        detection_ids[new] = self.add(stamp, labels[new], positions[new], covariances[new], orientations[new])
+
+        return detection_ids
+
+    def associate(self, labels, positions, covariances):
+        # (track indices, detection indices) of the matched pairs
+        if len(self.ids) == 0 or len(labels) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        # Squared Mahalanobis distance of every detection to every track (T, D). The largest
+        # eigenvalue of S is at most its trace, so pairs with |d|^2 > GATE trace(S) are out of
+        # the gate without solving, only the remaining same label pairs are solved.
+        differences = positions[None, :, :] - self.positions[:, None, :]
+        traces = np.trace(self.covariances, axis1=1, axis2=2)[:, None] + np.trace(covariances, axis1=1, axis2=2)
+        candidates = (self.labels[:, None] == labels[None, :]) & \
+                     (np.einsum('tdi,tdi->td', differences, differences) <= self.GATE * traces)
+
+        costs = np.full(candidates.shape, np.inf)
+        track_candidates, detection_candidates = np.nonzero(candidates)
+        if len(track_candidates) > 0:
+            candidate_differences = differences[track_candidates, detection_candidates]
+            innovation_covariances = self.covariances[track_candidates] + covariances[detection_candidates]
+            costs[track_candidates, detection_candidates] = np.einsum(
+                'ni,ni->n', candidate_differences,
+                np.linalg.solve(innovation_covariances, candidate_differences[..., None])[..., 0])
+        costs[costs > self.GATE] = np.inf
+
+        if self.association == 'greedy':
+            return self.greedy_assignment(costs)
+
+        # Gated pairs get a cost no assignment can prefer, they are dropped afterwards
+        finite_costs = np.where(np.isfinite(costs), costs, self.GATE * (costs.size + 1))
+        track_indices, detection_indices = linear_sum_assignment(finite_costs)
+        valid = np.isfinite(costs[track_indices, detection_indices])
+
+        return track_indices[valid], detection_indices[valid]
+
+    @staticmethod
+    def greedy_assignment(costs):
+        # Cheapest pair first, each track and detection used once
+        order = np.argsort(costs, axis=None)
+        order = order[np.isfinite(costs.ravel()[order])]
+        used_tracks, used_detections = set(), set()
+        track_indices, detection_indices = list(), list()
+        for track_index, detection_index in zip(*np.unravel_index(order, costs.shape)):
+            if track_index in used_tracks or detection_index in used_detections:
+                continue
+            used_tracks.add(track_index)
+            used_detections.add(detection_index)
+            track_indices.append(track_index)
+            detection_indices.append(detection_index)
+
+        return np.array(track_indices, dtype=np.int64), np.array(detection_indices, dtype=np.int64)
+
+    def add(self, stamp, labels, positions, covariances, orientations):
+        ids = np.arange(self.next_id, self.next_id + len(labels))
+        self.next_id += len(labels)
+
+        self.ids = np.concatenate((self.ids, ids))
+        self.labels = np.concatenate((self.labels, labels))
+        self.positions = np.concatenate((self.positions, positions))
+        self.covariances = np.concatenate((self.covariances, covariances))
+        self.orientations = np.concatenate((self.orientations, orientations))
+        self.hits = np.concatenate((self.hits, np.ones(len(labels), dtype=np.int64)))
+        self.misses = np.concatenate((self.misses, np.zeros(len(labels), dtype=np.int64)))
+        self.confidences = np.concatenate((self.confidences, np.full(len(labels), self.smoothing)))
+        self.first_stamps = np.concatenate((self.first_stamps, np.full(len(labels), float(stamp))))
+
+        return ids
+
+    def keep(self, kept):
+        self.ids = self.ids[kept]
+        self.labels = self.labels[kept]
+        self.positions = self.positions[kept]
+        self.covariances = self.covariances[kept]
+        self.orientations = self.orientations[kept]
+        self.hits = self.hits[kept]
+        self.misses = self.misses[kept]
+        self.confidences = self.confidences[kept]
+        self.first_stamps = self.first_stamps[kept]
+
+    def get_tracks(self):
+        # Confirmed tracks (seen min_hits times) ordered by id:
+        # {'ids', 'labels', 'positions', 'covariances', 'orientations', 'confidences', 'ages'}
+        confirmed = self.hits >= self.min_hits
+        ages = (self.last_stamp if self.last_stamp is not None else 0.) - self.first_stamps
+
+        return {
+            'ids': self.ids[confirmed],
+            'labels': self.labels[confirmed],
+            'positions': self.positions[confirmed],
+            'covariances': self.covariances[confirmed],
+            'orientations': self.orientations[confirmed],
+            'confidences': self.confidences[confirmed],
+            'ages': ages[confirmed]
+        }
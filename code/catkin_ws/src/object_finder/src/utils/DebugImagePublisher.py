@@ -0,0 +1,37 @@
+import time
+
+import cv2
+import rospy
+from cv_bridge import CvBridge, CvBridgeError
+from sensor_msgs.msg import Image
+
+
+# Downsampled debug image topic for nodes running without a window. Nothing is drawn or
+# converted unless a frame is due, rate = frames per second, 0 = off.
+class DebugImagePublisher:
+
+    def __init__(self, topic_name, rate=2., scale=0.25):
+        self.rate = rate
+        self.scale = scale
+        self.last_publish = 0.
+        self.cv_bridge = CvBridge()
+        self.publisher = rospy.Publisher(topic_name, Image, queue_size=1) if rate > 0 else None
+
+    def is_due(self):
+        return self.publisher is not None and time.perf_counter() - self.last_publish >= 1. / self.rate
+
+    def publish(self, image, mask=None, points=()):
+        # image (bgr8) with everything outside mask darkened and a dot per (x, y) point
+        self.last_publish = time.perf_counter()
+        small = cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        if mask is not None:
+            small_mask = cv2.resize(mask, (small.shape[1], small.shape[0]), interpolation=cv2.INTER_NEAREST)
+            small[small_mask == 0] //= 4
+
+        for x, y in points:
+            cv2.circle(small, (int(x * self.scale), int(y * self.scale)), 3, (0, 0, 255), -1)
+
+        try:
+            self.publisher.publish(self.cv_bridge.cv2_to_imgmsg(small, encoding="bgr8"))
+        except CvBridgeError as e:
+            print(e)
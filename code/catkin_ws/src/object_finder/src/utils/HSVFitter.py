@@ -0,0 +1,211 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from utils.ColorSampler import ColorSampler
+from utils.Const import Const
+from utils.HSVMaskEngine import HSVMaskEngine
+from utils.MaskMorphology import MaskMorphology
+
+
+# Fits saved_state color boxes (hue, sat, val, margins, noise, fill) to labelled frames by IoU.
+#
+# frames_directory/
+#     *.png / *.jpg           frames
+#     labels.json             {"frame.png": {"0": [[x, y], ...], "1": [...], "background": [[x, y], ...]}}
+#     masks/<frame stem>/<color>.png   optional full frame 0/255 masks, override clicks for that frame
+#
+# Clicks label a (2 roi_size)^2 square. Pixels of other colors and background are negatives,
+# unlabelled pixels are ignored. Every color is fitted in its own process.
+class HSVFitter:
+    IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+    UNLABELLED = 0
+    BACKGROUND = 255
+
+    MARGIN_LIMITS = (Const.HUE_MAX // 2, Const.SAT_MAX // 2, Const.VAL_MAX // 2)
+    MAX_SWEEPS = 10
+
+    @staticmethod
+    def get_colors(frames_directory):
+        labels = HSVFitter.read_labels(frames_directory)
+        colors = {key for frame_labels in labels.values() for key in frame_labels.keys() if key != 'background'}
+
+        masks_directory = os.path.join(frames_directory, 'masks')
+        if os.path.exists(masks_directory):
+            for frame_masks in os.listdir(masks_directory):
+                colors.update(os.path.splitext(name)[0] for name in os.listdir(os.path.join(masks_directory, frame_masks)))
+
+        return sorted(colors, key=int)
+
+    @staticmethod
+    def read_labels(frames_directory):
+        labels_file = os.path.join(frames_directory, 'labels.json')
+        if not os.path.exists(labels_file):
+            return dict()
+
+        with open(labels_file) as json_file:
+            return json.load(json_file)
+
+    @staticmethod
+    def load_frames(frames_directory, colors, roi_size):
+        # [(bgr frame, label image)], label k + 1 = colors[k], 255 = background, 0 = unlabelled
+        labels = HSVFitter.read_labels(frames_directory)
+        frames = []
+        for name in sorted(os.listdir(frames_directory)):
+            if not name.lower().endswith(HSVFitter.IMAGE_EXTENSIONS):
+                continue
+
+            image = cv2.imread(os.path.join(frames_directory, name))
+            label_image = np.full(image.shape[:2], HSVFitter.UNLABELLED, dtype=np.uint8)
+
+            mask_directory = os.path.join(frames_directory, 'masks', os.path.splitext(name)[0])
+            if os.path.exists(mask_directory):
+                label_image[:] = HSVFitter.BACKGROUND
+                for index, color in enumerate(colors):
+                    mask_file = os.path.join(mask_directory, f'{color}.png')
+                    if os.path.exists(mask_file):
+                        label_image[cv2.imread(mask_file, cv2.IMREAD_GRAYSCALE) > 0] = index + 1
+
+            elif name in labels:
+                for key, points in labels[name].items():
+                    label = HSVFitter.BACKGROUND if key == 'background' else colors.index(key) + 1
+                    for x, y in points:
+                        label_image[max(y - roi_size, 0): y + roi_size, max(x - roi_size, 0): x + roi_size] = label
+
+            else:
+                continue
+
+            frames.append((image, label_image))
+
+        return frames
+
+    @staticmethod
+    def get_weighted_colors(frames, label):
+        # Unique HSV values of labelled pixels with positive and negative counts
+        codes, positives = [], []
+        for image, label_image in frames:
+            labelled = label_image != HSVFitter.UNLABELLED
+            hsv_pixels = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)[labelled].astype(np.int64)
+            codes.append((hsv_pixels[:, 0] << 16) | (hsv_pixels[:, 1] << 8) | hsv_pixels[:, 2])
+            positives.append(label_image[labelled] == label)
+
+        codes = np.concatenate(codes)
+        positives = np.concatenate(positives)
+
+        unique_codes, inverse = np.unique(codes, return_inverse=True)
+        positive_weights = np.bincount(inverse, weights=positives, minlength=len(unique_codes))
+        negative_weights = np.bincount(inverse, weights=~positives, minlength=len(unique_codes))
+
+        hsv = np.stack((unique_codes >> 16, (unique_codes >> 8) & 0xFF, unique_codes & 0xFF), axis=1)
+
+        return hsv, positive_weights, negative_weights
+
+    @staticmethod
+    def iou(inside, positive_weights, negative_weights):
+        # inside (..., U) bool, IoU over labelled pixels
+        true_positives = inside @ positive_weights
+        false_positives = inside @ negative_weights
+        false_negatives = positive_weights.sum() - true_positives
+
+        return true_positives / np.maximum(true_positives + false_positives + false_negatives, 1)
+
+    @staticmethod
+    def fit_box(hsv, positive_weights, negative_weights, start_state):
+        # Coordinate ascent over hue, sat, val and margins, every candidate value of one
+        # parameter is scored at once
+        state = [int(value) for value in start_state[:6]] + [0, 0]
+        candidates = [np.arange(Const.HUE_MAX + 1), np.arange(Const.SAT_MAX + 1), np.arange(Const.VAL_MAX + 1)] + \
+                     [np.arange(limit + 1) for limit in HSVFitter.MARGIN_LIMITS]
+
+        tables = HSVMaskEngine.get_channel_tables(state)
+        best_iou = HSVFitter.iou(tables[0][hsv[:, 0]] & tables[1][hsv[:, 1]] & tables[2][hsv[:, 2]],
+                                 positive_weights, negative_weights)
+
+        for _ in range(HSVFitter.MAX_SWEEPS):
+            improved = False
+            for parameter in range(6):
+                channel = parameter % 3
+                tables = HSVMaskEngine.get_channel_tables(state)
+                others = np.ones(len(hsv), dtype=bool)
+                for other in range(3):
+                    if other != channel:
+                        others &= tables[other][hsv[:, other]]
+
+                candidate_tables = []
+                for value in candidates[parameter]:
+                    candidate_state = list(state)
+                    candidate_state[parameter] = int(value)
+                    candidate_tables.append(HSVMaskEngine.get_channel_tables(candidate_state)[channel])
+
+                inside = np.array(candidate_tables)[:, hsv[:, channel]] & others
+                scores = HSVFitter.iou(inside, positive_weights, negative_weights)
+
+                best = int(np.argmax(scores))
+                if scores[best] > best_iou:
+                    best_iou = scores[best]
+                    state[parameter] = int(candidates[parameter][best])
+                    improved = True
+
+            if not improved:
+                break
+
+        return state, float(best_iou)
+
+    @staticmethod
+    def fit_morphology(frames, label, state, noise_candidates, fill_candidates):
+        # Pick noise and fill by IoU of the cleaned masks on labelled pixels
+        raw_masks = [HSVMaskEngine.get_color_masks(image, [state])[0] for image, _ in frames]
+
+        best = (state[Const.NOISE], state[Const.FILL], -1.0)
+        for noise in noise_candidates:
+            for fill in fill_candidates:
+                true_positives, union = 0, 0
+                for raw_mask, (_, label_image) in zip(raw_masks, frames):
+                    inside = MaskMorphology.fill_and_remove_noise(raw_mask, fill, noise) > 0
+                    labelled = label_image != HSVFitter.UNLABELLED
+                    positive = label_image == label
+                    true_positives += np.count_nonzero(inside & positive)
+                    union += np.count_nonzero((inside & labelled) | positive)
+
+                iou = true_positives / max(union, 1)
+                if iou > best[2]:
+                    best = (noise, fill, iou)
+
+        return best
+
+    @staticmethod
+    def fit_color(frames_directory, colors, color, roi_size, noise_candidates, fill_candidates):
+        frames = HSVFitter.load_frames(frames_directory, colors, roi_size)
+        label = colors.index(color) + 1
+
+        hsv, positive_weights, negative_weights = HSVFitter.get_weighted_colors(frames, label)
+        if positive_weights.sum() == 0:
+            return color, None, 0.0
+
+        # Start from the IQR/circular statistics of the positive pixels, like a click in the UI
+        positive_pixels = np.repeat(hsv, positive_weights.astype(np.int64), axis=0).astype(np.uint8)
+        start_state = ColorSampler.describe(positive_pixels, np.zeros(len(positive_pixels), dtype=int), 1)[0]
+        start_state = [round(float(value)) for value in start_state]
+
+        state, box_iou = HSVFitter.fit_box(hsv, positive_weights, negative_weights, start_state)
+        noise, fill, iou = HSVFitter.fit_morphology(frames, label, state, noise_candidates, fill_candidates)
+        state[Const.NOISE] = noise
+        state[Const.FILL] = fill
+
+        return color, state, iou
+
+    @staticmethod
+    def fit_colors(frames_directory, roi_size=9, noise_candidates=(0, 3, 5, 7), fill_candidates=(0, 5, 10, 15),
+                   processes=None):
+        # {color: (state, iou)}, one process per color
+        colors = HSVFitter.get_colors(frames_directory)
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(HSVFitter.fit_color, frames_directory, colors, color, roi_size,
+                                       noise_candidates, fill_candidates) for color in colors]
+            results = [future.result() for future in futures]
+
+        return {color: (state, iou) for color, state, iou in results if state is not None}
@@ -0,0 +1,86 @@
+import cv2
+import numpy as np
+
+from utils.Const import Const
+
+
+# Evaluates many HSV color states on one frame.
+# The image is converted to HSV once and every state is compiled into
+# per channel lookup tables (one bit per color), so a single cv2.LUT call
+# classifies all colors at the same time.
+class HSVMaskEngine:
+    COLORS_PER_TABLE = 8
+
+    @staticmethod
+    def get_ranges(state):
+        # Same bounds as ColorObjectFinder.get_hsv_mask, hue wraps around HUE_MAX
+        hue_lower = state[Const.HUE] - state[Const.HUE_MARGIN]
+        hue_upper = state[Const.HUE] + state[Const.HUE_MARGIN]
+
+        hue_ranges = [(hue_lower, hue_upper)]
+        if hue_lower < 0:
+            hue_ranges.append((Const.HUE_MAX + hue_lower, Const.HUE_MAX))
+        if hue_upper > Const.HUE_MAX:
+            hue_ranges.append((0, hue_upper - Const.HUE_MAX))
+
+        sat_range = (state[Const.SATURATION] - state[Const.SATURATION_MARGIN],
+                     state[Const.SATURATION] + state[Const.SATURATION_MARGIN])
+        val_range = (state[Const.VALUE] - state[Const.VALUE_MARGIN],
+                     state[Const.VALUE] + state[Const.VALUE_MARGIN])
+
+        return hue_ranges, sat_range, val_range
+
+    @staticmethod
+    def in_range(lower, upper):
+        # cv2.inRange rounds float bounds half to even before comparing
+        channel_values = np.arange(256)
+        return (np.rint(lower) <= channel_values) & (channel_values <= np.rint(upper))
+
+    @staticmethod
+    def get_channel_tables(state):
+        # Boolean (256,) hue, saturation and value tables of one state
+        hue_ranges, sat_range, val_range = HSVMaskEngine.get_ranges(state)
+
+        hue_inside = np.zeros(256, dtype=bool)
+        for hue_range in hue_ranges:
+            hue_inside |= HSVMaskEngine.in_range(*hue_range)
+
+        return hue_inside, HSVMaskEngine.in_range(*sat_range), HSVMaskEngine.in_range(*val_range)
+
+    @staticmethod
+    def build_lookup_tables(states):
+        # One (1, 256, 3) uint8 table per group of 8 colors, bit k = color k in the group
+        tables = []
+        for start in range(0, len(states), HSVMaskEngine.COLORS_PER_TABLE):
+            table = np.zeros((1, 256, 3), dtype=np.uint8)
+
+            for bit, state in enumerate(states[start:start + HSVMaskEngine.COLORS_PER_TABLE]):
+                for channel, inside in enumerate(HSVMaskEngine.get_channel_tables(state)):
+                    table[0, inside, channel] |= np.uint8(1 << bit)
+
+            tables.append(table)
+
+        return tables
+
+    @staticmethod
+    def classify(hsv_image, table):
+        # Color bits set in all three channels
+        hue_bits, sat_bits, val_bits = cv2.split(cv2.LUT(hsv_image, table))
+        return cv2.bitwise_and(cv2.bitwise_and(hue_bits, sat_bits), val_bits)
+
+    @staticmethod
+    def get_color_masks(image, states, lookup_tables=None):
+        # Raw (no fill/noise) 0/255 mask per state, in the same order as states
+        if lookup_tables is None:
+            lookup_tables = HSVMaskEngine.build_lookup_tables(states)
+
+        hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+
+        masks = []
+        for group, table in enumerate(lookup_tables):
+            bits = HSVMaskEngine.classify(hsv_image, table)
+            group_size = min(HSVMaskEngine.COLORS_PER_TABLE, len(states) - group * HSVMaskEngine.COLORS_PER_TABLE)
+            for bit in range(group_size):
+                masks.append(cv2.compare(cv2.bitwise_and(bits, 1 << bit), 0, cv2.CMP_GT))
+
+        return masks
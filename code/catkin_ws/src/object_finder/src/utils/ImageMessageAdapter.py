@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+
+
+# sensor_msgs/Image -> NumPy without cv_bridge. bgr8, mono8 and the depth encodings are
+# returned as read only views on Image.data (no copy, the array lives as long as the
+# message), row padding (step) included. Other color encodings are converted once with OpenCV.
+class ImageMessageAdapter:
+    ENCODINGS = {
+        'bgr8': (np.uint8, 3),
+        'rgb8': (np.uint8, 3),
+        'bgra8': (np.uint8, 4),
+        'rgba8': (np.uint8, 4),
+        'mono8': (np.uint8, 1),
+        '8UC1': (np.uint8, 1),
+        '8UC3': (np.uint8, 3),
+        'mono16': (np.uint16, 1),
+        '16UC1': (np.uint16, 1),
+        '32FC1': (np.float32, 1),
+    }
+    TO_BGR = {
+        'rgb8': cv2.COLOR_RGB2BGR,
+        'bgra8': cv2.COLOR_BGRA2BGR,
+        'rgba8': cv2.COLOR_RGBA2BGR,
+        'mono8': cv2.COLOR_GRAY2BGR,
+    }
+
+    @staticmethod
+    def to_array(image_message):
+        # (H, W) or (H, W, C) view in the message encoding
+        if image_message.encoding not in ImageMessageAdapter.ENCODINGS:
+            raise ValueError(f'Unsupported image encoding {image_message.encoding}')
+
+        dtype, channels = ImageMessageAdapter.ENCODINGS[image_message.encoding]
+        dtype = np.dtype(dtype).newbyteorder('>' if image_message.is_bigendian else '<')
+        height, width, step = image_message.height, image_message.width, image_message.step
+
+        row_size = width * channels * dtype.itemsize
+        if step < row_size or len(image_message.data) < (height - 1) * step + row_size:
+            raise ValueError(f'Image data too small for {width}x{height} {image_message.encoding} step {step}')
+
+        # Strided view skips the row padding directly, viewing padded rows as a wider dtype
+        # needs NumPy >= 1.23
+        array = np.ndarray(shape=(height, width * channels), dtype=dtype, buffer=image_message.data,
+                           strides=(step, dtype.itemsize))
+        if not dtype.isnative:
+            array = array.astype(dtype.newbyteorder('='))
+
+        return array.reshape(height, width, channels) if channels > 1 else array
+
+    @staticmethod
+    def to_bgr8(image_message):
+        # (H, W, 3) uint8, a view for bgr8 (and 8UC3), converted otherwise
+        image = ImageMessageAdapter.to_array(image_message)
+        if image_message.encoding in ('bgr8', '8UC3'):
+            return image
+        if image_message.encoding not in ImageMessageAdapter.TO_BGR:
+            raise ValueError(f'Can not convert {image_message.encoding} to bgr8')
+
+        return cv2.cvtColor(image, ImageMessageAdapter.TO_BGR[image_message.encoding])
+
+    @staticmethod
+    def to_depth(image_message):
+        # (H, W) view, 16UC1 in mm or 32FC1 in m as published
+        if image_message.encoding not in ('16UC1', 'mono16', '32FC1'):
+            raise ValueError(f'Unsupported depth encoding {image_message.encoding}')
+
+        return ImageMessageAdapter.to_array(image_message)
@@ -0,0 +1,88 @@
+import numpy as np
+
+from utils.ColorObjectFinder import ColorObjectFinder
+
+
+# Segments the full frame every full_frame_interval frames (or when requested).
+# In between only padded regions around the last known segments are labelled.
+# A segment reaching the inner edge of its region has moved or grown, which
+# triggers a full frame on the next call.
+class IncrementalSegmenter:
+
+    def __init__(self, full_frame_interval=30, padding=20):
+        self.full_frame_interval = full_frame_interval
+        self.padding = padding
+
+        self.frames_since_full = 0
+        self.full_frame_requested = True
+        self.boxes = []  # x1, y1, x2, y2 (exclusive)
+
+    def request_full_frame(self):
+        self.full_frame_requested = True
+
+    def segment(self, image, get_label_image, label_count=None):
+        # get_label_image(image) -> uint8 label image, called on the frame or on crops of it
+        height, width = image.shape[:2]
+        full_frame = self.full_frame_requested or len(self.boxes) == 0 or \
+            self.frames_since_full + 1 >= self.full_frame_interval
+
+        if full_frame:
+            label_image = get_label_image(image)
+            segments = ColorObjectFinder.find_label_segments(label_image, label_count)
+            self.frames_since_full = 0
+            self.full_frame_requested = False
+
+        else:
+            label_image = np.zeros((height, width), dtype='uint8')
+            segments = []
+            for x1, y1, x2, y2 in self.merge_boxes(self.boxes):
+                roi_labels = get_label_image(image[y1:y2, x1:x2])
+                label_image[y1:y2, x1:x2] = roi_labels
+
+                for segment in ColorObjectFinder.find_label_segments(roi_labels, label_count):
+                    if self.touches_inner_edge(segment['bbox'], x1, y1, x2, y2, width, height):
+                        self.full_frame_requested = True
+                    segment['bbox'][0] += x1
+                    segment['bbox'][1] += y1
+                    segment['centroid'][0] += x1
+                    segment['centroid'][1] += y1
+                    segments.append(segment)
+
+            self.frames_since_full += 1
+
+        self.boxes = [self.pad_box(segment['bbox'], width, height) for segment in segments]
+
+        return label_image, segments
+
+    def pad_box(self, bbox, width, height):
+        x, y, w, h = bbox
+        return (max(x - self.padding, 0), max(y - self.padding, 0),
+                min(x + w + self.padding, width), min(y + h + self.padding, height))
+
+    @staticmethod
+    def touches_inner_edge(bbox, x1, y1, x2, y2, width, height):
+        # Edges of the region that are also image edges do not count
+        x, y, w, h = bbox
+        return (x == 0 and x1 > 0) or (y == 0 and y1 > 0) or \
+            (x + w == x2 - x1 and x2 < width) or (y + h == y2 - y1 and y2 < height)
+
+    @staticmethod
+    def merge_boxes(boxes):
+        # Union of overlapping boxes so no pixel is labelled twice
+        merged = [list(box) for box in boxes]
+        i = 0
+        while i < len(merged):
+            grown = False
+            j = i + 1
+            while j < len(merged):
+                a, b = merged[i], merged[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    merged[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del merged[j]
+                    grown = True
+                else:
+                    j += 1
+            # A grown box can now overlap a box before i, scan again from the start
+            i = 0 if grown else i + 1
+
+        return merged
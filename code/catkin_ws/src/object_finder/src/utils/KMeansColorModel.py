@@ -0,0 +1,121 @@
+import cv2
+import numpy as np
+
+from utils.Const import Const
+from utils.HSVMaskEngine import HSVMaskEngine
+
+
+# Alternative to the fixed HSV boxes: nearest k-means center in BGR.
+# Centers are fitted once on a subsampled frame and the nearest center of every cell of a
+# quantized BGR cube is precomputed. A cluster belongs to a color state when the state's
+# own color falls in it or when most of its sample pixels (min_share) are inside the box.
+# Same get_color_masks interface as HSVMaskEngine so ColorObjectFinder can use either.
+class KMeansColorModel:
+
+    def __init__(self, clusters=12, bits=5, subsample=4, attempts=3, min_share=0.5):
+        self.clusters = clusters
+        self.bits = bits
+        self.subsample = subsample
+        self.attempts = attempts
+        self.min_share = min_share
+
+        self.centers = None
+        self.cluster_table = None  # (2^bits,)*3 nearest center index
+        self.sample_hsv = None
+        self.sample_clusters = None
+
+        # (2^24,) label of every BGR color, rebuilt when the cluster -> label mapping changes
+        self.label_table = None
+        self.cluster_labels = None
+        self.label_states = None
+
+    def is_fitted(self):
+        return self.centers is not None
+
+    def reset(self):
+        # Fit again on the next labelled frame
+        self.centers = None
+        self.label_table = None
+        self.cluster_labels = None
+
+    def fit(self, image):
+        samples = np.ascontiguousarray(image[::self.subsample, ::self.subsample]).reshape(-1, 3)
+
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
+        _, sample_clusters, centers = cv2.kmeans(np.float32(samples), self.clusters, None, criteria,
+                                                 self.attempts, cv2.KMEANS_PP_CENTERS)
+
+        self.centers = centers
+        self.sample_clusters = sample_clusters.ravel()
+        self.sample_hsv = cv2.cvtColor(samples.reshape(-1, 1, 3), cv2.COLOR_BGR2HSV).reshape(-1, 3)
+        self.cluster_table = self.compile_cluster_table(centers, self.bits)
+        self.label_table = None
+        self.cluster_labels = None
+
+    @staticmethod
+    def compile_cluster_table(centers, bits):
+        # Nearest center of every quantized cell, measured from the cell center
+        size = 1 << bits
+        shift = 8 - bits
+        values = (np.arange(size, dtype=np.float32) * (1 << shift)) + ((1 << shift) >> 1)
+
+        blue, green, red = np.meshgrid(values, values, values, indexing='ij')
+        cells = np.stack((blue, green, red), axis=-1).reshape(-1, 3)
+
+        distances = ((cells[:, None, :] - centers[None, :, :]) ** 2).sum(axis=-1)
+        return np.argmin(distances, axis=1).astype(np.uint8).reshape(size, size, size)
+
+    def get_cluster(self, bgr):
+        shift = 8 - self.bits
+        return self.cluster_table[bgr[0] >> shift, bgr[1] >> shift, bgr[2] >> shift]
+
+    def assign_clusters(self, states):
+        # (clusters,) uint8 cluster -> label, label k = states[k - 1], lowest label wins
+        shares = np.zeros((len(states), self.clusters))
+        cluster_sizes = np.maximum(np.bincount(self.sample_clusters, minlength=self.clusters), 1)
+        for index, state in enumerate(states):
+            hue_table, sat_table, val_table = HSVMaskEngine.get_channel_tables(state)
+            inside = hue_table[self.sample_hsv[:, 0]] & sat_table[self.sample_hsv[:, 1]] & \
+                val_table[self.sample_hsv[:, 2]]
+            shares[index] = np.bincount(self.sample_clusters, weights=inside, minlength=self.clusters) / cluster_sizes
+
+        cluster_labels = np.zeros(self.clusters, dtype=np.uint8)
+        for index in range(len(states) - 1, -1, -1):
+            cluster_labels[shares[index] >= self.min_share] = index + 1
+
+            state = states[index]
+            state_hsv = np.uint8([[[round(state[Const.HUE]) % (Const.HUE_MAX + 1),
+                                    np.clip(round(state[Const.SATURATION]), 0, Const.SAT_MAX),
+                                    np.clip(round(state[Const.VALUE]), 0, Const.VAL_MAX)]]])
+            cluster_labels[self.get_cluster(cv2.cvtColor(state_hsv, cv2.COLOR_HSV2BGR)[0, 0])] = index + 1
+
+        return cluster_labels
+
+    def compile_label_table(self, cluster_labels):
+        # Index r << 16 | g << 8 | b, the layout of a little endian BGRA pixel read as an int
+        cells = np.arange(256) >> (8 - self.bits)
+        cube_labels = cluster_labels[self.cluster_table]
+
+        return np.ascontiguousarray(
+            cube_labels[cells[None, None, :], cells[None, :, None], cells[:, None, None]]).ravel()
+
+    def label(self, image, states):
+        if not self.is_fitted():
+            self.fit(image)
+
+        states_key = [list(state) for state in states]
+        if self.label_table is None or states_key != self.label_states:
+            cluster_labels = self.assign_clusters(states)
+            if self.label_table is None or not np.array_equal(cluster_labels, self.cluster_labels):
+                self.label_table = self.compile_label_table(cluster_labels)
+                self.cluster_labels = cluster_labels
+            self.label_states = states_key
+
+        # A BGRA pixel read as int32 is 0xFF << 24 | r << 16 | g << 8 | b, a negative index
+        # that np.take wraps to entry r, g, b of the 2^24 table. One gather per pixel.
+        bgra = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+        return np.take(self.label_table, bgra.view('<i4')[..., 0])
+
+    def get_color_masks(self, image, states):
+        labels = self.label(image, states)
+        return [cv2.compare(labels, label, cv2.CMP_EQ) for label in range(1, len(states) + 1)]
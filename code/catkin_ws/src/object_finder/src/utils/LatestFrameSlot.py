@@ -0,0 +1,32 @@
+import threading
+import time
+from collections import deque
+
+
+# Holds only the newest size frames of a camera. put never blocks, a frame that is pushed
+# out before a worker took it counts as dropped, so slow processing skips frames
+# instead of queueing them. take returns the oldest frame still held.
+class LatestFrameSlot:
+
+    def __init__(self, size=1):
+        self.condition = threading.Condition()
+        self.frames = deque(maxlen=size)  # (frame, perf_counter time of put)
+
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, frame):
+        with self.condition:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append((frame, time.perf_counter()))
+            self.received += 1
+            self.condition.notify()
+
+    def take(self, timeout=None):
+        # (frame, perf_counter time of put), (None, None) on timeout
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.frames) > 0, timeout=timeout):
+                return None, None
+
+            return self.frames.popleft()
@@ -0,0 +1,50 @@
+import cv2
+
+from utils.Const import Const
+
+
+# Fill (close) and noise removal (open) of the color masks.
+# Gives the same result as 3 iterations of a close followed by 3 of an open
+# (see benchmarks/morphology_benchmark.py):
+#   - iterations of a rectangle are folded into one larger rectangle
+#   - close then open is dilate, erode, erode, dilate, the two erosions are fused
+class MaskMorphology:
+    ITERATIONS = 3
+
+    @staticmethod
+    def fold_iterations(kernel_size, iterations):
+        # n iterations of a (k x k) rectangle == one (n(k-1)+1) rectangle, anchor scaled by n
+        size = iterations * (kernel_size - 1) + 1
+        anchor = iterations * (kernel_size // 2)
+        return size, anchor
+
+    @staticmethod
+    def rectangle(size):
+        return cv2.getStructuringElement(cv2.MORPH_RECT, (size, size))
+
+    @staticmethod
+    def fill_and_remove_noise(mask, fill, noise, iterations=ITERATIONS):
+        if fill > 0 and noise > 0:
+            fill_size, fill_anchor = MaskMorphology.fold_iterations(fill, iterations)
+            noise_size, noise_anchor = MaskMorphology.fold_iterations(noise, iterations)
+
+            mask = cv2.dilate(mask, MaskMorphology.rectangle(fill_size), anchor=(fill_anchor, fill_anchor))
+            erode_anchor = fill_anchor + noise_anchor
+            mask = cv2.erode(mask, MaskMorphology.rectangle(fill_size + noise_size - 1),
+                             anchor=(erode_anchor, erode_anchor))
+            return cv2.dilate(mask, MaskMorphology.rectangle(noise_size), anchor=(noise_anchor, noise_anchor))
+
+        if fill > 0:
+            size, anchor = MaskMorphology.fold_iterations(fill, iterations)
+            return cv2.morphologyEx(mask, cv2.MORPH_CLOSE, MaskMorphology.rectangle(size), anchor=(anchor, anchor))
+
+        if noise > 0:
+            size, anchor = MaskMorphology.fold_iterations(noise, iterations)
+            return cv2.morphologyEx(mask, cv2.MORPH_OPEN, MaskMorphology.rectangle(size), anchor=(anchor, anchor))
+
+        return mask
+
+    @staticmethod
+    def clean_masks(masks, states, iterations=ITERATIONS):
+        return [MaskMorphology.fill_and_remove_noise(mask, state[Const.FILL], state[Const.NOISE], iterations)
+                for mask, state in zip(masks, states)]
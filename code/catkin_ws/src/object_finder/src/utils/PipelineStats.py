@@ -0,0 +1,44 @@
+import threading
+from collections import defaultdict
+
+from camera_calibration.utils.Profiler import Profiler
+
+
+# Always on stage durations and thread safe counters of a node. Durations are kept by the
+# process wide Profiler, so they share its percentiles, /diagnostics and trace with the
+# profiled functions. Stage names are free form, e.g. 'cam_top/segment'.
+class PipelineStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+
+    @staticmethod
+    def add(stage, seconds, end=None):
+        # end = perf_counter at the end of the stage puts it in the trace, leave it out for
+        # values that are not a span of this thread (stamp skew, message age)
+        Profiler.add(stage, seconds, end)
+
+    @staticmethod
+    def stage(name):
+        # Always on counterpart of Profiler.stage
+        return Profiler.Span(name)
+
+    def set_counter(self, name, value):
+        with self.lock:
+            self.counters[name] = value
+
+    def summary(self):
+        # {stage: (count, p50 ms, p95 ms, p99 ms)}, {counter: value}
+        with self.lock:
+            counters = dict(self.counters)
+
+        return Profiler.percentiles(), counters
+
+    def report(self):
+        stages, counters = self.summary()
+        lines = [f'{stage:<32} n {count:5d}  p50 {p50:8.3f}  p95 {p95:8.3f}  p99 {p99:8.3f} ms'
+                 for stage, (count, p50, p95, p99) in sorted(stages.items())]
+        lines += [f'{name:<32} {value}' for name, value in sorted(counters.items())]
+
+        return '\n'.join(lines)
@@ -0,0 +1,92 @@
+import time
+
+import numpy as np
+import rospy
+import tf2_ros
+from scipy.spatial.transform import Rotation
+
+from utils.PipelineStats import PipelineStats
+
+
+# Lookups on a tf2_ros.Buffer that wait with a timeout instead of spinning, return None
+# when the transform does not come, and record their latency in PipelineStats
+# ('tf/lookup', 'tf/failed', ...). Transforms between frames listed as static (e.g. the
+# calibrated world -> cam_front extrinsics) are looked up once and then served from memory.
+class TransformCache:
+    EXCEPTIONS = (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException)
+
+    def __init__(self, timeout=1., static_frames=(), stats=None, buffer=None):
+        self.timeout = timeout
+        self.static_frames = set(static_frames)
+        self.stats = stats if stats is not None else PipelineStats()
+        self.buffer = buffer if buffer is not None else tf2_ros.Buffer()
+        self.listener = tf2_ros.TransformListener(self.buffer)
+
+        self.static_transforms = dict()  # (target, source) -> TransformStamped
+        self.static_matrices = dict()  # (target, source) -> 4x4
+        self.failed = 0
+
+    def is_static(self, target, source):
+        return target in self.static_frames and source in self.static_frames
+
+    def lookup(self, target, source, stamp=None, timeout=None):
+        # TransformStamped target <- source at stamp (None = latest), None after timeout seconds
+        key = (target, source)
+        if key in self.static_transforms:
+            self.stats.add('tf/static', 0.)
+            return self.static_transforms[key]
+
+        start_time = time.perf_counter()
+        try:
+            transform = self.buffer.lookup_transform(
+                target, source,
+                stamp if stamp is not None else rospy.Time(),
+                rospy.Duration(self.timeout if timeout is None else timeout))
+        except self.EXCEPTIONS:
+            self.failed += 1
+            failed_time = time.perf_counter()
+            self.stats.add('tf/failed', failed_time - start_time, end=failed_time)
+            self.stats.set_counter('tf/failed', self.failed)
+            print(f"No transform found between '{target}' and '{source}'.")
+            return None
+
+        done_time = time.perf_counter()
+        self.stats.add('tf/lookup', done_time - start_time, end=done_time)
+        if self.is_static(target, source):
+            self.static_transforms[key] = transform
+        return transform
+
+    def lookup_many(self, target, sources, stamp=None, timeout=None):
+        # {source: TransformStamped or None} for many frames at one stamp, only the first
+        # lookup waits, the others are already in the buffer or will not come in time
+        transforms = dict()
+        waited = False
+        for source in sources:
+            transforms[source] = self.lookup(target, source, stamp, timeout=0. if waited else timeout)
+            waited = waited or not self.is_static(target, source)
+        return transforms
+
+    def lookup_matrix(self, target, source, stamp=None, timeout=None):
+        # 4x4 homogeneous target <- source, None after timeout seconds
+        key = (target, source)
+        if key in self.static_matrices:
+            return self.static_matrices[key]
+
+        transform = self.lookup(target, source, stamp, timeout)
+        if transform is None:
+            return None
+
+        matrix = self.to_matrix(transform)
+        if key in self.static_transforms:
+            self.static_matrices[key] = matrix
+        return matrix
+
+    @staticmethod
+    def to_matrix(transform_stamped):
+        translation = transform_stamped.transform.translation
+        rotation = transform_stamped.transform.rotation
+
+        matrix = np.eye(4)
+        matrix[:3, :3] = Rotation.from_quat([rotation.x, rotation.y, rotation.z, rotation.w]).as_matrix()
+        matrix[:3, 3] = [translation.x, translation.y, translation.z]
+        return matrix
@@ -62,7 +62,7 @@ class UI:
         self.mouse_hover_y = y
 
     def update_ui(self, selected_camera, captured_values, scale, roi_size):
-        info = "[0-9] selected camera, [q]uit, [c]ollect color, [e]xport colors, [u]ndo, [o/p] scale, [k/l] ROI"
+        info = "[0-9] selected camera, [q]uit, [c]ollect color, [e]xport colors, [u]ndo, [o/p] scale, [k/l] ROI, [f]ull frame, [n]ew k-means"
         DaVinci.draw_text_box(
             image=self.display_image,
             text=info
@@ -1,6 +1,22 @@
 __all__ = [
     "ColorObjectFinder",
+    "ColorSampler",
     "DaVinci",
+    "DebugImagePublisher",
     "Const",
+    "ColorLookupTable",
+    "CameraRig",
+    "CubeFuser",
+    "CubePoseEstimator",
+    "CubeTracker",
+    "HSVFitter",
+    "HSVMaskEngine",
+    "ImageMessageAdapter",
+    "IncrementalSegmenter",
+    "KMeansColorModel",
+    "LatestFrameSlot",
+    "MaskMorphology",
+    "PipelineStats",
+    "TransformCache",
     "UI"
 ]